@@ -0,0 +1,40 @@
+"""
+    Benchmark del listado de imagenes (models.get_images_by_date): compara la version anterior con N+1 consultas
+    (una select de pictures y una select de tags por imagen) frente a la select unica con LEFT JOIN.
+    Informa de round trips a la BBDD y latencia para distintos tamaños de tabla.
+
+    Uso: python -m benchmarks.bench_images_join [n1 n2 ...]
+"""
+import sys
+import json
+
+from image_tags_api import models
+from benchmarks.common import create_sqlite_database, seed_pictures, RoundTripCounter, timed
+
+
+def get_images_by_date_n_plus_1(min_date: str, max_date: str):
+    """
+        Implementacion anterior de models.get_images_by_date: una select de tags por cada imagen.
+    """
+    sql, params = models.set_sql_pictures_by_date(min_date, max_date)
+    result = models.run_query(sql, params)
+    return [{"id": models.id_from_db(p_id), "date": models.date_from_db(p_date), "size": p_size,
+             "tags": models.get_tags_by_picture_id(models.id_from_db(p_id))} for p_id, p_date, p_size in result]
+
+def run(sizes):
+    results = []
+    for n in sizes:
+        create_sqlite_database()
+        seed_pictures(n)
+        row = {"pictures": n}
+        for name, func in (("n_plus_1", get_images_by_date_n_plus_1), ("join", models.get_images_by_date)):
+            with RoundTripCounter() as counter:
+                func("", "")
+            seconds, images = timed(func, "", "")
+            row[name] = {"round_trips": counter.count, "seconds": round(seconds, 4), "images": len(images)}
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+if __name__ == "__main__":
+    run([int(n) for n in sys.argv[1:]] or [100, 1000, 5000])
@@ -0,0 +1,51 @@
+"""
+    Benchmark de la migracion 08 (scripts/migracion_08_fechas_ids_binarios.sql): compara el esquema anterior
+    (ids VARCHAR(36) y fechas VARCHAR(25)) con el actual (ids BINARY(16) y fechas DATETIME) sobre un archivo sintetico.
+    Informa del tamaño en disco de cada tabla e indice (tabla dbstat de SQLite) y de la latencia de consultas por rango
+    de fechas: recuento de un mes y primera pagina de GET /images de un dia.
+    En SQLite DATETIME se guarda como texto, por lo que la diferencia se debe al tamaño de ids y claves; en MySQL
+    el tamaño de los indices se consulta en mysql.innodb_index_stats (stat_name='size').
+
+    Uso: python -m benchmarks.bench_schema_types [n_imagenes [tags_por_imagen]]
+"""
+import sys
+import json
+import datetime
+
+from image_tags_api import models
+from benchmarks.common import SQLITE_SCHEMA, create_sqlite_database, seed_pictures, timed
+
+# Esquema anterior a la migracion 08
+LEGACY_SQLITE_SCHEMA = (SQLITE_SCHEMA.replace("id BINARY(16)", "id VARCHAR(36)")
+                        .replace("picture_id BINARY(16)", "picture_id VARCHAR(36)")
+                        .replace("date DATETIME", "date VARCHAR(25)"))
+# Rangos consultados (los archivos sinteticos cubren 2023)
+MONTH = (datetime.datetime(2023, 6, 1), datetime.datetime(2023, 7, 1))
+DAY = (datetime.datetime(2023, 6, 1), datetime.datetime(2023, 6, 2))
+
+
+def get_sizes():
+    """
+        Devuelve los bytes ocupados por cada tabla e indice de la base de datos.
+    """
+    rows = models.run_query("SELECT name, SUM(pgsize) FROM dbstat WHERE name NOT LIKE 'sqlite_schema' GROUP BY name ORDER BY name", {})
+    return {name: int(size) for name, size in rows}
+
+def count_range(min_date, max_date):
+    return models.run_query("SELECT COUNT(*) FROM pictures p WHERE p.date>:min_date AND p.date<:max_date",
+                            {"min_date": min_date, "max_date": max_date})[0][0]
+
+def run(n_pictures: int, tags_per_picture: int):
+    results = {}
+    for name, schema, binary_ids in (("varchar", LEGACY_SQLITE_SCHEMA, False), ("binary_datetime", SQLITE_SCHEMA, True)):
+        create_sqlite_database(schema=schema)
+        seed_pictures(n_pictures, tags_per_picture=tags_per_picture, binary_ids=binary_ids)
+        month_seconds, month_count = timed(count_range, *MONTH)
+        page_seconds, page = timed(models.get_images_by_date, *DAY, limit=100)
+        results[name] = {"sizes": get_sizes(), "count_month": {"seconds": round(month_seconds, 4), "pictures": month_count},
+                         "images_day_page": {"seconds": round(page_seconds, 4), "images": len(page)}}
+        print(json.dumps({name: results[name]}))
+    return results
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000, int(sys.argv[2]) if len(sys.argv) > 2 else 2)
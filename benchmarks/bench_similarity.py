@@ -0,0 +1,56 @@
+"""
+    Benchmark del indice de similitud (similarity.TagIndex) usado por GET /image/<id>/similar: tiempo de carga del
+    indice, de una consulta top-k y de la insercion incremental de imagenes nuevas, para n imagenes sinteticas con
+    8 tags del vocabulario de benchmarks.common. La carga se hace en memoria, sin BBDD, como en similarity.build_index.
+
+    Uso: python -m benchmarks.bench_similarity [numero_de_imagenes]
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import statistics
+
+from image_tags_api import similarity
+from benchmarks.common import TAG_VOCABULARY
+
+
+def synthetic_tags(rnd: random.Random, tags_per_picture: int = 8):
+    return [{"tag": tag, "confidence": rnd.randrange(1, 101)} for tag in rnd.sample(TAG_VOCABULARY, tags_per_picture)]
+
+def run(n_pictures: int, n_queries: int = 200, n_inserts: int = 10000):
+    rnd = random.Random(0)
+    pictures = [(str(uuid.UUID(int=rnd.getrandbits(128), version=4)), synthetic_tags(rnd)) for _ in range(n_pictures)]
+
+    # Carga del indice con una sola fusion, como build_index
+    start = time.perf_counter()
+    index = similarity.TagIndex()
+    index.add_many(pictures)
+    build_seconds = time.perf_counter() - start
+
+    def query_times():
+        times = []
+        for picture_id, tags in rnd.sample(pictures, n_queries):
+            start = time.perf_counter()
+            index.top_k(tags, 10, exclude=picture_id)
+            times.append(time.perf_counter() - start)
+        return {"p50_ms": round(statistics.median(times)*1000, 3),
+                "max_ms": round(max(times)*1000, 3)}
+
+    result = {"pictures": n_pictures, "build_seconds": round(build_seconds, 2), "query": query_times()}
+    # Insercion incremental: las imagenes nuevas van al delta, que se fusiona al superar el umbral
+    times = []
+    for _ in range(n_inserts):
+        picture_id, tags = str(uuid.UUID(int=rnd.getrandbits(128), version=4)), synthetic_tags(rnd)
+        start = time.perf_counter()
+        index.add(picture_id, tags)
+        times.append(time.perf_counter() - start)
+    result["insert"] = {"mean_us": round(statistics.mean(times)*1e6, 1), "max_ms": round(max(times)*1000, 3)}
+    # Consultas con el delta pendiente de fusionar
+    result["query_with_delta"] = query_times()
+    print(json.dumps(result))
+    return result
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
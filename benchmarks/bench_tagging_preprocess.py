@@ -0,0 +1,63 @@
+"""
+    Benchmark de la reduccion de imagenes antes del etiquetado (preprocess.resize_for_tagging): compara los bytes
+    enviados al backend de etiquetado y el tiempo de registro completo (controller.register_image_bytes) con y sin
+    reduccion. El backend es un FakeTagger que simula la subida con un ancho de banda fijo (por defecto 10 Mbit/s),
+    ya que el tiempo de subida es el que domina el registro de imagenes grandes.
+    Usa las imagenes de tests/data y una imagen sintetica de 12 megapixeles.
+
+    Uso: python -m benchmarks.bench_tagging_preprocess [ancho_de_banda_en_bytes_por_segundo]
+"""
+import io
+import os
+import sys
+import json
+import random
+import tempfile
+
+from PIL import Image
+
+from image_tags_api import controller, metrics, taggers
+from benchmarks.common import create_sqlite_database, timed
+
+
+def synthetic_photo(width: int = 4000, height: int = 3000, seed: int = 0):
+    """
+        Genera un JPEG de width x height pixeles con ruido, similar en tamaño a una foto de movil.
+    """
+    rnd = random.Random(seed)
+    image = Image.frombytes("RGB", (width // 4, height // 4), rnd.randbytes(width // 4 * height // 4 * 3))
+    output = io.BytesIO()
+    image.resize((width, height), Image.BILINEAR).save(output, "JPEG", quality=92)
+    return output.getvalue()
+
+def load_images():
+    data = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "data")
+    images = {name: open(os.path.join(data, name), "rb").read() for name in sorted(os.listdir(data)) if name.endswith(".jpg")}
+    images["synthetic_12mp.jpg"] = synthetic_photo()
+    return images
+
+def register(image_bin: bytes):
+    # Cada registro es una imagen nueva: evitamos la deduplicacion por contenido añadiendo un byte aleatorio
+    return controller.register_image_bytes(image_bin + os.urandom(1), 0)
+
+def run(bandwidth: float):
+    create_sqlite_database()
+    os.environ["IMAGE_FOLDER"] = tempfile.mkdtemp(prefix="bench_images_")
+    taggers.set_tagger(taggers.FakeTagger(bandwidth=bandwidth))
+    max_edge = os.environ.get("TAG_MAX_EDGE", "1024")
+    repeat = 3
+    results = []
+    for name, image_bin in load_images().items():
+        row = {"image": name, "bytes": len(image_bin)}
+        for mode, max_edge in (("original", "0"), ("resized", max_edge)):
+            os.environ["TAG_MAX_EDGE"] = max_edge
+            sent = metrics.get_counter("tagging_bytes_sent")
+            seconds, _ = timed(register, image_bin, repeat=repeat)
+            row[mode] = {"bytes_sent": (metrics.get_counter("tagging_bytes_sent") - sent) // repeat, "seconds": round(seconds, 4)}
+        os.environ["TAG_MAX_EDGE"] = max_edge
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+if __name__ == "__main__":
+    run(float(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000 / 8)
@@ -0,0 +1,33 @@
+"""
+    Benchmark de las estadisticas de GET /tags (models.get_tags_stats_by_date): compara la agregacion de la tabla tags
+    frente a la combinacion de la tabla tag_stats (una fila por tag y dia) con los dias parciales de los extremos.
+    Informa de la latencia para el archivo completo y para un rango de 30 dias, para distintos tamaños de tabla.
+
+    Uso: python -m benchmarks.bench_tags_rollup [n1 n2 ...]
+"""
+import sys
+import json
+
+from image_tags_api import models
+from benchmarks.common import create_sqlite_database, seed_pictures, timed
+
+# Rangos de fechas consultados (los archivos sinteticos cubren 2023)
+RANGES = {"all": ("", ""), "30_days": ("2023-06-01 12:30:00", "2023-07-01 08:00:00")}
+
+
+def run(sizes):
+    results = []
+    for n in sizes:
+        create_sqlite_database()
+        seed_pictures(n)
+        row = {"pictures": n}
+        for range_name, (min_date, max_date) in RANGES.items():
+            for name, use_rollup in (("raw", False), ("rollup", True)):
+                seconds, tags = timed(models.get_tags_stats_by_date, min_date, max_date, use_rollup=use_rollup)
+                row[f"{range_name}_{name}"] = {"seconds": round(seconds, 4), "tags": len(tags)}
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+if __name__ == "__main__":
+    run([int(n) for n in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,144 @@
+"""
+    Utilidades comunes de los benchmarks: base de datos SQLite local con el esquema de la API,
+    generacion de archivos sinteticos de imagenes y tags, y contador de round trips a la BBDD.
+"""
+import os
+import time
+import uuid
+import random
+import sqlite3
+import datetime
+import tempfile
+
+from sqlalchemy import event, text
+
+from image_tags_api import models
+
+# Esquema equivalente a scripts/crear_db_tabla.sql y sus migraciones en dialecto SQLite
+SQLITE_SCHEMA = """
+create table pictures (id BINARY(16) PRIMARY KEY,
+                       path VARCHAR(256) NOT NULL,
+                       date DATETIME NOT NULL,
+                       size INT,
+                       hash CHAR(64) NULL,
+                       min_confidence INT NULL,
+                       segment VARCHAR(64) NULL,
+                       seg_offset BIGINT NULL,
+                       seg_length INT NULL
+                       );
+create index idx_pictures_date on pictures (date);
+create table tags (tag VARCHAR(32),
+                   picture_id BINARY(16),
+                   confidence INT NOT NULL,
+                   date DATETIME NOT NULL,
+                   PRIMARY KEY (tag, picture_id),
+                   FOREIGN KEY (picture_id) REFERENCES pictures(id)
+                   );
+create index idx_tags_picture on tags (picture_id);
+create index idx_tags_date on tags (date, tag, confidence);
+create index idx_tags_tag_confidence on tags (tag, confidence);
+create table tag_stats (tag VARCHAR(32) NOT NULL,
+                        day VARCHAR(10) NOT NULL,
+                        n INT NOT NULL,
+                        sum_confidence BIGINT NOT NULL,
+                        min_confidence INT NOT NULL,
+                        max_confidence INT NOT NULL,
+                        PRIMARY KEY (tag, day)
+                        );
+create index idx_tag_stats_day on tag_stats (day);
+create table jobs (id VARCHAR(36) PRIMARY KEY,
+                   status VARCHAR(16) NOT NULL,
+                   path VARCHAR(256) NOT NULL,
+                   min_confidence INT NOT NULL,
+                   result TEXT NULL,
+                   created VARCHAR(25) NOT NULL,
+                   updated VARCHAR(25) NOT NULL
+                   );
+"""
+
+# Vocabulario de tags de los archivos sinteticos
+TAG_VOCABULARY = [f"tag{i}" for i in range(500)]
+
+
+def create_sqlite_database(path: str = None, schema: str = SQLITE_SCHEMA):
+    """
+        Crea una base de datos SQLite con el esquema de la API e inicializa el engine compartido de models sobre ella.
+    Args:
+        path (str): fichero de la base de datos. Por defecto un fichero temporal.
+        schema (str): esquema de la base de datos. Por defecto SQLITE_SCHEMA
+
+    Returns:
+        str: path del fichero de la base de datos
+    """
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="bench_"), "pictures.sqlite")
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    conn.commit()
+    conn.close()
+    models.init_engine(f"sqlite:///{path}")
+    return path
+
+def seed_pictures(n_pictures: int, tags_per_picture: int = 8, seed: int = 0, batch: int = 5000, binary_ids: bool = True,
+                  path: str = None):
+    """
+        Inserta n_pictures imagenes sinteticas con tags_per_picture tags cada una, repartidas en el ultimo año.
+    Args:
+        n_pictures (int): numero de imagenes
+        tags_per_picture (int): numero de tags por imagen
+        seed (int): semilla de la generacion aleatoria
+        batch (int): numero de imagenes por transaccion
+        binary_ids (bool): guarda los ids en binario (BINARY(16)), como el esquema actual, o en texto, como el anterior
+        path (str): fichero de todas las imagenes, para poder leerlas. Por defecto un path que no existe
+
+    Returns:
+        list: ids de las imagenes insertadas
+    """
+    rnd = random.Random(seed)
+    now = datetime.datetime(2024, 1, 1)
+    ids = []
+    with models.connect() as conn:
+        for start in range(0, n_pictures, batch):
+            pictures, tags = [], []
+            for _ in range(start, min(start + batch, n_pictures)):
+                p_id = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+                db_id = models.id_to_db(p_id) if binary_ids else p_id
+                date = (now - datetime.timedelta(seconds=rnd.randrange(365*24*3600))).strftime("%Y-%m-%d %H:%M:%S")
+                pictures.append({"id": db_id, "path": path or f"img_{p_id}", "date": date, "size": rnd.randrange(10_000, 5_000_000)})
+                for tag in rnd.sample(TAG_VOCABULARY, tags_per_picture):
+                    tags.append({"tag": tag, "picture_id": db_id, "confidence": rnd.randrange(1, 101), "date": date})
+                ids.append(p_id)
+            conn.execute(text("INSERT INTO pictures (id,path,date, size) VALUES (:id, :path, :date, :size)"), pictures)
+            conn.execute(text("INSERT INTO tags (tag,picture_id,confidence,date) VALUES (:tag, :picture_id, :confidence, :date)"), tags)
+            conn.commit()
+    # Calculamos las estadisticas por tag y dia de los tags insertados
+    models.rebuild_tag_stats()
+    return ids
+
+class RoundTripCounter:
+    """
+        Cuenta las sentencias enviadas a la BBDD por el engine compartido mientras esta activo (context manager).
+    """
+    def __init__(self):
+        self.count = 0
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(models.get_engine(), "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(models.get_engine(), "before_cursor_execute", self._on_execute)
+
+def timed(func, *args, repeat: int = 3, **kwargs):
+    """
+        Ejecuta func repeat veces y devuelve el mejor tiempo en segundos y el resultado de la ultima ejecucion.
+    """
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
@@ -0,0 +1,105 @@
+"""
+    Servidores HTTP locales que simulan Imagga e Imagekitio en los benchmarks, con una latencia configurable por
+    servicio. Se usan configurando IMAGGA_API_URL e IMAGEKIT_API_URL con la url del servidor (ver FakeServices.env).
+
+    Rutas simuladas:
+        - POST /api/v1/files/upload (subida a Imagekitio): devuelve fileId y la url publica de la imagen
+        - DELETE /v1/files/<id> (borrado en Imagekitio): 204
+        - GET /v2/tags?image_url=... y POST /v2/tags (tags de Imagga): tags deterministas derivados de la imagen
+"""
+import json
+import time
+import uuid
+import random
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.common import TAG_VOCABULARY
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict = None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _tags(self, key: bytes):
+        rnd = random.Random(hashlib.sha256(key).digest())
+        return {"result": {"tags": [{"tag": {"en": tag}, "confidence": round(rnd.uniform(5, 100), 4)}
+                                    for tag in rnd.sample(TAG_VOCABULARY, self.server.n_tags)]}}
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+        if path == "/api/v1/files/upload":
+            time.sleep(self.server.imagekit_latency)
+            file_id = uuid.uuid4().hex
+            self._send_json(200, {"fileId": file_id, "name": file_id, "filePath": f"/{file_id}",
+                                  "url": f"{self.server.url}/files/{file_id}", "size": len(body), "fileType": "image",
+                                  "AITags": None, "versionInfo": {"id": file_id, "name": "Version 1"}})
+        elif path == "/v2/tags":
+            time.sleep(self.server.imagga_latency)
+            self._send_json(200, self._tags(body))
+        else:
+            self._send_json(404, {"message": "not found"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/v2/tags":
+            time.sleep(self.server.imagga_latency)
+            self._send_json(200, self._tags(parse_qs(url.query).get("image_url", [""])[0].encode()))
+        else:
+            self._send_json(404, {"message": "not found"})
+
+    def do_DELETE(self):
+        if urlparse(self.path).path.startswith("/v1/files/"):
+            time.sleep(self.server.imagekit_latency)
+            self._send_json(204)
+        else:
+            self._send_json(404, {"message": "not found"})
+
+class FakeServices:
+    """
+        Servidor local de Imagga e Imagekitio en un thread del proceso. Imagga responde tras imagga_latency segundos
+        e Imagekitio tras imagekit_latency segundos por llamada.
+    """
+    def __init__(self, imagga_latency: float = 0.0, imagekit_latency: float = 0.0, n_tags: int = 10):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeServiceHandler)
+        self.server.daemon_threads = True
+        self.server.imagga_latency = imagga_latency
+        self.server.imagekit_latency = imagekit_latency
+        self.server.n_tags = n_tags
+        self.server.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.url = self.server.url
+        self._thread = None
+
+    def env(self):
+        """
+            Devuelve las variables de entorno que dirigen las llamadas de la API a este servidor.
+
+        Returns:
+            dict: variables de entorno
+        """
+        return {"IMAGGA_API_URL": self.url, "IMAGEKIT_API_URL": self.url}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-services", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,203 @@
+"""
+    Prueba de carga reproducible de la API: arranca la aplicacion Flask en el proceso, servida por waitress, sobre una
+    base de datos SQLite temporal (o una MySQL local con --database-url) con un archivo sintetico de imagenes y tags,
+    y con Imagga e Imagekitio simulados por servidores locales con latencia configurable (ver fake_services).
+    Lanza cada escenario con una concurrencia fija y devuelve, en json, el throughput y las latencias p50/p95/p99 de
+    cada uno, para compararlos entre commits.
+
+    Escenarios: post_image (POST /image), get_images (GET /images de un dia), get_images_tags (GET /images con dos tags),
+    get_image (GET /image/<id>) y get_tags (GET /tags de 30 dias).
+
+    Uso: python -m benchmarks.loadtest [--pictures 10000] [--concurrency 8] [--requests 500] [--scenarios ...]
+             [--imagga-latency 0.05] [--imagekit-latency 0.02] [--tagger url] [--database-url url] [--output fichero]
+    Con --database-url la BBDD debe tener el esquema de scripts/ aplicado: el archivo sintetico se inserta en ella.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from waitress import create_server
+
+from image_tags_api import models
+from benchmarks.common import create_sqlite_database, seed_pictures, TAG_VOCABULARY
+from benchmarks.fake_services import FakeServices
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "data")
+SCENARIOS = ("post_image", "get_images", "get_images_tags", "get_image", "get_tags")
+# Rango de fechas del archivo sintetico (ver common.seed_pictures)
+ARCHIVE_END = datetime.datetime(2024, 1, 1)
+
+
+def percentile(values: list, p: float):
+    """
+        Devuelve el percentil p (0-100) de values, ya ordenados, por el metodo del rango mas cercano.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+def random_window(rnd: random.Random, days: int):
+    start = ARCHIVE_END - datetime.timedelta(days=rnd.randrange(365 - days + 1) + days)
+    return start.strftime("%Y-%m-%d %H:%M:%S"), (start + datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+def make_request(scenario: str, session: requests.Session, url: str, rnd: random.Random, ids: list, images: list):
+    """
+        Envia una peticion del escenario scenario y devuelve su codigo de estado.
+    """
+    if scenario == "post_image":
+        # Un byte aleatorio al final evita la deduplicacion por contenido sin invalidar el JPEG
+        image_bin = rnd.choice(images) + rnd.randbytes(1)
+        response = session.post(f"{url}/image?min_confidence=0&return_data=false", data=image_bin,
+                                headers={"Content-Type": "application/octet-stream"})
+    elif scenario == "get_images":
+        min_date, max_date = random_window(rnd, 1)
+        response = session.get(f"{url}/images", params={"min_date": min_date, "max_date": max_date, "limit": 100})
+    elif scenario == "get_images_tags":
+        min_date, max_date = random_window(rnd, 30)
+        response = session.get(f"{url}/images", params={"min_date": min_date, "max_date": max_date, "limit": 100,
+                                                        "tags": ",".join(rnd.sample(TAG_VOCABULARY, 2))})
+    elif scenario == "get_image":
+        response = session.get(f"{url}/image/{rnd.choice(ids)}")
+    else:
+        min_date, max_date = random_window(rnd, 30)
+        response = session.get(f"{url}/tags", params={"min_date": min_date, "max_date": max_date})
+    response.content
+    return response.status_code
+
+def run_scenario(scenario: str, url: str, n_requests: int, concurrency: int, ids: list, images: list, seed: int = 0):
+    """
+        Lanza n_requests peticiones del escenario con concurrency clientes concurrentes, cada uno con su sesion HTTP
+        keep-alive, y devuelve el throughput y la distribucion de latencias.
+    """
+    latencies, statuses = [], {}
+    remaining = [n_requests]
+    lock = threading.Lock()
+
+    def client(index: int):
+        rnd = random.Random(f"{seed}-{scenario}-{index}")
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status = make_request(scenario, session, url, rnd, ids, images)
+            except requests.RequestException:
+                status = "connection_error"
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client, range(concurrency)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {"requests": n_requests, "concurrency": concurrency, "seconds": round(seconds, 3),
+            "throughput_rps": round(n_requests / seconds, 2),
+            "errors": sum(count for status, count in statuses.items() if not status.startswith("2")),
+            "status": statuses,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2), "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2), "max_ms": round(latencies[-1] * 1000, 2),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2)}
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(DATA_FOLDER)).stdout.strip() or None
+    except OSError:
+        return None
+
+def prepare(args, workdir: str):
+    """
+        Configura el entorno de la API (credenciales, carpeta de imagenes, BBDD y servicios simulados), crea la BBDD
+        con el archivo sintetico y devuelve los ids de las imagenes insertadas.
+    """
+    with open(os.path.join(workdir, "credentials.json"), "w") as f:
+        json.dump({"imaggan": {"api_secret": "secret", "api_key": "key"},
+                   "imagekitio": {"url_endpoint": "http://127.0.0.1/fake", "public_key": "public_key",
+                                  "private_key": "private_key"}}, f)
+    os.environ["IMAGE_FOLDER"] = os.path.join(workdir, "images")
+    os.makedirs(os.environ["IMAGE_FOLDER"])
+    os.environ["TAGGER_BACKEND"] = args.tagger
+    os.environ.setdefault("JOBS_WORKERS", "0")
+    # Todas las imagenes del archivo apuntan a un mismo fichero, para que GET /image pueda leerlas
+    picture_path = os.path.join(os.environ["IMAGE_FOLDER"], "archive.jpg")
+    shutil.copy(os.path.join(DATA_FOLDER, "car1.jpg"), picture_path)
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+        models.init_engine(args.database_url)
+    else:
+        os.environ["DATABASE_URL"] = f"sqlite:///{create_sqlite_database(os.path.join(workdir, 'pictures.sqlite'))}"
+    start = time.perf_counter()
+    ids = seed_pictures(args.pictures, path=picture_path)
+    print(f"Archivo sintetico de {args.pictures} imagenes creado en {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return ids
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    services = FakeServices(args.imagga_latency, args.imagekit_latency).start()
+    # La API se dirige a los servicios simulados con IMAGGA_API_URL e IMAGEKIT_API_URL, leidas al crear la aplicacion
+    os.environ.update(services.env())
+    try:
+        ids = prepare(args, workdir)
+        images = [open(os.path.join(DATA_FOLDER, name), "rb").read() for name in sorted(os.listdir(DATA_FOLDER))]
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            from image_tags_api import create_app
+            app = create_app()
+        finally:
+            os.chdir(cwd)
+        server = create_server(app, host="127.0.0.1", port=0, threads=args.server_threads or args.concurrency)
+        threading.Thread(target=server.run, name="loadtest-server", daemon=True).start()
+        url = f"http://127.0.0.1:{server.effective_port}"
+
+        results = {"commit": get_commit(), "python": platform.python_version(),
+                   "database": "mysql" if args.database_url else "sqlite", "pictures": args.pictures,
+                   "concurrency": args.concurrency, "tagger": args.tagger, "imagga_latency": args.imagga_latency,
+                   "imagekit_latency": args.imagekit_latency, "scenarios": {}}
+        for scenario in args.scenarios:
+            # Calentamiento: conexiones, caches de SQLite y del proceso
+            run_scenario(scenario, url, min(args.concurrency * 2, args.requests), args.concurrency, ids, images, seed=1)
+            results["scenarios"][scenario] = run_scenario(scenario, url, args.requests, args.concurrency, ids, images)
+            print(json.dumps({scenario: results["scenarios"][scenario]}), file=sys.stderr)
+        server.close()
+    finally:
+        services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga de la API con servicios externos simulados")
+    parser.add_argument("--pictures", type=int, default=10000, help="imagenes del archivo sintetico (10000)")
+    parser.add_argument("--concurrency", type=int, default=8, help="clientes concurrentes (8)")
+    parser.add_argument("--requests", type=int, default=500, help="peticiones por escenario (500)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--imagga-latency", type=float, default=0.05, help="latencia de Imagga en segundos (0.05)")
+    parser.add_argument("--imagekit-latency", type=float, default=0.02, help="latencia de Imagekitio en segundos (0.02)")
+    parser.add_argument("--tagger", choices=("url", "direct"), default="url", help="backend de etiquetado (url)")
+    parser.add_argument("--server-threads", type=int, default=None, help="threads de waitress (--concurrency)")
+    parser.add_argument("--database-url", default=None, help="BBDD MySQL con el esquema aplicado (SQLite temporal)")
+    parser.add_argument("--output", default=None, help="fichero donde guardar el json de resultados")
+    run(parser.parse_args())
@@ -1,25 +1,38 @@
 from flask import Flask
-import os
-import json
+import time
+import logging
 
 def create_app():
+    start = time.perf_counter()
     app = Flask(__name__)
-    # Cargamos las credenciales
-    credentials="credentials.json"
-    with open(credentials, 'r') as f:
-            data = json.load(f)
-    # Definimos las credenciales como variables de entorno
-    os.environ["IMAGGAN_API_SECRET"] = data['imaggan']['api_secret']
-    os.environ["IMAGGAN_API_KEY"] = data['imaggan']['api_key']
-    os.environ["IMAGEKIT_URL_ENDPOINT"] = data['imagekitio']['url_endpoint']
-    os.environ["IMAGEKIT_PUBLIC_KEY"] = data['imagekitio']['public_key']
-    os.environ["IMAGEKIT_PRIVATE_KEY"] = data['imagekitio']['private_key']
+    # Cargamos la configuracion y las credenciales
+    from image_tags_api import config
+    settings = config.load_settings()
+    app.config["SETTINGS"] = settings
+
+    # Creamos el engine de la BBDD con su pool de conexiones, compartido por todas las peticiones
+    from image_tags_api import models
+    models.init_engine()
     
     # Import views
     from image_tags_api.image_view import image_bp
     from image_tags_api.tag_view import tag_bp
+    from image_tags_api.monitor_view import monitor_bp
+    from image_tags_api.job_view import job_bp
     # Registramos los blueprints
     app.register_blueprint(image_bp)
     app.register_blueprint(tag_bp)
+    app.register_blueprint(monitor_bp)
+    app.register_blueprint(job_bp)
+
+    # Arrancamos los workers que registran en segundo plano las imagenes de POST /image?async=true
+    from image_tags_api import jobs
+    if settings.jobs_workers > 0:
+        jobs.start_workers(settings.jobs_workers)
+
+    # Calentamos en segundo plano el pool de conexiones y las sesiones HTTP: /readyz responde 200 al terminar
+    from image_tags_api import startup
+    startup.start_warmup(settings, start)
+    logging.info(f"Aplicacion creada en {time.perf_counter() - start:.3f}s")
 
-    return app
\ No newline at end of file
+    return app
@@ -10,3 +10,6 @@ class BBDDConexionError(Exception):
 
 class BBDDObjetoError(Exception):
     pass
+
+class CircuitOpenError(Exception):
+    pass
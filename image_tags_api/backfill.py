@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import uuid
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import models, controller, storage
+
+# Completa los tags de las imagenes registradas antes de guardar todos los tags (pictures.min_confidence mayor que 0
+# o NULL): vuelve a etiquetar cada imagen y añade los tags que le faltan (ver models.add_picture_tags).
+# El progreso se guarda en un fichero de checkpoint tras cada bloque, de forma que se puede interrumpir y reanudar.
+# La API se ejecuta en otro proceso: con api_url, tras cada bloque se le pide que refresque las imagenes completadas
+# (POST /images/refresh); sin ella, sus caches y su indice de similitud se actualizan al caducar o al reiniciarla.
+
+
+def load_checkpoint(path: str):
+    """
+        Lee el checkpoint del backfill. Si no existe, devuelve un checkpoint vacio.
+    Args:
+        path (str): fichero del checkpoint
+
+    Raises:
+        ValueError: si el checkpoint no es valido
+
+    Returns:
+        dict: con las claves after (id de la ultima imagen procesada), pictures, tags, missing y errors
+    """
+    if not os.path.exists(path):
+        return {"after": None, "pictures": 0, "tags": 0, "missing": 0, "errors": 0}
+    with open(path, "r") as f:
+        checkpoint = json.load(f)
+    # El id de la ultima imagen procesada se pasa a la BBDD como BINARY(16): debe ser un uuid
+    after = checkpoint.get("after") if isinstance(checkpoint, dict) else None
+    if not isinstance(checkpoint, dict) or (after is not None and not isinstance(after, str)):
+        raise ValueError(f"checkpoint no valido: {path}")
+    if after is not None:
+        try:
+            uuid.UUID(after)
+        except ValueError as error:
+            raise ValueError(f"checkpoint no valido: {path}: {error}")
+    return checkpoint
+
+def save_checkpoint(path: str, checkpoint: dict):
+    """
+        Guarda el checkpoint del backfill de forma atomica: se escribe en un fichero temporal que sustituye al anterior.
+    Args:
+        path (str): fichero del checkpoint
+        checkpoint (dict): checkpoint (ver load_checkpoint)
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def backfill_picture(picture: dict):
+    """
+        Vuelve a etiquetar una imagen y le añade los tags que le faltan.
+    Args:
+        picture (dict): imagen (ver models.get_pictures_to_backfill)
+
+    Returns:
+        tuple: resultado (`ok`, `missing` si no se ha podido leer el fichero de la imagen o `error`) y numero de tags añadidos
+    """
+    try:
+        image_bin = storage.read(storage.pop_location(dict(picture)))
+    except OSError as error:
+        logging.warning(f"No se ha podido leer la imagen {picture['id']}: {error}")
+        return "missing", 0
+    try:
+        tags = controller.get_tags_image(image_bin, f"img_{picture['id']}")
+        n_tags = models.add_picture_tags(picture["id"], picture["date"], tags)
+    except Exception as error:
+        logging.error(f"Error al completar los tags de la imagen {picture['id']}: {error}")
+        return "error", 0
+    # Eliminamos la imagen de la cache compartida (PICTURE_CACHE_REDIS_URL) y actualizamos sus tags en el indice de
+    # similitud; la cache local de la API caduca con su TTL
+    try:
+        controller.refresh_picture(picture["id"])
+    except Exception as error:
+        logging.warning(f"No se ha podido refrescar la imagen {picture['id']}: {error}")
+    return "ok", n_tags
+
+def refresh_api(api_url: str, ids: list):
+    """
+        Pide a la API que refresque las imagenes ids (POST /images/refresh). Si falla, se registra en el log.
+    Args:
+        api_url (str): url base de la API, por ejemplo http://localhost:80
+        ids (list): ids de las imagenes
+
+    Returns:
+        bool: True si la API ha refrescado las imagenes
+    """
+    try:
+        response = requests.post(f"{api_url.rstrip('/')}/images/refresh", json={"ids": ids}, timeout=30)
+        response.raise_for_status()
+        return True
+    except requests.RequestException as error:
+        logging.warning(f"No se han podido refrescar {len(ids)} imagenes en la API: {error}")
+        return False
+
+def backfill(checkpoint_path: str, workers: int = 4, batch: int = 100, limit: int = None, api_url: str = None):
+    """
+        Completa los tags de las imagenes pendientes en bloques de batch imagenes, ordenadas por id, que se etiquetan
+        concurrentemente en un pool de workers threads. Tras cada bloque se guarda el checkpoint con el id de su ultima
+        imagen, por lo que una ejecucion interrumpida continua en el bloque siguiente.
+        Las imagenes que fallan o cuyo fichero no se puede leer se registran en el log y se saltan; como siguen
+        pendientes, se reintentan al ejecutar de nuevo sin checkpoint. Si falla el etiquetado de todas las imagenes
+        legibles de un bloque (por ejemplo, porque Imagga no responde o se ha agotado su cuota) el backfill se detiene
+        sin avanzar el checkpoint.
+    Args:
+        checkpoint_path (str): fichero del checkpoint
+        workers (int): numero de imagenes etiquetadas concurrentemente
+        batch (int): numero de imagenes de cada bloque
+        limit (int): numero maximo de imagenes a procesar en esta ejecucion. Por defecto todas
+        api_url (str): url base de la API a la que se pide que refresque las imagenes completadas (ver refresh_api)
+
+    Returns:
+        dict: checkpoint final (ver load_checkpoint)
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    processed = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as executor:
+        while limit is None or processed < limit:
+            pictures = models.get_pictures_to_backfill(checkpoint["after"],
+                                                       batch if limit is None else min(batch, limit - processed))
+            if len(pictures)==0:
+                break
+            start = time.perf_counter()
+            results = list(executor.map(backfill_picture, pictures))
+            counts = {status: sum(1 for result, _ in results if result == status) for status in ("ok", "missing", "error")}
+            if counts["error"] > 0 and counts["ok"] == 0:
+                logging.error(f"Ha fallado el etiquetado de las {counts['error']} imagenes del bloque: el backfill se detiene")
+                break
+            checkpoint["after"] = pictures[-1]["id"]
+            checkpoint["pictures"] += counts["ok"]
+            checkpoint["tags"] += sum(n_tags for _, n_tags in results)
+            checkpoint["missing"] += counts["missing"]
+            checkpoint["errors"] += counts["error"]
+            save_checkpoint(checkpoint_path, checkpoint)
+            if api_url and counts["ok"] > 0:
+                refresh_api(api_url, [picture["id"] for picture, (result, _) in zip(pictures, results) if result == "ok"])
+            processed += len(pictures)
+            logging.info(f"Bloque de {len(pictures)} imagenes completado en {time.perf_counter() - start:.1f}s: {checkpoint}")
+    return checkpoint
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Completa los tags de las imagenes guardadas con un filtro de confianza")
+    parser.add_argument("--workers", type=int, default=4, help="imagenes etiquetadas concurrentemente (4)")
+    parser.add_argument("--batch", type=int, default=100, help="imagenes de cada bloque entre checkpoints (100)")
+    parser.add_argument("--limit", type=int, default=None, help="imagenes maximas a procesar en esta ejecucion (todas)")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json", help="fichero del checkpoint (backfill_checkpoint.json)")
+    parser.add_argument("--reset", action="store_true", help="ignora el checkpoint y empieza desde la primera imagen pendiente")
+    parser.add_argument("--api-url", default=os.environ.get("BACKFILL_API_URL"),
+                        help="url de la API a la que se pide que refresque las imagenes completadas (BACKFILL_API_URL)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.reset and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    try:
+        print(f"Backfill: {backfill(args.checkpoint, args.workers, args.batch, args.limit, args.api_url)}")
+    except ValueError as error:
+        parser.error(f"{error} (usa --reset para empezar de nuevo)")
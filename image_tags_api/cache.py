@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from . import metrics
+
+# Caches de lectura de imagenes por id (ver get_picture y get_picture_data) y de respuestas (ver get_response)
+_picture_cache = None
+_data_cache = None
+_response_cache = None
+_shared = None
+_cache_lock = threading.Lock()
+# Generacion de escritura: se incrementa con cada insercion de imagenes confirmada en la BBDD. Con el nivel compartido
+# (PICTURE_CACHE_REDIS_URL) tambien se guarda en el servidor, en la clave GENERATION_KEY, que comparten todos los procesos
+_generation = 0
+_generation_lock = threading.Lock()
+GENERATION_KEY = "image_tags:generation"
+
+
+class LRUCache:
+    """
+        Cache en memoria del proceso con politica LRU y caducidad (TTL). Se acota por numero de entradas y,
+        opcionalmente, por el tamaño total de sus valores. Cuenta aciertos, fallos, caducadas y expulsiones
+        en las metricas <name>_hits, <name>_misses, <name>_expired y <name>_evictions.
+    """
+    def __init__(self, name: str, max_entries: int, ttl: float, max_bytes: int = None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """
+            Devuelve el valor de key, None si no esta o ha caducado.
+        Args:
+            key (str): clave
+
+        Returns:
+            obj: valor cacheado
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] <= time.monotonic():
+                self._remove(key)
+                metrics.incr(f"{self.name}_expired")
+                item = None
+            if item is None:
+                metrics.incr(f"{self.name}_misses")
+                return None
+            self._data.move_to_end(key)
+            metrics.incr(f"{self.name}_hits")
+            return item[2]
+
+    def set(self, key: str, value, size: int = 0):
+        """
+            Guarda value en key, expulsando las entradas menos usadas recientemente si se supera algun limite.
+        Args:
+            key (str): clave
+            value (obj): valor
+            size (int): tamaño del valor en bytes, para el limite max_bytes
+        """
+        if self.max_entries <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+                metrics.incr(f"{self.name}_evictions")
+
+    def delete(self, key: str):
+        """
+            Elimina key de la cache.
+        Args:
+            key (str): clave
+        """
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        """
+            Vacia la cache.
+        """
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remove(self, key: str):
+        self._bytes -= self._data.pop(key)[1]
+
+    def stats(self):
+        """
+            Devuelve el numero de entradas y los bytes ocupados.
+
+        Returns:
+            dict: con las claves entries y bytes
+        """
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._bytes}
+
+class FakeRedis:
+    """
+        Cliente en memoria con el subconjunto de la API de redis que usa SharedCache (get, set con ex, delete e incr).
+        Sustituye al servidor Redis en tests y benchmarks (PICTURE_CACHE_REDIS_URL=fake://).
+    """
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str):
+        with self._lock:
+            item = self._data.get(name)
+            if item is None or (item[0] is not None and item[0] <= time.monotonic()):
+                self._data.pop(name, None)
+                return None
+            return item[1]
+
+    def set(self, name: str, value, ex: float = None):
+        with self._lock:
+            self._data[name] = (time.monotonic() + ex if ex else None, value.encode() if isinstance(value, str) else value)
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+    def incr(self, name: str):
+        with self._lock:
+            item = self._data.get(name)
+            value = int(item[1]) + 1 if item is not None else 1
+            self._data[name] = (item[0] if item is not None else None, str(value).encode())
+            return value
+
+class SharedCache:
+    """
+        Nivel compartido entre procesos de la cache sobre un servidor compatible con Redis. Los valores se guardan en json
+        con caducidad ttl. Un fallo del servidor no falla la peticion: se registra y se trata como un fallo de cache.
+    """
+    def __init__(self, client, prefix: str, ttl: float):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key: str):
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception as error:
+            logging.warning(f"Error al leer de la cache compartida: {error}")
+            return None
+        metrics.incr("picture_cache_shared_hits" if value is not None else "picture_cache_shared_misses")
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value):
+        try:
+            self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(self.ttl)))
+        except Exception as error:
+            logging.warning(f"Error al escribir en la cache compartida: {error}")
+
+    def delete(self, key: str):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception as error:
+            logging.warning(f"Error al borrar de la cache compartida: {error}")
+
+    def incr(self, key: str):
+        # Los contadores no llevan prefijo ni caducan
+        try:
+            self.client.incr(key)
+        except Exception as error:
+            logging.warning(f"Error al incrementar un contador de la cache compartida: {error}")
+
+    def get_counter(self, key: str):
+        try:
+            value = self.client.get(key)
+        except Exception as error:
+            logging.warning(f"Error al leer de la cache compartida: {error}")
+            return None
+        return int(value) if value is not None else 0
+
+def create_shared_client(url: str):
+    """
+        Crea el cliente del nivel compartido de la cache: `fake://` para un FakeRedis en memoria o una url de redis
+        (requiere el paquete redis, que no es una dependencia de la API).
+    Args:
+        url (str): url del servidor
+
+    Returns:
+        obj: cliente compatible con redis
+    """
+    if url.startswith("fake://"):
+        return FakeRedis()
+    try:
+        import redis
+    except ImportError:
+        raise ImportError("PICTURE_CACHE_REDIS_URL requiere el paquete redis (pip install redis)")
+    return redis.Redis.from_url(url)
+
+def _init_caches():
+    global _picture_cache, _data_cache, _response_cache, _shared
+    ttl = float(os.environ.get("PICTURE_CACHE_TTL", 60))
+    _picture_cache = LRUCache("picture_cache", int(os.environ.get("PICTURE_CACHE_SIZE", 10000)), ttl)
+    _data_cache = LRUCache("picture_data_cache", int(os.environ.get("PICTURE_CACHE_SIZE", 10000)), ttl,
+                           max_bytes=int(os.environ.get("PICTURE_CACHE_MAX_BYTES", 64*1024*1024)))
+    _response_cache = LRUCache("response_cache", int(os.environ.get("RESPONSE_CACHE_SIZE", 256)),
+                               float(os.environ.get("RESPONSE_CACHE_TTL", 300)),
+                               max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 32*1024*1024)))
+    url = os.environ.get("PICTURE_CACHE_REDIS_URL")
+    _shared = SharedCache(create_shared_client(url), "picture:", ttl) if url else None
+
+def _get_caches():
+    if _picture_cache is None:
+        with _cache_lock:
+            if _picture_cache is None:
+                _init_caches()
+    return _picture_cache, _data_cache, _response_cache, _shared
+
+def reset():
+    """
+        Vuelve a crear las caches con la configuracion de las variables de entorno, por ejemplo en tests y benchmarks.
+    """
+    with _cache_lock:
+        _init_caches()
+
+def get_picture(picture_id: str, loader):
+    """
+        Devuelve los datos y tags de una imagen, leyendolos de la cache local, de la compartida (si se configura
+        PICTURE_CACHE_REDIS_URL) o, si no estan, con loader (normalmente models.get_image_by_id), que se cachea.
+        Las imagenes que no existen no se cachean.
+    Args:
+        picture_id (str): id de la imagen
+        loader (function): funcion que recibe picture_id y devuelve la imagen, o un dict vacio si no existe
+
+    Returns:
+        dict: copia de la imagen, que el llamante puede modificar
+    """
+    local, _, _, shared = _get_caches()
+    picture = local.get(picture_id)
+    if picture is None and shared is not None:
+        picture = shared.get(picture_id)
+        if picture is not None:
+            local.set(picture_id, picture)
+    if picture is None:
+        picture = loader(picture_id)
+        if picture:
+            local.set(picture_id, picture)
+            if shared is not None:
+                shared.set(picture_id, picture)
+    return dict(picture)
+
+def get_picture_data(picture_id: str, loader):
+    """
+        Devuelve la imagen codificada en base64 de la cache local, acotada a PICTURE_CACHE_MAX_BYTES, o con loader.
+    Args:
+        picture_id (str): id de la imagen
+        loader (function): funcion sin argumentos que devuelve la imagen en base64
+
+    Returns:
+        str: imagen en base64
+    """
+    _, data_cache, _, _ = _get_caches()
+    data = data_cache.get(picture_id)
+    if data is None:
+        data = loader()
+        data_cache.set(picture_id, data, size=len(data))
+    return data
+
+def invalidate_picture(picture_id: str):
+    """
+        Elimina una imagen de todos los niveles de la cache. Se invoca al insertar, modificar o borrar una imagen.
+    Args:
+        picture_id (str): id de la imagen
+    """
+    local, data_cache, _, shared = _get_caches()
+    local.delete(picture_id)
+    data_cache.delete(picture_id)
+    if shared is not None:
+        shared.delete(picture_id)
+
+def bump_generation():
+    """
+        Incrementa la generacion de escritura. Se invoca tras confirmar una insercion de imagenes en la BBDD,
+        de forma que las respuestas cacheadas con la generacion anterior dejan de usarse. Con el nivel compartido
+        se incrementa tambien la del servidor, de forma que la escritura invalida las respuestas de todos los procesos
+        (incluida la API cuando escriben el backfill o `tag_stats rebuild`).
+    """
+    global _generation
+    with _generation_lock:
+        _generation += 1
+    shared = _get_caches()[3]
+    if shared is not None:
+        shared.incr(GENERATION_KEY)
+
+def get_generation():
+    """
+        Devuelve la generacion de escritura actual: la del proceso y, con el nivel compartido, la del servidor (None si
+        no responde; las escrituras de otros procesos se ven entonces al caducar las respuestas, RESPONSE_CACHE_TTL).
+
+    Returns:
+        tuple: generacion de escritura del proceso y compartida
+    """
+    with _generation_lock:
+        generation = _generation
+    shared = _get_caches()[3]
+    return generation, shared.get_counter(GENERATION_KEY) if shared is not None else None
+
+def estimate_size(value, sample: int = 16):
+    """
+        Estima el tamaño en bytes de value serializado en json. En las listas de mas de sample elementos solo se
+        serializan sample elementos repartidos por la lista y se extrapola al resto, de forma que el coste no crece con
+        el tamaño de la respuesta.
+    Args:
+        value (obj): valor serializable en json
+        sample (int): numero maximo de elementos de una lista que se serializan
+
+    Returns:
+        int: tamaño estimado en bytes
+    """
+    if isinstance(value, list) and len(value) > sample:
+        step = len(value) / sample
+        sampled = len(json.dumps([value[int(i*step)] for i in range(sample)], default=str))
+        return int(sampled * len(value) / sample)
+    return len(json.dumps(value, default=str))
+
+def get_response(endpoint: str, params: dict, loader):
+    """
+        Devuelve la respuesta de endpoint para los parametros params de la cache de respuestas o, si no esta, con loader.
+        La clave incluye la generacion de escritura leida antes de ejecutar loader: tras una insercion, las respuestas
+        anteriores no se vuelven a servir (y una respuesta calculada durante una insercion no se sirve despues de ella).
+        Las entradas antiguas se expulsan por LRU, acotadas por RESPONSE_CACHE_SIZE y RESPONSE_CACHE_MAX_BYTES.
+    Args:
+        endpoint (str): nombre del endpoint
+        params (dict): parametros normalizados de la consulta
+        loader (function): funcion sin argumentos que calcula la respuesta
+
+    Returns:
+        obj: respuesta, compartida entre peticiones: el llamante no debe modificarla
+    """
+    responses = _get_caches()[2]
+    key = json.dumps([get_generation(), endpoint, params], sort_keys=True, default=str)
+    response = responses.get(key)
+    if response is None:
+        response = loader()
+        responses.set(key, response, size=estimate_size(response))
+    return response
+
+def get_cache_stats():
+    """
+        Devuelve el tamaño de las caches locales, sus aciertos, fallos, expulsiones y tasa de aciertos.
+
+    Returns:
+        dict: estadisticas de las caches picture_cache, picture_data_cache y response_cache
+    """
+    stats = {}
+    for cache in _get_caches()[:3]:
+        counters = {counter: metrics.get_counter(f"{cache.name}_{counter}") for counter in ("hits", "misses", "expired", "evictions")}
+        lookups = counters["hits"] + counters["misses"]
+        stats[cache.name] = dict(cache.stats(), **counters, hit_ratio=counters["hits"] / lookups if lookups else 0.0)
+    return stats
@@ -0,0 +1,106 @@
+import os
+import time
+import queue
+import random
+import logging
+import threading
+
+from . import models, metrics
+
+# Cola de borrados diferidos de imagenes subidas temporalmente a Imagekitio y thread que los procesa (ver schedule_delete)
+_queue = None
+_worker = None
+_lock = threading.Lock()
+
+
+def _get_queue():
+    global _queue, _worker
+    if _worker is None:
+        with _lock:
+            if _worker is None:
+                _queue = queue.Queue(maxsize=int(os.environ.get("CLEANUP_QUEUE_SIZE", 1000)))
+                _worker = threading.Thread(target=_run, name="imagekit-cleanup", daemon=True)
+                _worker.start()
+    return _queue
+
+def schedule_delete(file_id: str):
+    """
+        Encola el borrado en Imagekitio del fichero file_id, que se realiza en segundo plano sin esperar a que termine.
+        Si la cola (CLEANUP_QUEUE_SIZE, 1000 por defecto) esta llena, el fichero se borra en el thread que llama.
+    Args:
+        file_id (str): id del fichero en Imagekitio
+    """
+    try:
+        _get_queue().put_nowait((file_id, 0))
+        metrics.incr("cleanup_scheduled")
+    except queue.Full:
+        metrics.incr("cleanup_queue_full")
+        _delete(file_id, 0)
+
+def _delete(file_id: str, attempt: int):
+    """
+        Borra el fichero file_id de Imagekitio. Si falla, lo vuelve a encolar hasta CLEANUP_RETRIES reintentos (5 por
+        defecto), tras esperar con backoff exponencial y jitter desde CLEANUP_BACKOFF segundos (1 por defecto).
+    Returns:
+        bool: True si se ha borrado
+    """
+    try:
+        models.delete_image_url(file_id)
+        metrics.incr("cleanup_deleted")
+        return True
+    except Exception as error:
+        if attempt >= int(os.environ.get("CLEANUP_RETRIES", 5)):
+            metrics.incr("cleanup_failed")
+            logging.error(f"No se ha podido borrar la imagen {file_id} de Imagekitio: {error}")
+            return False
+        metrics.incr("cleanup_retries")
+        logging.warning(f"Error al borrar la imagen {file_id} de Imagekitio, se reintentara: {error}")
+        delay = random.uniform(0, float(os.environ.get("CLEANUP_BACKOFF", 1)) * 2 ** attempt)
+        # El reintento se encola tras la espera, en un timer, para no bloquear el resto de borrados
+        timer = threading.Timer(delay, _requeue, args=(file_id, attempt + 1))
+        timer.daemon = True
+        timer.start()
+        return False
+
+def _requeue(file_id: str, attempt: int):
+    try:
+        _queue.put_nowait((file_id, attempt))
+    except queue.Full:
+        _delete(file_id, attempt)
+
+def _run():
+    while True:
+        file_id, attempt = _queue.get()
+        try:
+            _delete(file_id, attempt)
+        finally:
+            _queue.task_done()
+
+def get_pending():
+    """
+        Devuelve el numero de borrados en la cola.
+
+    Returns:
+        int: borrados pendientes
+    """
+    return _queue.qsize() if _queue is not None else 0
+
+# Borrados pendientes, exportados en /metrics
+metrics.register_gauge("cleanup_pending", get_pending)
+
+def wait(timeout: float = 10):
+    """
+        Espera a que la cola de borrados se vacie, por ejemplo en tests y benchmarks. No espera a los reintentos
+        programados que aun no se han vuelto a encolar.
+    Args:
+        timeout (float): segundos maximos de espera
+
+    Returns:
+        bool: True si la cola esta vacia
+    """
+    deadline = time.monotonic() + timeout
+    while get_pending() > 0 or (_queue is not None and _queue.unfinished_tasks > 0):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
@@ -0,0 +1,93 @@
+import os
+import json
+import threading
+from dataclasses import dataclass
+
+# Configuracion del proceso (ver load_settings y get_settings)
+_settings = None
+_settings_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+        Configuracion de la API: credenciales y urls de Imagga e Imagekitio, parametros de las llamadas HTTP, backend de
+        etiquetado y parametros de arranque.
+        Se carga una vez al crear la aplicacion (ver load_settings); las credenciales no se copian a variables de entorno.
+    """
+    imagga_api_key: str
+    imagga_api_secret: str
+    imagekit_url_endpoint: str
+    imagekit_public_key: str
+    imagekit_private_key: str
+    imagga_api_url: str = "https://api.imagga.com"
+    imagekit_api_url: str = None
+    http_connect_timeout: float = 3.05
+    http_read_timeout: float = 30.0
+    http_pool_size: int = 10
+    tagger_backend: str = "url"
+    fake_tagger_latency: float = 0.0
+    fake_tagger_bandwidth: float = 0.0
+    jobs_workers: int = 2
+    warmup: bool = True
+    warmup_db_connections: int = 0
+    warmup_timeout: float = 30.0
+
+def load_settings(credentials: str = None):
+    """
+        Carga la configuracion del fichero de credenciales y de las variables de entorno y la guarda como la
+        configuracion del proceso.
+        El fichero de credenciales es CREDENTIALS_FILE (por defecto credentials.json). Si no existe, las credenciales se
+        leen de las variables de entorno IMAGGAN_API_KEY, IMAGGAN_API_SECRET, IMAGEKIT_URL_ENDPOINT, IMAGEKIT_PUBLIC_KEY
+        e IMAGEKIT_PRIVATE_KEY.
+        El resto de parametros se leen de IMAGGA_API_URL (https://api.imagga.com), IMAGEKIT_API_URL (sin definir: la
+        API de Imagekitio), HTTP_CONNECT_TIMEOUT (3.05 segundos), HTTP_READ_TIMEOUT (30 segundos), HTTP_POOL_SIZE (10),
+        TAGGER_BACKEND (url), FAKE_TAGGER_LATENCY (0 segundos), FAKE_TAGGER_BANDWIDTH (0 bytes por segundo),
+        JOBS_WORKERS (2), WARMUP (true), WARMUP_DB_CONNECTIONS (0: DB_POOL_SIZE) y WARMUP_TIMEOUT (30 segundos).
+    Args:
+        credentials (str): fichero de credenciales. Por defecto CREDENTIALS_FILE
+
+    Returns:
+        Settings: configuracion del proceso
+    """
+    global _settings
+    credentials = credentials or os.environ.get("CREDENTIALS_FILE", "credentials.json")
+    if os.path.exists(credentials):
+        with open(credentials, 'r') as f:
+            data = json.load(f)
+    else:
+        data = {"imaggan": {"api_key": os.environ.get("IMAGGAN_API_KEY"), "api_secret": os.environ.get("IMAGGAN_API_SECRET")},
+                "imagekitio": {"url_endpoint": os.environ.get("IMAGEKIT_URL_ENDPOINT"),
+                               "public_key": os.environ.get("IMAGEKIT_PUBLIC_KEY"),
+                               "private_key": os.environ.get("IMAGEKIT_PRIVATE_KEY")}}
+    settings = Settings(imagga_api_key=data['imaggan']['api_key'],
+                        imagga_api_secret=data['imaggan']['api_secret'],
+                        imagekit_url_endpoint=data['imagekitio']['url_endpoint'],
+                        imagekit_public_key=data['imagekitio']['public_key'],
+                        imagekit_private_key=data['imagekitio']['private_key'],
+                        imagga_api_url=os.environ.get("IMAGGA_API_URL", "https://api.imagga.com"),
+                        imagekit_api_url=os.environ.get("IMAGEKIT_API_URL"),
+                        http_connect_timeout=float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3.05)),
+                        http_read_timeout=float(os.environ.get("HTTP_READ_TIMEOUT", 30)),
+                        http_pool_size=int(os.environ.get("HTTP_POOL_SIZE", 10)),
+                        tagger_backend=os.environ.get("TAGGER_BACKEND", "url"),
+                        fake_tagger_latency=float(os.environ.get("FAKE_TAGGER_LATENCY", 0)),
+                        fake_tagger_bandwidth=float(os.environ.get("FAKE_TAGGER_BANDWIDTH", 0)),
+                        jobs_workers=int(os.environ.get("JOBS_WORKERS", 2)),
+                        warmup=os.environ.get("WARMUP", "true").lower() in ("1", "true", "yes"),
+                        warmup_db_connections=int(os.environ.get("WARMUP_DB_CONNECTIONS", 0)),
+                        warmup_timeout=float(os.environ.get("WARMUP_TIMEOUT", 30)))
+    with _settings_lock:
+        _settings = settings
+    return settings
+
+def get_settings():
+    """
+        Devuelve la configuracion del proceso, cargandola si todavia no se ha cargado (por ejemplo, fuera de la API).
+
+    Returns:
+        Settings: configuracion del proceso
+    """
+    if _settings is None:
+        return load_settings()
+    return _settings
@@ -1,49 +1,72 @@
 from typing import List
 
+import io
 import os
+import csv
+import json
+import time
 import uuid
 import base64
+import hashlib
+import logging
 import datetime
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
-from . import models
-from .appexceptions import ImageKitError, ImaggaError
+from . import models, metrics, taggers, storage, preprocess, cache, similarity
 
+# Pool de threads para etiquetar los lotes de imagenes (ver get_batch_executor)
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+# Pool de threads para guardar las imagenes en el almacen mientras se etiquetan (ver get_store_executor)
+_store_executor = None
+_store_executor_lock = threading.Lock()
 
-def get_tags_image_minconfidence(imagenb64: str, filename: str, min_confidence: int):
+
+def get_tags_image(image_bin, filename: str):
     """
-        Obtiene los tags de una imagen (imagenb64) invocando la API de Imagga y devolviendo los tags con confidence > min_confidence.
-        Emplea imagekitio como repositorio temporal de la imagen.
+        Obtiene todos los tags de una imagen (image_bin) con el backend de etiquetado configurado en TAGGER_BACKEND.
+        Al backend se envia la imagen reducida (ver preprocess). Los tags se guardan todos, con su confianza, y el
+        filtro min_confidence se aplica al consultarlos (ver filter_tags), de forma que cambiar el umbral no obliga a
+        volver a etiquetar la imagen.
     Args:
-        imagenb64 (str): imagen en base 64 en formato str.
+        image_bin (bytes): imagen en binario, o fichero de la imagen abierto en modo binario (ver register_image_file)
         filename (str): nombre de la imagen
-        min_confidence (int): confianza minima de los tags a aceptar.
 
     Returns:
-        list: lsta de tags asociados a la imagen con confianza mayor que min_confidence
+        list: lista de tags asociados a la imagen
     """
-    try:
-        # Upload the image to imagekitio
-        upload_info = models.get_image_url(imagenb64,filename)    
-    except Exception as error:
-        raise ImageKitError(f"Error al subir la imagen a Imagekitio: {error}")
-    try:
-        # Requests the tags of the image to imagga
-        all_tags= models.get_tags_url(upload_info.response_metadata.raw['url'])
-        # Define the list of tags with confidence > min_confidence
-        tags = [t for t in all_tags if t["confidence"] > min_confidence]
-    except Exception as error:
-        raise ImaggaError(f"Error al obtener los tags de la imagen de Imagga: {error}")
-    
-    try:
-        # Delete the image from  imagekitio
-        models.delete_image_url(upload_info.file_id)
-    except Exception as error:
-        raise ImageKitError(f"Error al borrar la imagen de Imagekitio: {error}")
-    
-    # Devuelve los tags de la imagen con confidence > min_confidence
-    return tags
+    # Reducimos la imagen que se envia al backend de etiquetado
+    start = time.perf_counter()
+    if isinstance(image_bin, bytes):
+        size = len(image_bin)
+        tagging_bin = preprocess.resize_for_tagging(image_bin)
+    else:
+        size = os.fstat(image_bin.fileno()).st_size
+        tagging_bin = preprocess.resize_file_for_tagging(image_bin)
+    metrics.observe("tagging_preprocess_seconds", time.perf_counter() - start)
+    metrics.incr("tagging_bytes_original", size)
+    metrics.incr("tagging_bytes_sent", len(tagging_bin))
+    # Obtenemos todos los tags de la imagen
+    return taggers.get_tagger().get_tags(tagging_bin, filename)
+
+def filter_tags(tags: List, min_confidence: int = None):
+    """
+        Devuelve los tags con confidence > min_confidence.
+    Args:
+        tags (List): lista de tags y su confidence
+        min_confidence (int): confianza minima (excluida). Si es None se devuelven todos los tags
 
-def register_image_tags_bd(myuuid: str, path: str,  tags:str, date: str, size: int):
+    Returns:
+        list: lista de tags con confianza mayor que min_confidence
+    """
+    if min_confidence is None:
+        return tags
+    return [t for t in tags if t["confidence"] > min_confidence]
+
+def register_image_tags_bd(myuuid: str, path: str,  tags:str, date: str, size: int, hash: str = None, min_confidence: int = None,
+                           location: dict = None):
     """
         Registra una imagen y sus tags en la base de datos.
         Devuelve un dict con los datos de la imagen y sus tags.
@@ -54,6 +77,9 @@ def register_image_tags_bd(myuuid: str, path: str,  tags:str, date: str, size: i
         tags (str): lista de tag-confidence asociados a la imagen
         date (str): fecha de registro de la imagen
         size (int): tamaño de la imagen en bytes
+        hash (str): hash SHA-256 del contenido de la imagen
+        min_confidence (int): confianza minima con la que se filtraron los tags guardados (0 si se guardan todos)
+        location (dict): ubicacion de la imagen en el almacen de segmentos (ver storage)
 
     Returns:
         json: con los campos:
@@ -66,22 +92,161 @@ def register_image_tags_bd(myuuid: str, path: str,  tags:str, date: str, size: i
         - `data`: imagen como string codificado en base64
     """
     # Insertamos la imagen y sus tags en la base de datos
-    models.insert_picture_tags(myuuid, date, path, size, tags)
+    models.insert_picture_tags(myuuid, date, path, size, tags, hash, min_confidence, location)
+    cache.invalidate_picture(myuuid)
+    similarity.add_picture(myuuid, tags)
     # Creamos la respuesta
     response={"id": myuuid, "date": date, "size":size,
             "tags": tags}
     # Devolvemos un dict con los datos de la imagen y sus tags
     return response
 
-def register_image_tags(imagenb64: str, min_confidence: str):
+def get_tags_image_dedup(image_bin: bytes, image_hash: str, filename: str, min_confidence: int):
     """
-        Registra una imagen y sus tags con confianza superior a min confidence en la base de datos.
-        Devuelve un dict con los datos de la imagen y sus tags.
-        Emplea los servicios Imagga e Imagekitio como repositorio temporal de la imagen y para obtener todos sus tags.
+        Obtiene los tags de una imagen a guardar. Si ya se registro una imagen con el mismo contenido (hash SHA-256),
+        con todos sus tags de confianza superior a min_confidence, se reutilizan sus tags sin invocar al backend de
+        etiquetado y, si DEDUP_REUSE_FILE no es false y su fichero sigue en disco, se devuelve su ubicacion para reutilizarlo.
+    Args:
+        image_bin (bytes): imagen en binario.
+        image_hash (str): hash SHA-256 de la imagen
+        filename (str): nombre de la imagen
+        min_confidence (int): confianza minima de los tags solicitados.
+
+    Returns:
+        list: lista de tags a guardar
+        dict: ubicacion de la imagen duplicada a reutilizar (ver storage), None si hay que guardar la imagen
+        int: confianza minima con la que se filtraron los tags a guardar (0 si son todos)
+    """
+    duplicate = find_duplicate(image_hash, min_confidence)
+    if duplicate is None:
+        # Obtiene todos los tags de la imagen
+        return get_tags_image(image_bin,filename), None, 0
+    return duplicate
+
+def find_duplicate(image_hash: str, min_confidence: int):
+    """
+        Busca una imagen ya registrada con el mismo contenido (hash SHA-256) y etiquetada con una confianza minima que
+        permita reutilizar sus tags (ver get_tags_image_dedup).
+    Args:
+        image_hash (str): hash SHA-256 de la imagen
+        min_confidence (int): confianza minima de los tags a aceptar.
+
+    Returns:
+        tuple: tags guardados de la imagen duplicada, ubicacion del fichero a reutilizar (None si hay que guardar la
+            imagen) y confianza minima con la que se filtraron sus tags, o None si no hay una imagen duplicada
+    """
+    # Buscamos una imagen con el mismo contenido ya etiquetada
+    duplicate = models.get_image_by_hash(image_hash, min_confidence)
+    if not duplicate:
+        metrics.incr("dedup_misses")
+        return None
+
+    metrics.incr("dedup_hits")
+    # Reutilizamos los tags de la imagen duplicada
+    tags = duplicate["tags"]
+    # Reutilizamos el fichero de la imagen duplicada si sigue en disco
+    location = storage.pop_location(duplicate)
+    if os.environ.get("DEDUP_REUSE_FILE", "true").lower() != "false" and storage.exists(location):
+        return tags, location, duplicate["min_confidence"]
+    return tags, None, duplicate["min_confidence"]
+
+def register_image_tags(imagenb64: str, min_confidence: int, timings: dict = None):
+    """
+        Registra una imagen en base 64 y sus tags en la base de datos y devuelve los tags con confianza superior a
+        min_confidence. Ver register_image_bytes.
     
     Args:
         imagenb64 (str): imagen en base 64 en formato str.
-        min_confidence (int): confianza minima de los tags a aceptar.
+        min_confidence (int): confianza minima de los tags de la respuesta.
+        timings (dict): si se indica, se completa con la duracion de cada etapa del registro (ver register_image_bytes)
+
+    Returns:
+        json: con los campos id, size, date y tags (ver register_image_bytes)
+    """
+    # Convertimos la imagen a binario y la registramos
+    return register_image_bytes(base64.b64decode(imagenb64.encode()), min_confidence, timings=timings)
+
+def get_store_executor():
+    """
+        Devuelve el pool de threads, acotado a STORE_WORKERS threads (4 por defecto), con el que se guardan las imagenes
+        en el almacen mientras se etiquetan. Lo comparten todas las peticiones del proceso.
+
+    Returns:
+        ThreadPoolExecutor: pool de threads
+    """
+    global _store_executor
+    if _store_executor is None:
+        with _store_executor_lock:
+            if _store_executor is None:
+                _store_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("STORE_WORKERS", 4)),
+                                                     thread_name_prefix="image-store")
+    return _store_executor
+
+def run_stage(timings: dict, stage: str, func, *args, **kwargs):
+    """
+        Ejecuta func(*args, **kwargs) como la etapa stage del registro de una imagen: su duracion se registra en la
+        metrica ingest_<stage>_seconds y, si timings no es None, en timings[stage] (en milisegundos).
+    Args:
+        timings (dict): duracion de las etapas, o None
+        stage (str): nombre de la etapa
+        func (callable): funcion a ejecutar
+
+    Returns:
+        obj: resultado de func
+    """
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe(f"ingest_{stage}_seconds", seconds)
+        if timings is not None:
+            timings[stage] = seconds * 1000
+
+def save_image(image_bin: bytes, filename: str, source_path: str = None):
+    """
+        Guarda la imagen en el almacen de imagenes. Si se indica source_path, mueve ese fichero al almacen.
+    Args:
+        image_bin (bytes): imagen en binario. Puede ser None si se indica source_path
+        filename (str): nombre de la imagen
+        source_path (str): fichero de la carpeta de imagenes que ya contiene la imagen
+
+    Returns:
+        dict: ubicacion de la imagen en el almacen (ver storage)
+    """
+    if source_path is not None:
+        return storage.get_store().put_file(source_path, filename, image_bin)
+    return storage.get_store().put(image_bin, filename)
+
+def discard_image(location: dict):
+    """
+        Borra el fichero de una imagen guardada que no se ha llegado a registrar. En un segmento, su espacio se
+        recupera al compactarlo.
+    Args:
+        location (dict): ubicacion de la imagen en el almacen (ver storage)
+    """
+    if location["segment"] is None and os.path.exists(location["path"]):
+        os.remove(location["path"])
+
+def register_image_bytes(image_bin: bytes, min_confidence: int, source_path: str = None, timings: dict = None,
+                         picture_id: str = None):
+    """
+        Registra una imagen y todos sus tags en la base de datos.
+        Devuelve un dict con los datos de la imagen y sus tags con confianza superior a min_confidence.
+        Obtiene los tags con el backend de etiquetado configurado (por defecto Imagga, con Imagekitio como repositorio temporal de la imagen).
+        La imagen se guarda en el almacen de imagenes concurrentemente con el etiquetado y se registra en la BBDD cuando
+        terminan ambos, de forma que la BBDD nunca apunta a un fichero que no existe.
+        Si ya se registro una imagen con el mismo contenido (hash SHA-256) se reutilizan sus tags sin invocar a Imagga ni a
+        Imagekitio y, si DEDUP_REUSE_FILE no es false, tambien su fichero en disco.
+    
+    Args:
+        image_bin (bytes): imagen en binario.
+        min_confidence (int): confianza minima de los tags de la respuesta.
+        source_path (str): fichero de la carpeta de imagenes que ya contiene la imagen. Se mueve al almacen de imagenes
+            (en el almacen flat sin volver a escribir la imagen) y se borra.
+        timings (dict): si se indica, se completa con la duracion en milisegundos de cada etapa: dedup (busqueda de
+            duplicados), tag (etiquetado), store (escritura en el almacen, concurrente con tag), db (insercion) y total
+        picture_id (str): id de la imagen. Por defecto se genera un uuid nuevo
 
     Returns:
         json: con los campos:
@@ -92,36 +257,305 @@ def register_image_tags(imagenb64: str, min_confidence: str):
             - `tag`: nombre de la tag
             - `confidence`: confianza con la que la etiqueta está asociada a la imagen
     """
+    # Calculamos el tamaño en bytes de la imagen y su hash
+    return register_image(image_bin, len(image_bin), hashlib.sha256(image_bin).hexdigest(), min_confidence,
+                          source_path=source_path, timings=timings, picture_id=picture_id)
+
+def register_image(image, size: int, image_hash: str, min_confidence: int, source_path: str = None, timings: dict = None,
+                   picture_id: str = None):
+    """
+        Registra una imagen y todos sus tags en la base de datos (ver register_image_bytes). La imagen puede estar en
+        memoria o en el fichero source_path: en ese caso solo se lee completa si se envia sin reducir al backend de
+        etiquetado.
+    Args:
+        image (obj): imagen en binario (bytes) o fichero source_path abierto en modo binario
+        size (int): tamaño de la imagen en bytes
+        image_hash (str): hash SHA-256 del contenido de la imagen
+        min_confidence (int): confianza minima de los tags de la respuesta.
+        source_path (str): fichero de la carpeta de imagenes que ya contiene la imagen (ver register_image_bytes)
+        timings (dict): si se indica, se completa con la duracion de cada etapa del registro (ver register_image_bytes)
+        picture_id (str): id de la imagen. Por defecto se genera un uuid nuevo
+
+    Returns:
+        json: con los campos id, size, date y tags (ver register_image_bytes)
+    """
+    start = time.perf_counter()
+    image_bin = image if isinstance(image, bytes) else None
     # Generamos un uuid para la imagen
-    myuuid = str(uuid.uuid4())
-    # Definimos el nombre y el path para la imagen
+    myuuid = picture_id if picture_id is not None else str(uuid.uuid4())
+    # Definimos el nombre para la imagen
     filename = f"img_{myuuid}"
-    path=os.path.abspath(os.path.join(os.environ["IMAGE_FOLDER"], filename))
     # Comprobamos que existe el directorio de imagenes
     assert os.path.exists(os.environ["IMAGE_FOLDER"]), "El directorio de imagenes no existe. Consulte con su admin"
 
-    # Obtiene los tags de la imagen
-    tags = get_tags_image_minconfidence(imagenb64,filename,min_confidence)
-    # Convertimos la imagen a binario y calculamos su tamaño en bytes
-    image_bin = base64.b64decode(imagenb64.encode())
-    size = len(image_bin)
+    # Buscamos una imagen con el mismo contenido para reutilizar sus tags
+    duplicate = run_stage(timings, "dedup", find_duplicate, image_hash, min_confidence)
+    if duplicate is None:
+        # Guardamos la imagen en el almacen mientras se etiqueta
+        saving = get_store_executor().submit(run_stage, timings, "store", save_image, image_bin, filename, source_path)
+        try:
+            tags = run_stage(timings, "tag", get_tags_image, image, filename)
+        except Exception:
+            # Si el etiquetado falla, borramos la imagen guardada
+            try:
+                discard_image(saving.result())
+            except Exception as error:
+                logging.error(f"Error al guardar la imagen {filename}: {error}")
+            raise
+        location = saving.result()
+        saved = True
+        tags_min_confidence = 0
+    else:
+        tags, location, tags_min_confidence = duplicate
+        saved = location is None
+        if saved:
+            location = run_stage(timings, "store", save_image, image_bin, filename, source_path)
+        elif source_path is not None:
+            os.remove(source_path)
     # Registramos la imagen y sus tags en la base de datos
     # Obtenemos el json con los datos de la imagen y sus tags
-    response= register_image_tags_bd(myuuid, path, tags, 
-                                     datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), size)
-    # Guardamos la imagen en la carpeta de imagene
-    models.save_image(image_bin, path)
+    try:
+        response= run_stage(timings, "db", register_image_tags_bd, myuuid, location["path"], tags,
+                            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), size,
+                            image_hash, tags_min_confidence, location)
+    except Exception:
+        # Si la imagen no se registra borramos su fichero
+        if saved:
+            discard_image(location)
+        raise
+    # Se guardan todos los tags, pero la respuesta solo incluye los de confianza superior a min_confidence
+    response["tags"] = filter_tags(response["tags"], min_confidence)
+    metrics.observe("ingest_total_seconds", time.perf_counter() - start)
+    if timings is not None:
+        timings["total"] = (time.perf_counter() - start) * 1000
     # Devolvemos la respuesta
     return response
 
-def get_images_by_date(min_date: str, max_date: str):
+def get_tmp_path():
+    """
+        Devuelve el path de un nuevo fichero temporal de la carpeta de imagenes.
+
+    Returns:
+        str: path del fichero temporal
+    """
+    # Comprobamos que existe el directorio de imagenes
+    assert os.path.exists(os.environ["IMAGE_FOLDER"]), "El directorio de imagenes no existe. Consulte con su admin"
+    return os.path.abspath(os.path.join(os.environ["IMAGE_FOLDER"], f"tmp_{uuid.uuid4()}"))
+
+def save_image_stream(stream):
+    """
+        Copia en streaming una imagen recibida en binario a un fichero temporal de la carpeta de imagenes,
+        sin cargarla completa en memoria, y calcula su hash SHA-256 mientras se copia.
+    Args:
+        stream (file): stream de lectura de la imagen
+
+    Returns:
+        str: path del fichero temporal
+        str: hash SHA-256 de la imagen
+    """
+    path = get_tmp_path()
+    hasher = hashlib.sha256()
+    models.save_stream(stream, path, hasher=hasher)
+    return path, hasher.hexdigest()
+
+def save_image_upload(upload):
+    """
+        Guarda la imagen de un formulario multipart/form-data en un fichero temporal de la carpeta de imagenes.
+    Args:
+        upload (FileStorage): fichero del formulario
+
+    Returns:
+        str: path del fichero temporal
+        str: hash SHA-256 de la imagen
+    """
+    path = get_tmp_path()
+    upload.save(path)
+    return path, models.hash_image(path)
+
+def register_image_file(source_path: str, min_confidence: int, return_data: bool = False, timings: dict = None,
+                        image_hash: str = None):
+    """
+        Registra la imagen guardada en el fichero temporal source_path (ver save_image_stream) y sus tags, y devuelve
+        los de confianza superior a min_confidence. El fichero se mueve a su ubicacion definitiva; si el registro falla se borra.
+        Salvo con return_data, la imagen no se carga completa en memoria: se etiqueta y se guarda desde el fichero.
+    Args:
+        source_path (str): path del fichero temporal con la imagen
+        min_confidence (int): confianza minima de los tags de la respuesta.
+        return_data (bool): si es true, la respuesta incluye la imagen en base64 en el campo data.
+        timings (dict): si se indica, se completa con la duracion de cada etapa del registro (ver register_image_bytes)
+        image_hash (str): hash SHA-256 de la imagen, si ya se ha calculado al guardarla
+
+    Returns:
+        json: con los campos id, size, date, tags y, si return_data es true, data (ver register_image_bytes)
+    """
+    try:
+        if return_data:
+            image_bin = models.read_image(source_path)
+            response = register_image_bytes(image_bin, min_confidence, source_path=source_path, timings=timings)
+        else:
+            if image_hash is None:
+                image_hash = models.hash_image(source_path)
+            # El fichero abierto se sigue pudiendo leer aunque se mueva al almacen mientras se etiqueta
+            with open(source_path, "rb") as image_file:
+                response = register_image(image_file, os.fstat(image_file.fileno()).st_size, image_hash, min_confidence,
+                                          source_path=source_path, timings=timings)
+    except Exception:
+        if os.path.exists(source_path):
+            os.remove(source_path)
+        raise
+    if return_data:
+        response["data"] = base64.b64encode(image_bin).decode()
+    return response
+
+def get_batch_executor():
+    """
+        Devuelve el pool de threads, acotado a BATCH_WORKERS threads (8 por defecto), con el que se etiquetan
+        concurrentemente las imagenes de los lotes. Lo comparten todas las peticiones del proceso.
+
+    Returns:
+        ThreadPoolExecutor: pool de threads
+    """
+    global _batch_executor
+    if _batch_executor is None:
+        with _batch_executor_lock:
+            if _batch_executor is None:
+                _batch_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("BATCH_WORKERS", 8)),
+                                                     thread_name_prefix="batch-tagger")
+    return _batch_executor
+
+def register_images_batch(images: List, min_confidence: int):
+    """
+        Registra un lote de imagenes y sus tags, y devuelve los tags con confianza superior a min_confidence.
+        Las imagenes se etiquetan concurrentemente (las imagenes repetidas en el lote solo una vez) y se insertan todas
+        en la base de datos en una unica transaccion. Un error en una imagen no impide registrar el resto.
+    Args:
+        images (List): lista de imagenes en binario. Los elementos que no son bytes (por ejemplo, una imagen que no se ha
+            podido decodificar) se tratan como error, con el valor del elemento como descripcion.
+        min_confidence (int): confianza minima de los tags de la respuesta.
+
+    Returns:
+        list: un dict por imagen, en el orden recibido, con los campos:
+        - `index`: posicion de la imagen en el lote
+        - `status`: `ok` o `error`
+        - `id`, `size`, `date`, `tags`: si status es `ok`, datos de la imagen registrada
+        - `description`: si status es `error`, descripcion del error
+    """
+    # Comprobamos que existe el directorio de imagenes
+    assert os.path.exists(os.environ["IMAGE_FOLDER"]), "El directorio de imagenes no existe. Consulte con su admin"
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    results = [None]*len(images)
+    # Etiquetamos concurrentemente cada contenido distinto del lote
+    futures = {}
+    pictures = []
+    for index, image_bin in enumerate(images):
+        if not isinstance(image_bin, bytes):
+            results[index] = {"index": index, "status": "error", "description": str(image_bin)}
+            continue
+        myuuid = str(uuid.uuid4())
+        image_hash = hashlib.sha256(image_bin).hexdigest()
+        if image_hash not in futures:
+            futures[image_hash] = get_batch_executor().submit(get_tags_image_dedup, image_bin, image_hash,
+                                                              f"img_{myuuid}", min_confidence)
+        pictures.append({"index": index, "id": myuuid, "image_bin": image_bin, "hash": image_hash})
+
+    # Recogemos los tags y guardamos en el almacen las imagenes correctamente etiquetadas
+    registered = []
+    saved_locations = {}
+    for picture in pictures:
+        try:
+            tags, location, tags_min_confidence = futures[picture["hash"]].result()
+            if location is None and picture["hash"] in saved_locations:
+                # Imagen repetida dentro del lote
+                location = saved_locations[picture["hash"]]
+            elif location is None:
+                location = storage.get_store().put(picture["image_bin"], f"img_{picture['id']}")
+                saved_locations[picture["hash"]] = location
+        except Exception as error:
+            logging.error(f"Error al registrar la imagen {picture['index']} del lote: {error}")
+            results[picture["index"]] = {"index": picture["index"], "status": "error", "description": str(error)}
+            continue
+        registered.append({"id": picture["id"], "date": date, "size": len(picture["image_bin"]),
+                           "hash": picture["hash"], "min_confidence": tags_min_confidence, "tags": tags, **location})
+        results[picture["index"]] = {"index": picture["index"], "status": "ok", "id": picture["id"], "date": date,
+                                     "size": len(picture["image_bin"]), "tags": filter_tags(tags, min_confidence)}
+
+    # Insertamos todas las imagenes y sus tags en una unica transaccion
+    if len(registered)>0:
+        models.insert_pictures_tags_bulk(registered)
+        for picture in registered:
+            cache.invalidate_picture(picture["id"])
+            similarity.add_picture(picture["id"], picture["tags"])
+
+    return results
+
+def get_dedup_stats():
+    """
+        Devuelve las estadisticas de la deduplicacion de imagenes por contenido.
+
+    Returns:
+        dict: con los campos hits, misses y hit_rate
+    """
+    hits = metrics.get_counter("dedup_hits")
+    misses = metrics.get_counter("dedup_misses")
+    return {"hits": hits, "misses": misses, "hit_rate": hits/(hits+misses) if hits+misses > 0 else 0.0}
+
+def encode_cursor(picture: dict):
+    """
+        Genera el cursor opaco que apunta a la imagen picture, la ultima de una pagina de resultados.
+    Args:
+        picture (dict): imagen con las claves id y date
+
+    Returns:
+        str: cursor en base64 url-safe
+    """
+    date = picture["date"]
+    if isinstance(date, datetime.datetime):
+        date = date.strftime("%Y-%m-%d %H:%M:%S")
+    return base64.urlsafe_b64encode(json.dumps([str(date), picture["id"]]).encode()).decode()
+
+def decode_cursor(cursor: str):
+    """
+        Decodifica un cursor generado por encode_cursor.
+    Args:
+        cursor (str): cursor en base64 url-safe
+
+    Raises:
+        ValueError: si el cursor no es valido
+
+    Returns:
+        tuple: (date, id) de la ultima imagen de la pagina anterior
+    """
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"cursor no valido: {error}")
+    # El cursor debe ser la lista [date, id] generada por encode_cursor
+    if not isinstance(value, list) or len(value) != 2:
+        raise ValueError("cursor no valido")
+    date, picture_id = value
+    if not isinstance(date, str) or not isinstance(picture_id, str):
+        raise ValueError("cursor no valido")
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        uuid.UUID(picture_id)
+    except ValueError as error:
+        raise ValueError(f"cursor no valido: {error}")
+    return date, picture_id
+
+def get_images_by_date(min_date: str, max_date: str, limit: int = None, cursor: str = None,
+                       min_confidence: int = models.DEFAULT_MIN_CONFIDENCE):
     """
         Devuelve todas las id, atributos y tags registrados en la base de datos de imagenes cuya fecha de creacion este entre
         un valor min_date y otro max date.
+        Con limit se devuelve como maximo ese numero de imagenes, a partir de la imagen indicada por cursor.
     
     Args:
         min_date (str): fecha minima de creacion
         max_date (str): fecha máxima de creacion
+        limit (int): numero maximo de imagenes a devolver. Por defecto todas
+        cursor (str): cursor de la pagina anterior (ver encode_cursor)
+        min_confidence (int): confianza minima (excluida) de los tags. Por defecto models.DEFAULT_MIN_CONFIDENCE (80);
+            None para incluir todos los tags
 
     Returns:
         list: cada elmento es un dict con campos:
@@ -130,20 +564,30 @@ def get_images_by_date(min_date: str, max_date: str):
         size: , 
         tags: tag y confidence
     """
-    # Obtenemos las imagenes entre las fechas min_date y max_date
-    pictures = models.get_images_by_date(min_date, max_date)
+    # Obtenemos las imagenes entre las fechas min_date y max_date, de la cache de respuestas si no ha habido inserciones
+    pictures = cache.get_response("images", {"min_date": min_date, "max_date": max_date, "limit": limit, "cursor": cursor,
+                                             "min_confidence": min_confidence},
+                                  lambda: models.get_images_by_date(min_date, max_date, limit=limit,
+                                                                    after=decode_cursor(cursor) if cursor else None,
+                                                                    min_confidence=min_confidence))
 
     return pictures
 
-def get_images_by_date_tags(min_date: str, max_date: str, tags: List):
+def get_images_by_date_tags(min_date: str, max_date: str, tags: List, limit: int = None, cursor: str = None,
+                            min_confidence: int = models.DEFAULT_MIN_CONFIDENCE):
     """
     
         Devuelve todas las id, atributos y tags registrados en la base de datos de imagenes cuya fecha de creacion este entre
         un valor min_date y otro max date y que tiene todas las tags incluidas en el parametro tags.
+        Con limit se devuelve como maximo ese numero de imagenes, a partir de la imagen indicada por cursor.
     Args:
         min_date (str): fecha minima de creacion
         max_date (str): fecha máxima de creacion
         tags (List): lista de tags
+        limit (int): numero maximo de imagenes a devolver. Por defecto todas
+        cursor (str): cursor de la pagina anterior (ver encode_cursor)
+        min_confidence (int): confianza minima (excluida) de los tags, incluidos los del filtro. Por defecto
+            models.DEFAULT_MIN_CONFIDENCE (80); None para incluir todos los tags
 
     Returns:
         list: cada elmento es un dict con campos:
@@ -152,25 +596,81 @@ def get_images_by_date_tags(min_date: str, max_date: str, tags: List):
         size: , 
         tags: tag y confidence
     """
-    # inicializamos la respuesta
-    response=[]
-    # Obtenemos las imagenes entre las fechas min_date y max_date
-    pictures = models.get_images_by_date(min_date, max_date)
-    # Recorremos las imagenes y buscamos las que tienen todas las etiquetas
-    for picture in pictures:
-        # Si la imagen tiene etiquetas, las buscamos en las etiquetas del usuario
-        if len(picture["tags"])>0:
-            # Si la imagen tiene todas las etiquetas del usuario, la añadimos a la respues
-            tags_encontrados=[tag["tag"] for tag in picture["tags"] if tag['tag'] in tags]
-            if len(tags_encontrados)==len(tags):
-                response.append(picture)
+    # Obtenemos las imagenes entre las fechas min_date y max_date que tienen todas las etiquetas.
+    # El filtro de etiquetas se resuelve en la BBDD. El orden de las tags no cambia el resultado
+    pictures = cache.get_response("images", {"min_date": min_date, "max_date": max_date, "tags": sorted(tags), "limit": limit,
+                                             "cursor": cursor, "min_confidence": min_confidence},
+                                  lambda: models.get_images_by_date(min_date, max_date, tags, limit=limit,
+                                                                    after=decode_cursor(cursor) if cursor else None,
+                                                                    min_confidence=min_confidence))
 
-    return response
+    return pictures
 
-def get_image_by_id(id: str):
+def iter_images_by_date(min_date: str, max_date: str, tags: List = None, limit: int = None, cursor: str = None,
+                        min_confidence: int = models.DEFAULT_MIN_CONFIDENCE):
     """
-        Devuelve la imagen con id id y sus tags.
-    
+        Version en streaming de get_images_by_date_tags: devuelve las imagenes una a una a medida que se leen de la BBDD.
+    Args:
+        min_date (str): fecha minima de creacion
+        max_date (str): fecha máxima de creacion
+        tags (List): lista de tags
+        limit (int): numero maximo de imagenes a devolver. Por defecto todas
+        cursor (str): cursor de la pagina anterior (ver encode_cursor)
+        min_confidence (int): confianza minima (excluida) de los tags. Por defecto models.DEFAULT_MIN_CONFIDENCE (80);
+            None para incluir todos los tags
+
+    Returns:
+        generator: cada elmento es un dict con campos id, date, size y tags
+    """
+    return models.iter_images_by_date(min_date, max_date, tags, limit=limit,
+                                      after=decode_cursor(cursor) if cursor else None, min_confidence=min_confidence)
+
+def iter_export(since: str = "", export_format: str = "ndjson"):
+    """
+        Devuelve las lineas de la exportacion del archivo de imagenes y tags (ver models.set_sql_export), leidas de la
+        BBDD con un cursor de servidor en bloques de EXPORT_CHUNK_SIZE filas (1000 por defecto).
+        En formato ndjson cada linea es una imagen con sus tags; en formato csv cada linea es una tag de una imagen
+        (id, date, size, tag, confidence), precedidas de la cabecera. Las imagenes sin tags ocupan una linea con tag y
+        confidence vacios.
+        La primera fila se lee antes de devolver el generador, de forma que los errores de conexion se producen al llamar.
+    Args:
+        since (str): fecha minima de registro. Vacia para exportar todo el archivo
+        export_format (str): ndjson o csv
+
+    Returns:
+        generator: lineas de la exportacion, terminadas en salto de linea
+    """
+    rows = models.iter_export_rows(since, int(os.environ.get("EXPORT_CHUNK_SIZE", 1000)))
+    first = next(rows, None)
+    rows = itertools.chain([first], rows) if first is not None else iter(())
+    if export_format == "csv":
+        return csv_lines(rows)
+    return (json.dumps(picture) + "\n" for picture in models.iter_group_pictures_tags(rows))
+
+def csv_lines(rows):
+    """
+        Genera las lineas csv de la exportacion a partir de las filas (id, date, size, tag, confidence).
+    Args:
+        rows (iterable): filas de la exportacion
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in itertools.chain([("id", "date", "size", "tag", "confidence")], rows):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def get_image_by_id(id: str, min_confidence: int = models.DEFAULT_MIN_CONFIDENCE):
+    """
+        Devuelve la imagen con id id y sus tags, a traves de la cache de imagenes (ver cache).
+        La cache guarda todos los tags de la imagen y el filtro min_confidence se aplica sobre ellos, sin volver a
+        consultar la BBDD para cada umbral.
+    Args:
+        id (str): id de la imagen
+        min_confidence (int): confianza minima (excluida) de los tags. Por defecto models.DEFAULT_MIN_CONFIDENCE (80);
+            None para incluir todos los tags
+
     Returns:
         json: con los campos:
         - `id`: identificador de la imagen
@@ -181,45 +681,144 @@ def get_image_by_id(id: str):
             - `confidence`: confianza con la que la etiqueta está asociada a la imagen
         - `data`: imagen como string codificado en base64
     """
+    try:
+        picture = _get_image_by_id(id)
+    except FileNotFoundError:
+        # La ubicacion cacheada ya no existe (por ejemplo, tras compactar el almacen): la volvemos a leer de la BBDD
+        cache.invalidate_picture(id)
+        picture = _get_image_by_id(id)
+    # La copia de la cache comparte la lista de tags: la sustituimos en lugar de modificarla
+    if picture and min_confidence is not None:
+        picture["tags"] = filter_tags(picture["tags"], min_confidence)
+    return picture
+
+def _get_image_by_id(id: str):
     # Obtenemos la imagen por su id
-    picture = models.get_image_by_id(id)
-    # Si picture contiene el path de la imagen
+    picture = cache.get_picture(id, models.get_image_by_id)
+    # Si picture contiene la ubicacion de la imagen
     if "path" in picture:
-        # Leemos la imagen de la carpeta de imagenes y eliminamos la key path de la respuesta
-        image_str = models.read_image(picture.pop("path", None))
+        # Leemos la imagen del almacen de imagenes y eliminamos su ubicacion de la respuesta
+        location = storage.pop_location(picture)
         # Incluimos la imagen en la respuesta en formato base64 y tipo string
-        picture["data"]=base64.b64encode(image_str).decode()
+        picture["data"]=cache.get_picture_data(id, lambda: base64.b64encode(storage.read(location)).decode())
     
     return picture
 
-def get_tags_by_date(min_date: str, max_date: str):
+def get_similar_images(picture_id: str, k: int):
+    """
+        Devuelve las k imagenes mas parecidas a la imagen con id picture_id por similitud coseno de sus vectores de
+        tag-confidence, calculada sobre el indice en memoria (ver similarity).
+        Si la imagen no existe, devuelve None.
+    Args:
+        picture_id (str): id de la imagen
+        k (int): numero maximo de imagenes a devolver
+
+    Returns:
+        list: dict con los campos:
+        - `id`: identificador de la imagen
+        - `similarity`: similitud coseno con la imagen consultada, entre 0 y 1
+    """
+    picture = cache.get_picture(picture_id, models.get_image_by_id)
+    if not picture:
+        return None
+    start = time.perf_counter()
+    similar = similarity.get_index().top_k(picture["tags"], k, exclude=picture_id)
+    metrics.observe("similarity_query_seconds", time.perf_counter() - start)
+    return similar
+
+def refresh_picture(picture_id: str):
     """
-        Devuelve las tags registradas entre las fechas min_date y max_date
+        Refresca una imagen cuyos tags se han modificado en la BBDD: la elimina de la cache y sustituye sus tags
+        en el indice de similitud por los de la BBDD.
+    Args:
+        picture_id (str): id de la imagen
+    """
+    cache.invalidate_picture(picture_id)
+    picture = models.get_image_by_id(picture_id)
+    if picture:
+        similarity.update_picture(picture_id, picture["tags"])
+
+def refresh_pictures(ids: List):
+    """
+        Refresca las imagenes ids (ver refresh_picture) e invalida las respuestas cacheadas.
+    Args:
+        ids (List): ids de las imagenes
+
+    Returns:
+        int: numero de imagenes refrescadas
+    """
+    for picture_id in ids:
+        refresh_picture(picture_id)
+    cache.bump_generation()
+    return len(ids)
+
+def get_image_mimetype(header: bytes):
+    """
+        Identifica el tipo de una imagen a partir de su cabecera (magic bytes).
+    Args:
+        header (bytes): primeros bytes de la imagen
+
+    Returns:
+        str: content type de la imagen, application/octet-stream si no se reconoce
+    """
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header.startswith(b"BM"):
+        return "image/bmp"
+    if header.startswith((b"II*\x00", b"MM\x00*")):
+        return "image/tiff"
+    return "application/octet-stream"
+
+def get_image_file(picture_id: str):
+    """
+        Devuelve la informacion necesaria para servir el fichero de la imagen con id picture_id.
+        Si la imagen no existe, o su fichero no esta en disco, devuelve un dict vacio.
+    
+    Returns:
+        dict: con los campos:
+        - `location`: ubicacion de la imagen en el almacen de imagenes (ver storage)
+        - `size`: tamaño de la imagen en bytes
+        - `mimetype`: content type de la imagen
+        - `etag`: ETag fuerte de la imagen: su hash SHA-256 o, si no se registro, su id (el contenido de una imagen no cambia)
+    """
+    picture = models.get_image_file_by_id(picture_id)
+    if not picture:
+        return {}
+    location = storage.pop_location(picture)
+    if not storage.exists(location):
+        return {}
+    return {"location": location, "size": picture["size"],
+            "mimetype": get_image_mimetype(storage.read(location, 16)),
+            "etag": picture["hash"] or picture["id"]}
+
+def get_tags_by_date(min_date: str, max_date: str, limit: int = None, order_by: str = None,
+                     min_confidence: int = models.DEFAULT_MIN_CONFIDENCE):
+    """
+        Devuelve las tags registradas entre las fechas min_date y max_date con sus estadisticas de confianza
     Args:
         min_date (str): fecha minima de creacion
         max_date (str): fecha máxima de creacion
+        limit (int): numero maximo de tags a devolver. Por defecto todas
+        order_by (str): `n` o `mean_confidence` para ordenar de mayor a menor. Por defecto se ordena por tag
+        min_confidence (int): confianza minima (excluida) de los tags. Por defecto models.DEFAULT_MIN_CONFIDENCE (80);
+            None para incluir todos los tags
 
     Returns:
         list: cada elemento es un dict con los campos:
         - `tag`: nombre de la tag
-        - `n_images`: número de imágenes que tienen asociada esta tag
+        - `n`: número de imágenes que tienen asociada esta tag
         - `min_confidence`, `max_confidence`, `mean_confidence`: confianza mínima, máxima y media de esta tag para todas las imágenes con las que está asignada.
     """
-    # Inicializamos el diccionario de etiquetas
-    tags={}
-    # Obtenemos las imagenes y sus tags entre las fechas min_date y max_date
-    pictures = models.get_images_by_date(min_date, max_date)
-    # Recorremos las imagenes y extraemos sus tags
-    for picture in pictures:
-        # Si la imagen tiene etiquetas
-        if len(picture["tags"])>0:
-            # Recorremos las etiquetas y añadimos el tag a la lista de tags
-            for tag in picture["tags"]:
-                # Si ya tenemos la tag
-                if tag['tag'] in tags:
-                    #tags[tag['tag']]["n"]+=1# tags[tag['tag']]["n"]+1
-                    tags[tag['tag']]["confidences"].append(tag['confidence'])
-                else:
-                    tags[tag['tag']] = {"confidences":[tag['confidence']]} 
-
-    return tags
\ No newline at end of file
+    # Las estadisticas se calculan en la BBDD con una unica select agrupada por tag, o se leen de la cache de respuestas
+    tags = cache.get_response("tags", {"min_date": min_date, "max_date": max_date, "limit": limit, "order_by": order_by,
+                                       "min_confidence": min_confidence},
+                              lambda: models.get_tags_stats_by_date(min_date, max_date, limit, order_by,
+                                                                    min_confidence=min_confidence))
+
+    return tags
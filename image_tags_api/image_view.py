@@ -1,9 +1,15 @@
-from flask import Blueprint, request, make_response
+from flask import Blueprint, Response, request, make_response, send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+import os
+import json
+import time
+import zlib
+import base64
 import datetime
 import logging
 from uuid import UUID
 
-from image_tags_api import controller
+from image_tags_api import controller, jobs, storage, metrics
 from image_tags_api.appexceptions import ImageKitError, ImaggaError, BBDDConexionError, BBDDObjetoError
 
 image_bp = Blueprint('image', __name__, url_prefix='/')
@@ -11,12 +17,19 @@ image_bp = Blueprint('image', __name__, url_prefix='/')
 @image_bp.post('/image')
 def post_image():
     """
-        Implementacion del metodo POST /image. Registramos la imagen recibida en la tabla de Pictures y los tags asociadas a la misma
-        cuya confidence sea superior a min_confidence.
-        La imagen se recibe en el body del request como un json con el campo data.
+        Implementacion del metodo POST /image. Registramos la imagen recibida en la tabla de Pictures y todos los tags asociados
+        a la misma con su confidence. La respuesta solo incluye los tags cuya confidence sea superior a min_confidence.
+        La imagen se recibe en el body del request como un json con el campo data (imagen en base64), como un formulario
+        multipart/form-data con el fichero en el campo image o como binario con Content-Type application/octet-stream.
+        Las imagenes binarias se guardan en streaming en un fichero temporal, sin cargar el body completo en memoria.
         La respuesta incluye la imagen en base64 y los tags asociados.
+        Con async=true la imagen se guarda, se encola un trabajo para registrarla en segundo plano y se responde 202 con
+        el id del trabajo, cuyo estado se consulta en GET /jobs/<id>.
     Query parameters:
-        min_confidence: valor de confianza minimo para aceptar la tag de una imagen.
+        min_confidence: valor de confianza minimo para incluir la tag de una imagen en la respuesta.
+        async: si es true, el registro de la imagen se realiza en segundo plano.
+        return_data: si es false la respuesta no incluye la imagen en base64. Por defecto true si la imagen se
+            recibe en json y false si se recibe en binario.
     Returns:
         Un json con los siguientes campos:
             - `id`: identificador de la imagen
@@ -25,7 +38,7 @@ def post_image():
             - `tags`: lista de objetos identificando las tags asociadas a la imágen. Cada objeto tendrá el siguiente formato:
                 - `tag`: nombre de la tag
                 - `confidence`: confianza con la que la etiqueta está asociada a la imagen
-            - `data`: imagen como string codificado en base64
+            - `data`: imagen como string codificado en base64, si return_data es true
     """
     try:
         # Leemos el query parameter min_confidence
@@ -35,6 +48,17 @@ def post_image():
             return make_response({"description": "min_confidence debe estar entre 0 y 100"}, 400)
     except ValueError:
         return make_response({"description": "min_confidence debe ser un entero"}, 400)
+
+    # Leemos el query parameter return_data
+    return_data= request.args.get("return_data")
+    if return_data is not None and return_data.lower() not in ("true", "false"):
+        return make_response({"description": "return_data debe ser true o false"}, 400)
+    # Leemos el query parameter async
+    is_async= request.args.get("async", "false").lower() == "true"
+
+    # Si la imagen se recibe en binario la guardamos en streaming
+    if request.mimetype in ("multipart/form-data", "application/octet-stream"):
+        return post_image_binary(min_confidence, is_async, return_data is not None and return_data.lower() == "true")
     
     # Leemos la imagen del json del body
     if not request.is_json:
@@ -42,18 +66,24 @@ def post_image():
     
     try:
         imagenb64 = request.json['data']
-    except ValueError:
+        image_bin = base64.b64decode(imagenb64.encode(), validate=True)
+    except (KeyError, TypeError, AttributeError, ValueError):
         return make_response({"description": "data debe ser una imagen en base64"}, 400)
 
+    # Si se solicita, registramos la imagen en segundo plano
+    if is_async:
+        return post_image_async(image_bin, min_confidence)
+
     # Registramos la imagen y sus tags en la base de datos
     # Guardamos la imagen en la carpeta de imagenes y 
+    timings = {}
     try:
-        response= controller.register_image_tags(imagenb64, min_confidence)
-        print("Imagen insertada")
+        response= controller.register_image_bytes(image_bin, min_confidence, timings=timings)
         # Completamos la respuesta
         logging.info("Imagen insertada en BBDD")
-        response["data"]= imagenb64
-        logging.info("Imagen en base 64 incluida en la respuesta")
+        if return_data is None or return_data.lower() == "true":
+            response["data"]= imagenb64
+            logging.info("Imagen en base 64 incluida en la respuesta")
     except AssertionError as error:
         logging.critical(error)
         return make_response({"description": str(error)}, 501)
@@ -70,7 +100,184 @@ def post_image():
         logging.error(error)
         return make_response({"description": str(error)}, 501)
         
-    return response
+    return make_response(response, 200, {"Server-Timing": server_timing(timings)})
+
+def server_timing(timings: dict):
+    """
+        Devuelve el valor de la cabecera Server-Timing con la duracion de cada etapa del registro de una imagen.
+    Args:
+        timings (dict): duracion en milisegundos de cada etapa (ver controller.register_image_bytes)
+    Returns:
+        str: valor de la cabecera, por ejemplo `dedup;dur=1.2, tag;dur=840.5, store;dur=3.1, db;dur=4.0, total;dur=850.2`
+    """
+    return ", ".join(f"{stage};dur={duration:.1f}" for stage, duration in timings.items())
+
+def post_image_binary(min_confidence: int, is_async: bool, return_data: bool):
+    """
+        Registra una imagen recibida en binario (multipart/form-data con el fichero en el campo image, o application/octet-stream).
+        La imagen se copia en streaming a un fichero temporal de la carpeta de imagenes, calculando su hash, y se etiqueta
+        y se mueve a su ubicacion definitiva desde ese fichero, sin cargarla completa en memoria.
+    Args:
+        min_confidence (int): confianza minima de los tags de la respuesta.
+        is_async (bool): si es true, el registro de la imagen se realiza en segundo plano.
+        return_data (bool): si es true, la respuesta incluye la imagen en base64.
+    Returns:
+        La respuesta de POST /image, o de POST /image?async=true.
+    """
+    if request.mimetype == "multipart/form-data" and "image" not in request.files:
+        return make_response({"description": "el formulario debe incluir el fichero de la imagen en el campo image"}, 400)
+
+    try:
+        # Copiamos la imagen en streaming a un fichero temporal
+        if request.mimetype == "multipart/form-data":
+            tmp_path, image_hash = controller.save_image_upload(request.files["image"])
+        else:
+            tmp_path, image_hash = controller.save_image_stream(request.stream)
+    except AssertionError as error:
+        logging.critical(error)
+        return make_response({"description": str(error)}, 501)
+
+    if os.path.getsize(tmp_path) == 0:
+        os.remove(tmp_path)
+        return make_response({"description": "el body debe contener la imagen"}, 400)
+
+    try:
+        if is_async:
+            job_id = jobs.submit_file(tmp_path, min_confidence)
+            logging.info(f"Trabajo {job_id} encolado")
+            return make_response({"id": job_id, "status": "pending"}, 202, {"Location": f"/jobs/{job_id}"})
+
+        timings = {}
+        response= controller.register_image_file(tmp_path, min_confidence, return_data, timings, image_hash)
+        logging.info("Imagen insertada en BBDD")
+    except ImageKitError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except ImaggaError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+
+    return make_response(response, 200, {"Server-Timing": server_timing(timings)})
+
+def post_image_async(image_bin: bytes, min_confidence: int):
+    """
+        Guarda la imagen y encola un trabajo para registrarla en segundo plano.
+    Args:
+        image_bin (bytes): imagen en binario.
+        min_confidence (int): confianza minima de los tags de la respuesta.
+    Returns:
+        Respuesta 202 con un json con los campos `id` y `status` del trabajo y la cabecera Location con su url.
+    """
+    try:
+        job_id = jobs.submit(image_bin, min_confidence)
+        logging.info(f"Trabajo {job_id} encolado")
+    except AssertionError as error:
+        logging.critical(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+
+    return make_response({"id": job_id, "status": "pending"}, 202, {"Location": f"/jobs/{job_id}"})
+
+@image_bp.post('/images/batch')
+def post_images_batch():
+    """
+        Implementacion del metodo POST /images/batch. Registramos un lote de imagenes y todos sus tags. La respuesta
+        solo incluye los tags con confidence superior a min_confidence. Las imagenes se etiquetan concurrentemente y se insertan en la BBDD en una unica transaccion.
+        El body del request es un json con el campo images: una lista de objetos con el campo data (imagen en base64).
+        Un error en una imagen no impide registrar el resto.
+    Query parameters:
+        min_confidence: valor de confianza minimo para incluir la tag de una imagen en la respuesta.
+    Returns:
+        Un json con el campo `results`: una lista con un objeto por imagen, en el orden recibido, con los campos:
+            - `index`: posicion de la imagen en el lote
+            - `status`: `ok` o `error`
+            - `id`, `size`, `date`, `tags`: si status es `ok`, datos de la imagen registrada
+            - `description`: si status es `error`, descripcion del error
+    """
+    try:
+        # Leemos el query parameter min_confidence
+        min_confidence= int(request.args.get("min_confidence", 80))
+        # Validamos que min_confidence este entre 0 y 100
+        if min_confidence < 0 or min_confidence > 100:
+            return make_response({"description": "min_confidence debe estar entre 0 y 100"}, 400)
+    except ValueError:
+        return make_response({"description": "min_confidence debe ser un entero"}, 400)
+
+    # Leemos las imagenes del json del body
+    if not request.is_json or not isinstance(request.json.get("images") if isinstance(request.json, dict) else None, list):
+        return make_response({"description": "Body debe ser un objeto json con una lista images"}, 400)
+    items = request.json["images"]
+    max_images = int(os.environ.get("BATCH_MAX_IMAGES", 500))
+    if len(items) > max_images:
+        return make_response({"description": f"el lote no puede tener mas de {max_images} imagenes"}, 413)
+
+    # Decodificamos cada imagen. Las que no son validas se devuelven como error en su posicion
+    images = []
+    for item in items:
+        try:
+            images.append(base64.b64decode(item["data"].encode(), validate=True))
+        except (TypeError, KeyError, AttributeError, ValueError):
+            images.append("data debe ser una imagen en base64")
+
+    try:
+        results= controller.register_images_batch(images, min_confidence)
+        logging.info(f"Lote de {len(images)} imagenes procesado")
+    except AssertionError as error:
+        logging.critical(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+
+    return {"results": results}
+
+@image_bp.post('/images/refresh')
+def post_images_refresh():
+    """
+        Implementacion del metodo POST /images/refresh. Refrescamos en este proceso las imagenes cuyos tags se han
+        modificado en la BBDD desde otro proceso (por ejemplo, el backfill): se eliminan de la cache de imagenes, se
+        actualizan sus tags en el indice de similitud y se invalidan las respuestas cacheadas de GET /images y GET /tags.
+        El body del request es un json con el campo ids: una lista de ids de imagenes.
+    Returns:
+        Un json con el campo `refreshed`: numero de imagenes refrescadas.
+    """
+    # Leemos los ids del json del body
+    if not request.is_json or not isinstance(request.json.get("ids") if isinstance(request.json, dict) else None, list):
+        return make_response({"description": "Body debe ser un objeto json con una lista ids"}, 400)
+    ids = request.json["ids"]
+    max_images = int(os.environ.get("BATCH_MAX_IMAGES", 500))
+    if len(ids) > max_images:
+        return make_response({"description": f"no se pueden refrescar mas de {max_images} imagenes"}, 413)
+    try:
+        for picture_id in ids:
+            _ = UUID(picture_id)
+    except (TypeError, AttributeError, ValueError):
+        return make_response({"description": "ids debe ser una lista de cadenas uuid validas"}, 400)
+
+    try:
+        refreshed= controller.refresh_pictures(ids)
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+
+    return {"refreshed": refreshed}
 
 @image_bp.get('/images')
 def get_images():
@@ -78,10 +285,17 @@ def get_images():
         Implementacion del metodo GET /images. Obtenemos todas las imagenes registradas en la base de datos cuya fecha de creacion este entre
         un valor min_date y otro max date y además si se proporciona el parametro tags todos los tags de la imagen deben estar entre los proporcionados.
         La respuesta incluye la imagen en base64 y los tags asociados.
+        Las imagenes se devuelven ordenadas por fecha de registro descendente. Si se indica limit, la respuesta se pagina y la
+        cabecera X-Next-Cursor contiene el cursor de la pagina siguiente.
     Query parameters:
         min_date: fecha minima de creacion de la imagen.
         max_date: fecha maxima de creacion de la imagen.
         tags: lista de tags separados por comas.
+        limit: numero maximo de imagenes a devolver.
+        cursor: cursor de la pagina siguiente, devuelto en la cabecera X-Next-Cursor de la pagina anterior.
+        min_confidence: solo se devuelven las tags con confidence superior (por defecto 80), y el filtro tags solo considera esas tags.
+        stream: si es true (o la cabecera Accept es application/x-ndjson) la respuesta se envia en streaming en formato NDJSON,
+            una imagen por linea, leyendo las imagenes de la BBDD a medida que llegan.
     Returns:
         Un json con los siguientes campos:
             - `id`: identificador de la imagen
@@ -122,11 +336,49 @@ def get_images():
         return make_response({"description": "tags debe ser una lista de tags separados por comas"}, 400)
 
     try:
+        # Leemos el query parameter limit
+        limit= int(request.args["limit"]) if 'limit' in request.args else None
+        # Validamos que limit sea positivo
+        if limit is not None and limit <= 0:
+            return make_response({"description": "limit debe ser un entero positivo"}, 400)
+    except ValueError:
+        return make_response({"description": "limit debe ser un entero"}, 400)
+
+    try:
+        # Leemos el query parameter min_confidence
+        min_confidence= int(request.args.get("min_confidence", 80))
+        # Validamos que min_confidence este entre 0 y 100
+        if min_confidence < 0 or min_confidence > 100:
+            return make_response({"description": "min_confidence debe estar entre 0 y 100"}, 400)
+    except ValueError:
+        return make_response({"description": "min_confidence debe ser un entero"}, 400)
+
+    # Leemos el query parameter cursor y validamos su formato
+    cursor= request.args.get("cursor")
+    if cursor is not None:
+        try:
+            controller.decode_cursor(cursor)
+        except ValueError as error:
+            return make_response({"description": str(error)}, 400)
+
+    # Comprobamos si se solicita la respuesta en streaming NDJSON
+    stream= request.args.get("stream", "false").lower() == "true" or \
+        request.accept_mimetypes.best == "application/x-ndjson"
+
+    try:
+        if stream:
+            # Obtenemos las imagenes a medida que se leen de la BBDD
+            pictures= controller.iter_images_by_date(min_date, max_date, tags, limit, cursor, min_confidence)
+            # Leemos la primera imagen para que los errores de conexion se devuelvan antes de iniciar la respuesta
+            first= next(pictures, None)
+            logging.info("Imagenes en streaming desde BBDD")
+            return Response(ndjson_lines(first, pictures), mimetype="application/x-ndjson")
+
         # Obtenemos las imagenes con las tags y fecha de creacion entre min_date y max_date
         if len(tags)>0:
-            response= controller.get_images_by_date_tags(min_date, max_date, tags)
+            response= controller.get_images_by_date_tags(min_date, max_date, tags, limit, cursor, min_confidence)
         else:
-            response= controller.get_images_by_date(min_date, max_date)
+            response= controller.get_images_by_date(min_date, max_date, limit, cursor, min_confidence)
             
         logging.info("Imagenes obtenidas de BBDD")
     except BBDDConexionError as error:
@@ -136,14 +388,115 @@ def get_images():
         logging.error(error)
         return make_response({"description": str(error)}, 501)
 
+    response= make_response(response)
+    # Si la pagina esta completa, indicamos el cursor de la pagina siguiente
+    if limit is not None and len(response.json)==limit:
+        response.headers["X-Next-Cursor"]= controller.encode_cursor(response.json[-1])
+
     return response
 
+def ndjson_lines(first, pictures):
+    """
+        Genera las lineas NDJSON de la respuesta en streaming de GET /images.
+    Args:
+        first (dict): primera imagen, ya leida de la BBDD. None si no hay imagenes
+        pictures (generator): resto de imagenes
+    """
+    if first is None:
+        return
+    yield json.dumps(first) + "\n"
+    try:
+        for picture in pictures:
+            yield json.dumps(picture) + "\n"
+    except (BBDDConexionError, BBDDObjetoError) as error:
+        # La respuesta ya se ha iniciado, solo podemos registrar el error y cortarla
+        logging.error(error)
+
+# Tamaño de los bloques en los que se envia la respuesta de GET /export
+EXPORT_BLOCK_SIZE = 64*1024
+
+@image_bp.get('/export')
+def get_export():
+    """
+        Implementacion del metodo GET /export. Exportamos en streaming todas las imagenes registradas con sus tags,
+        leyendolas de la BBDD con un cursor de servidor en bloques de tamaño fijo, de forma que la memoria empleada no
+        depende del tamaño del archivo. Las imagenes se exportan ordenadas por fecha de registro ascendente.
+        Si la cabecera Accept-Encoding admite gzip, la respuesta se comprime en streaming (Content-Encoding: gzip).
+    Query parameters:
+        format: ndjson (por defecto), una imagen con sus tags por linea, o csv, una tag de una imagen por linea.
+        since: fecha minima de registro de las imagenes, en formato `YYYY-MM-DD HH:MM:SS`, para exportaciones incrementales.
+    Returns:
+        NDJSON con los campos id, date, size y tags de cada imagen, o CSV con las columnas id, date, size, tag y confidence.
+    """
+    try:
+        # Leemos el query parameter since
+        if 'since' in request.args:
+            since= datetime.datetime.strptime(request.args.get("since"), "%Y-%m-%d %H:%M:%S")
+        else:
+            since=""
+    except ValueError:
+        return make_response({"description": "since debe ser una fecha en formato %Y-%m-%d %H:%M:%S"}, 400)
+
+    # Leemos el query parameter format
+    export_format= request.args.get("format", "ndjson").lower()
+    if export_format not in ("ndjson", "csv"):
+        return make_response({"description": "format debe ser ndjson o csv"}, 400)
+
+    try:
+        lines= controller.iter_export(since, export_format)
+        logging.info("Exportacion en streaming desde BBDD")
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+
+    compress= "gzip" in request.accept_encodings
+    headers= {"Content-Disposition": f"attachment; filename=export.{export_format}", "Vary": "Accept-Encoding"}
+    if compress:
+        headers["Content-Encoding"]= "gzip"
+    mimetype= "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return Response(export_blocks(lines, compress), mimetype=mimetype, headers=headers)
+
+def export_blocks(lines, compress: bool):
+    """
+        Agrupa las lineas de la exportacion en bloques de EXPORT_BLOCK_SIZE bytes, comprimidos con gzip si se indica,
+        para enviar la respuesta de GET /export en pocas escrituras.
+    Args:
+        lines (generator): lineas de la exportacion (ver controller.iter_export)
+        compress (bool): si es true, los bloques se comprimen con gzip
+    """
+    start= time.perf_counter()
+    compressor= zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    block, size= [], 0
+    try:
+        for line in lines:
+            data= line.encode()
+            block.append(data)
+            size+= len(data)
+            if size >= EXPORT_BLOCK_SIZE:
+                data= b"".join(block)
+                block, size= [], 0
+                data= compressor.compress(data) if compressor else data
+                if data:
+                    yield data
+    except (BBDDConexionError, BBDDObjetoError) as error:
+        # La respuesta ya se ha iniciado: la cortamos sin terminarla, para que el cliente no la tome por completa
+        logging.error(error)
+        raise
+    data= b"".join(block)
+    yield compressor.compress(data) + compressor.flush() if compressor else data
+    metrics.observe("export_seconds", time.perf_counter() - start)
+
 @image_bp.get('/image/<picture_id>')
 def get_image(picture_id):
     """
     Implementacion del metodo GET /image. Obtenemos la imagen con el id proporcionado.
     Path parameter:
         id: identificador de la imagen.
+    Query parameters:
+        min_confidence: solo se devuelven las tags con confidence superior (por defecto 80).
     Returns:
         Un json con los siguientes campos:
             - `id`: identificador de la imagen
@@ -160,9 +513,18 @@ def get_image(picture_id):
     except ValueError:
         return make_response({"description": "el path parametro id debe ser una cadena uuid valida"}, 400)
 
+    try:
+        # Leemos el query parameter min_confidence
+        min_confidence= int(request.args.get("min_confidence", 80))
+        # Validamos que min_confidence este entre 0 y 100
+        if min_confidence < 0 or min_confidence > 100:
+            return make_response({"description": "min_confidence debe estar entre 0 y 100"}, 400)
+    except ValueError:
+        return make_response({"description": "min_confidence debe ser un entero"}, 400)
+
     try:
         #Obtenemos la imagen y sus tags de la base de datos
-        response= controller.get_image_by_id(picture_id)
+        response= controller.get_image_by_id(picture_id, min_confidence)
         logging.info("Imagen obtenidas de BBDD")
     except BBDDConexionError as error:
         logging.error(error)
@@ -172,3 +534,93 @@ def get_image(picture_id):
         return make_response({"description": str(error)}, 501)
 
     return response
+
+@image_bp.get('/image/<picture_id>/similar')
+def get_similar_images(picture_id):
+    """
+    Implementacion del metodo GET /image/<id>/similar. Obtenemos las imagenes mas parecidas a la imagen con el id
+    proporcionado, por similitud coseno de sus vectores de tag-confidence.
+    Path parameter:
+        id: identificador de la imagen.
+    Query parameters:
+        k: numero maximo de imagenes a devolver, entre 1 y SIMILARITY_MAX_K. Por defecto 10.
+    Returns:
+        Una lista json, ordenada por similitud descendente, con los siguientes campos:
+            - `id`: identificador de la imagen
+            - `similarity`: similitud coseno con la imagen consultada, entre 0 y 1
+    """
+    try:
+        _ = UUID(picture_id, version=4)
+    except ValueError:
+        return make_response({"description": "el path parametro id debe ser una cadena uuid valida"}, 400)
+
+    max_k = int(os.environ.get("SIMILARITY_MAX_K", 100))
+    try:
+        # Leemos el query parameter k
+        k= int(request.args.get("k", 10))
+    except ValueError:
+        return make_response({"description": f"k debe ser un entero entre 1 y {max_k}"}, 400)
+    # Validamos que k este en el rango permitido
+    if k <= 0 or k > max_k:
+        return make_response({"description": f"k debe ser un entero entre 1 y {max_k}"}, 400)
+
+    try:
+        similar= controller.get_similar_images(picture_id, k)
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+
+    if similar is None:
+        return make_response({"description": f"no existe la imagen {picture_id}"}, 404)
+
+    return similar
+
+@image_bp.get('/image/<picture_id>/raw')
+def get_image_raw(picture_id):
+    """
+    Implementacion del metodo GET /image/<id>/raw. Devolvemos el fichero de la imagen en binario, en streaming desde disco
+    (con wsgi.file_wrapper cuando el servidor lo ofrece, como waitress) o desde el mmap de su segmento, y con su content type.
+    La respuesta incluye un ETag fuerte basado en el hash del contenido y respeta las cabeceras If-None-Match (304)
+    y Range (206), de forma que caches y CDNs pueden servir las lecturas repetidas.
+    Path parameter:
+        id: identificador de la imagen.
+    Returns:
+        El fichero de la imagen.
+    """
+    try:
+        _ = UUID(picture_id, version=4)
+    except ValueError:
+        return make_response({"description": "el path parametro id debe ser una cadena uuid valida"}, 400)
+
+    try:
+        image_file= controller.get_image_file(picture_id)
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+
+    if not image_file:
+        return make_response({"description": f"no existe la imagen {picture_id}"}, 404)
+
+    location = image_file["location"]
+    max_age = int(os.environ.get("IMAGE_CACHE_MAX_AGE", 86400))
+    # Las imagenes del almacen flat se sirven desde su fichero
+    if location["segment"] is None:
+        return send_file(location["path"], mimetype=image_file["mimetype"], etag=image_file["etag"], conditional=True,
+                         max_age=max_age)
+    # Las de un segmento, desde un fichero acotado a la imagen dentro del segmento, sin copiarla a memoria.
+    # send_file solo conoce el tamaño de los ficheros en disco, asi que lo indicamos para responder a las cabeceras Range
+    file = storage.open_image(location)
+    response = send_file(file, mimetype=image_file["mimetype"], etag=image_file["etag"], conditional=False,
+                         max_age=max_age)
+    response.content_length = file.length
+    try:
+        return response.make_conditional(request, accept_ranges=True, complete_length=file.length)
+    except RequestedRangeNotSatisfiable:
+        file.close()
+        raise
@@ -0,0 +1,41 @@
+from flask import Blueprint, make_response
+import logging
+from uuid import UUID
+
+from image_tags_api import jobs
+from image_tags_api.appexceptions import BBDDConexionError, BBDDObjetoError
+
+job_bp = Blueprint('job', __name__, url_prefix='/')
+
+@job_bp.get('/jobs/<job_id>')
+def get_job(job_id):
+    """
+    Implementacion del metodo GET /jobs. Obtenemos el estado de un trabajo de registro de imagen creado con POST /image?async=true.
+    Path parameter:
+        job_id: identificador del trabajo.
+    Returns:
+        Un json con los siguientes campos:
+            - `id`: identificador del trabajo
+            - `status`: `pending`, `running`, `done` o `error`
+            - `created`, `updated`: fechas de creacion y ultima actualizacion del trabajo
+            - `result`: si status es `done`, la imagen registrada con los campos `id`, `size`, `date` y `tags`
+            - `description`: si status es `error`, la descripcion del error
+    """
+    try:
+        _ = UUID(job_id, version=4)
+    except ValueError:
+        return make_response({"description": "el path parametro job_id debe ser una cadena uuid valida"}, 400)
+
+    try:
+        response= jobs.get_job_status(job_id)
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+
+    if not response:
+        return make_response({"description": f"no existe el trabajo {job_id}"}, 404)
+
+    return response
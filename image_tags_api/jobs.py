@@ -0,0 +1,189 @@
+import os
+import json
+import uuid
+import queue
+import logging
+import datetime
+import threading
+
+from . import models, metrics, controller, storage
+from .appexceptions import BBDDConexionError, BBDDObjetoError
+
+# Cola de trabajos de registro de imagenes y pool de workers del proceso (ver start_workers).
+# Los trabajos se persisten en la tabla jobs: la cola en memoria solo despierta a los workers,
+# que ademas recogen periodicamente los trabajos pending de la BBDD.
+_queue = None
+_workers = []
+_lock = threading.Lock()
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def _enqueue(job_id: str):
+    """
+        Encola un trabajo para los workers. Si la cola esta llena el trabajo sigue pending en la BBDD
+        y lo recogera un worker cuando quede libre.
+    Args:
+        job_id (str): id del trabajo
+
+    Returns:
+        bool: True si se ha encolado
+    """
+    try:
+        _queue.put_nowait(job_id)
+        return True
+    except queue.Full:
+        return False
+
+def start_workers(n_workers: int = None, queue_size: int = None, poll_interval: float = None):
+    """
+        Arranca el pool acotado de workers que procesan los trabajos de registro de imagenes.
+        Antes recupera los trabajos que quedaron running o pending al detenerse el proceso.
+        La configuracion se lee de las variables de entorno JOBS_WORKERS (2), JOBS_QUEUE_SIZE (100)
+        y JOBS_POLL_INTERVAL (5 segundos).
+    Args:
+        n_workers (int): numero de workers
+        queue_size (int): tamaño maximo de la cola en memoria
+        poll_interval (float): segundos entre consultas de trabajos pending a la BBDD cuando la cola esta vacia
+    """
+    global _queue
+    n_workers = n_workers if n_workers is not None else int(os.environ.get("JOBS_WORKERS", 2))
+    queue_size = queue_size if queue_size is not None else int(os.environ.get("JOBS_QUEUE_SIZE", 100))
+    poll_interval = poll_interval if poll_interval is not None else float(os.environ.get("JOBS_POLL_INTERVAL", 5))
+    with _lock:
+        if len(_workers)>0:
+            return
+        _queue = queue.Queue(maxsize=queue_size)
+        try:
+            # Recuperamos los trabajos interrumpidos y los pendientes
+            recovered = models.reset_running_jobs(_now())
+            pending = models.get_pending_job_ids(queue_size)
+            for job_id in pending:
+                _enqueue(job_id)
+            logging.info(f"Trabajos recuperados: {recovered} running, {len(pending)} pending")
+        except (BBDDConexionError, BBDDObjetoError) as error:
+            logging.error(f"No se han podido recuperar los trabajos pendientes: {error}")
+        for i in range(n_workers):
+            worker = threading.Thread(target=_worker, args=(poll_interval,), name=f"jobs-worker-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+def _worker(poll_interval: float):
+    """
+        Bucle de un worker: procesa los trabajos de la cola y, si esta vacia, los trabajos pending de la BBDD.
+    """
+    while True:
+        try:
+            job_id = _queue.get(timeout=poll_interval)
+        except queue.Empty:
+            job_id = None
+        try:
+            if job_id is None:
+                # Recogemos los trabajos que no cupieron en la cola
+                pending = models.get_pending_job_ids(1)
+                if len(pending)==0:
+                    continue
+                job_id = pending[0]
+            run_job(job_id)
+        except Exception as error:
+            logging.error(f"Error en el worker de trabajos: {error}")
+
+def submit(image_bin: bytes, min_confidence: int):
+    """
+        Guarda la imagen en la carpeta de imagenes, registra un trabajo pending para registrarla y lo encola.
+    Args:
+        image_bin (bytes): imagen en binario
+        min_confidence (int): confianza minima de los tags del resultado
+
+    Returns:
+        str: id del trabajo
+    """
+    # Comprobamos que existe el directorio de imagenes
+    assert os.path.exists(os.environ["IMAGE_FOLDER"]), "El directorio de imagenes no existe. Consulte con su admin"
+    job_id = str(uuid.uuid4())
+    path = os.path.abspath(os.path.join(os.environ["IMAGE_FOLDER"], f"job_{job_id}"))
+    # Guardamos la imagen y el trabajo antes de responder, para que sobreviva a un reinicio
+    models.save_image(image_bin, path)
+    return _register_job(job_id, path, min_confidence)
+
+def submit_file(source_path: str, min_confidence: int):
+    """
+        Como submit, para una imagen ya guardada en un fichero temporal de la carpeta de imagenes, que se mueve
+        al fichero del trabajo sin volver a escribirla.
+    Args:
+        source_path (str): path del fichero temporal con la imagen
+        min_confidence (int): confianza minima de los tags del resultado
+
+    Returns:
+        str: id del trabajo
+    """
+    job_id = str(uuid.uuid4())
+    path = os.path.abspath(os.path.join(os.environ["IMAGE_FOLDER"], f"job_{job_id}"))
+    models.move_image(source_path, path)
+    return _register_job(job_id, path, min_confidence)
+
+def _register_job(job_id: str, path: str, min_confidence: int):
+    """
+        Registra en la BBDD el trabajo de la imagen guardada en path y lo encola.
+    """
+    models.insert_job(job_id, path, min_confidence, _now())
+    metrics.incr("jobs_submitted")
+    if _queue is not None:
+        _enqueue(job_id)
+    return job_id
+
+def run_job(job_id: str):
+    """
+        Procesa un trabajo: registra la imagen y sus tags y guarda el resultado en la tabla jobs.
+        Si otro worker ya ha reclamado el trabajo no hace nada.
+        La imagen se registra con el id del trabajo: si el proceso se detuvo tras registrarla y antes de terminar el
+        trabajo (el fichero del trabajo ya se ha movido al almacen), al recuperarlo se termina con la imagen registrada.
+    Args:
+        job_id (str): id del trabajo
+    """
+    if not models.claim_job(job_id, _now()):
+        return
+    job = models.get_job(job_id)
+    try:
+        picture = models.get_image_by_id(job_id)
+        if picture:
+            storage.pop_location(picture)
+            picture["tags"] = controller.filter_tags(picture["tags"], job["min_confidence"])
+            response = picture
+        else:
+            image_bin = models.read_image(job["path"])
+            # El fichero del trabajo se mueve al almacen de imagenes
+            response = controller.register_image_bytes(image_bin, job["min_confidence"], source_path=job["path"],
+                                                        picture_id=job_id)
+    except Exception as error:
+        logging.error(f"Error en el trabajo {job_id}: {error}")
+        metrics.incr("jobs_error")
+        models.finish_job(job_id, "error", json.dumps({"description": str(error)}), _now())
+        return
+    models.finish_job(job_id, "done", json.dumps(response), _now())
+    metrics.incr("jobs_done")
+
+def get_job_status(job_id: str):
+    """
+        Devuelve el estado de un trabajo. Si no existe devuelve un dict vacio.
+    Args:
+        job_id (str): id del trabajo
+
+    Returns:
+        dict: con los campos:
+        - `id`: identificador del trabajo
+        - `status`: pending, running, done o error
+        - `created`, `updated`: fechas de creacion y ultima actualizacion
+        - `result`: si status es done, la imagen registrada con sus tags (id, size, date y tags)
+        - `description`: si status es error, la descripcion del error
+    """
+    job = models.get_job(job_id)
+    if not job:
+        return {}
+    response = {"id": job["id"], "status": job["status"], "created": job["created"], "updated": job["updated"]}
+    if job["status"] == "done":
+        response["result"] = json.loads(job["result"])
+    elif job["status"] == "error":
+        response["description"] = json.loads(job["result"])["description"]
+    return response
@@ -0,0 +1,191 @@
+import time
+import bisect
+import functools
+import threading
+
+# Metricas internas del proceso: contadores, resumenes (numero, suma y maximo de observaciones), histogramas por
+# etiquetas de las mismas observaciones y gauges
+_lock = threading.Lock()
+_counters = {}
+_summaries = {}
+_histograms = {}
+_gauges = {}
+_gauge_callbacks = {}
+# Limites superiores (en segundos) de los buckets de los histogramas
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def incr(name: str, value: float = 1):
+    """
+        Incrementa el contador name en value.
+    Args:
+        name (str): nombre del contador
+        value (float): incremento
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def observe(name: str, value: float, labels: dict = None):
+    """
+        Registra una observacion (por ejemplo una duracion en segundos) en el resumen name y en su histograma con las
+        etiquetas labels. El resumen agrega las observaciones de todas las etiquetas.
+    Args:
+        name (str): nombre del resumen
+        value (float): valor observado
+        labels (dict): etiquetas del histograma, por ejemplo {"status": "200"}
+    """
+    key = (name, tuple(sorted(labels.items())) if labels else ())
+    bucket = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        summary = _summaries.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        summary["count"] += 1
+        summary["sum"] += value
+        if value > summary["max"]:
+            summary["max"] = value
+        # Observaciones por bucket (el ultimo es +Inf) y suma de las observaciones
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0]*(len(BUCKETS) + 1) + [0.0]
+        histogram[bucket] += 1
+        histogram[-1] += value
+
+def timed(name: str, **labels):
+    """
+        Decorador que registra la duracion en segundos de cada llamada a la funcion decorada en el resumen name, con la
+        etiqueta function (nombre de la funcion) ademas de labels. Las llamadas que fallan tambien se registran.
+    Args:
+        name (str): nombre del resumen
+
+    Returns:
+        function: decorador
+    """
+    def decorator(func):
+        func_labels = dict(labels, function=func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, func_labels)
+        return wrapper
+    return decorator
+
+def add_gauge(name: str, value: float):
+    """
+        Suma value (negativo para restar) al gauge name, por ejemplo el numero de peticiones en curso.
+    Args:
+        name (str): nombre del gauge
+        value (float): incremento
+    """
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + value
+
+def register_gauge(name: str, callback):
+    """
+        Registra un gauge cuyo valor se obtiene llamando a callback al exportar las metricas (ver render_prometheus),
+        por ejemplo el estado del pool de conexiones.
+    Args:
+        name (str): nombre del gauge
+        callback (function): funcion sin argumentos que devuelve el valor del gauge
+    """
+    with _lock:
+        _gauge_callbacks[name] = callback
+
+def get_counter(name: str):
+    """
+        Devuelve el valor del contador name, 0 si no existe.
+    Args:
+        name (str): nombre del contador
+
+    Returns:
+        float: valor del contador
+    """
+    with _lock:
+        return _counters.get(name, 0)
+
+def get_summary(name: str):
+    """
+        Devuelve el resumen name con las claves count, sum, max y mean.
+    Args:
+        name (str): nombre del resumen
+
+    Returns:
+        dict: resumen de las observaciones
+    """
+    with _lock:
+        summary = dict(_summaries.get(name, {"count": 0, "sum": 0.0, "max": 0.0}))
+    summary["mean"] = summary["sum"]/summary["count"] if summary["count"] > 0 else 0.0
+    return summary
+
+def snapshot():
+    """
+        Devuelve una copia de todos los contadores y resumenes.
+
+    Returns:
+        dict: con las claves counters y summaries
+    """
+    with _lock:
+        names = list(_summaries.keys())
+        counters = dict(_counters)
+    return {"counters": counters, "summaries": {name: get_summary(name) for name in names}}
+
+def _prometheus_name(prefix: str, name: str):
+    return prefix + "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+
+def _prometheus_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prometheus_labels(labels, extra: tuple = ()):
+    labels = tuple(labels) + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_prometheus_escape(value)}"' for key, value in labels) + "}"
+
+def render_prometheus(prefix: str = "image_tags_"):
+    """
+        Devuelve todas las metricas en el formato de texto de Prometheus: los contadores como counter (<name>_total),
+        las observaciones como histogram por etiquetas y los gauges como gauge. Los gauges con callback que fallan
+        se omiten.
+    Args:
+        prefix (str): prefijo de los nombres de las metricas
+
+    Returns:
+        str: metricas en formato de texto de Prometheus (version 0.0.4)
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(histogram) for key, histogram in _histograms.items()}
+        gauges = dict(_gauges)
+        callbacks = dict(_gauge_callbacks)
+    for name, callback in callbacks.items():
+        try:
+            gauges[name] = callback()
+        except Exception:
+            pass
+
+    lines = []
+    for name in sorted(counters):
+        metric = _prometheus_name(prefix, name) + "_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {counters[name]}"]
+    # Los histogramas de un mismo nombre se agrupan bajo una unica cabecera TYPE
+    by_name = {}
+    for (name, labels), value in histograms.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        metric = _prometheus_name(prefix, name)
+        lines.append(f"# TYPE {metric} histogram")
+        for labels, histogram in sorted(by_name[name]):
+            buckets, total_sum = histogram[:-1], histogram[-1]
+            cumulative, total = 0, sum(buckets)
+            for bound, count in zip(BUCKETS, buckets):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_prometheus_labels(labels, (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{metric}_bucket{_prometheus_labels(labels, (('le', '+Inf'),))} {total}")
+            lines.append(f"{metric}_sum{_prometheus_labels(labels)} {total_sum}")
+            lines.append(f"{metric}_count{_prometheus_labels(labels)} {total}")
+    for name in sorted(gauges):
+        metric = _prometheus_name(prefix, name)
+        lines += [f"# TYPE {metric} gauge", f"{metric} {gauges[name]}"]
+    return "\n".join(lines) + "\n"
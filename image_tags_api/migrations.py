@@ -0,0 +1,163 @@
+import os
+import re
+import logging
+import argparse
+
+from sqlalchemy import text
+from sqlalchemy import exc
+
+from . import models
+
+# Migraciones versionadas del esquema: scripts/migracion_<version>_<nombre>.sql, aplicadas en orden de version.
+# Las versiones aplicadas se registran en la tabla schema_version.
+MIGRATION_PATTERN = re.compile(r"^migracion_(\d+)_(\w+)\.sql$")
+SCHEMA_VERSION_DDL = ("CREATE TABLE IF NOT EXISTS schema_version (version INT PRIMARY KEY, name VARCHAR(128) NOT NULL, "
+                      "applied DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+
+
+def get_migrations_folder():
+    """
+        Devuelve la carpeta de los scripts de migracion: MIGRATIONS_FOLDER o, por defecto, la carpeta scripts del repositorio.
+
+    Returns:
+        str: path de la carpeta
+    """
+    return os.environ.get("MIGRATIONS_FOLDER",
+                          os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+def list_migrations(folder: str = None):
+    """
+        Devuelve las migraciones de la carpeta folder ordenadas por version.
+    Args:
+        folder (str): carpeta de los scripts. Por defecto get_migrations_folder()
+
+    Returns:
+        list: tuplas (version, nombre, path)
+    """
+    folder = folder or get_migrations_folder()
+    migrations = []
+    for filename in os.listdir(folder):
+        match = MIGRATION_PATTERN.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(folder, filename)))
+    return sorted(migrations)
+
+def split_statements(sql: str):
+    """
+        Divide un script sql en sentencias separadas por `;`, eliminando los comentarios de linea (`--`).
+    Args:
+        sql (str): contenido del script
+
+    Returns:
+        list: sentencias
+    """
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+def get_applied_versions():
+    """
+        Devuelve las versiones registradas en schema_version, un conjunto vacio si la tabla no existe.
+
+    Returns:
+        set: versiones aplicadas
+    """
+    try:
+        with models.connect() as conn:
+            return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+    except (exc.ProgrammingError, exc.OperationalError):
+        return set()
+
+def record_version(conn, version: int, name: str):
+    """
+        Registra la version en schema_version si el script no la ha registrado.
+    """
+    if conn.execute(text("SELECT COUNT(*) FROM schema_version WHERE version=:version"), {"version": version}).scalar() == 0:
+        conn.execute(text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"), {"version": version, "name": name})
+
+def apply_migration(version: int, name: str, path: str):
+    """
+        Aplica las sentencias del script de una migracion y registra su version.
+        En MySQL las sentencias DDL no son transaccionales: si una sentencia falla, las anteriores quedan aplicadas y
+        la version no se registra.
+    Args:
+        version (int): version de la migracion
+        name (str): nombre de la migracion
+        path (str): path del script
+    """
+    with open(path, "r") as f:
+        statements = split_statements(f.read())
+    with models.connect() as conn:
+        for statement in statements:
+            conn.exec_driver_sql(statement)
+        record_version(conn, version, name)
+        conn.commit()
+
+def upgrade(target: int = None):
+    """
+        Aplica en orden las migraciones pendientes hasta la version target (por defecto todas).
+    Args:
+        target (int): version maxima a aplicar
+
+    Returns:
+        list: versiones aplicadas
+    """
+    with models.connect() as conn:
+        conn.execute(text(SCHEMA_VERSION_DDL))
+        conn.commit()
+    applied = get_applied_versions()
+    done = []
+    for version, name, path in list_migrations():
+        if version in applied or (target is not None and version > target):
+            continue
+        logging.info(f"Aplicando la migracion {version} ({name})")
+        apply_migration(version, name, path)
+        done.append(version)
+    return done
+
+def baseline(version: int):
+    """
+        Registra como aplicadas, sin ejecutarlas, las migraciones hasta version. Se usa en una BBDD creada con esas
+        migraciones antes de existir la tabla schema_version.
+    Args:
+        version (int): ultima version aplicada
+
+    Returns:
+        list: versiones registradas
+    """
+    with models.connect() as conn:
+        conn.execute(text(SCHEMA_VERSION_DDL))
+        recorded = []
+        for migration_version, name, _ in list_migrations():
+            if migration_version <= version:
+                record_version(conn, migration_version, name)
+                recorded.append(migration_version)
+        conn.commit()
+    return recorded
+
+def status():
+    """
+        Devuelve el estado de cada migracion.
+
+    Returns:
+        list: dict con las claves version, name y applied
+    """
+    applied = get_applied_versions()
+    return [{"version": version, "name": name, "applied": version in applied} for version, name, _ in list_migrations()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migraciones versionadas del esquema de la BBDD")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="muestra las migraciones y si estan aplicadas")
+    upgrade_parser = subparsers.add_parser("upgrade", help="aplica las migraciones pendientes")
+    upgrade_parser.add_argument("--to", type=int, default=None, help="version maxima a aplicar")
+    baseline_parser = subparsers.add_parser("baseline", help="registra como aplicadas las migraciones hasta version")
+    baseline_parser.add_argument("version", type=int)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "status":
+        for migration in status():
+            print(f"{migration['version']:>4} {migration['name']:<32} {'aplicada' if migration['applied'] else 'pendiente'}")
+    elif args.command == "upgrade":
+        print(f"Migraciones aplicadas: {upgrade(args.to)}")
+    else:
+        print(f"Migraciones registradas: {baseline(args.version)}")
@@ -2,18 +2,125 @@ from typing import List
 
 from imagekitio import ImageKit
 import requests
+from requests.adapters import HTTPAdapter
 
 from sqlalchemy import create_engine
 from sqlalchemy import text
 from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
 
 import os
+import time
+import uuid
+import hashlib
+import datetime
+import threading
+from contextlib import contextmanager
+
+from . import metrics, cache, config
+from .resilience import CircuitBreaker, retry_call
 from .appexceptions import BBDDConexionError, BBDDObjetoError
 
+# Engine de la base de datos compartido por todo el proceso (ver init_engine)
+_engine = None
+_engine_lock = threading.RLock()
+
+# Sesion HTTP y cliente de Imagekitio compartidos por todo el proceso (ver get_http_session y get_imagekit)
+_http_session = None
+_imagekit = None
+_http_lock = threading.Lock()
+# Circuit breakers de los servicios externos
+imagga_breaker = CircuitBreaker("imagga")
+imagekit_breaker = CircuitBreaker("imagekit")
+# Urls base de Imagekitio. Con IMAGEKIT_API_URL (ver config) las llamadas se dirigen a otro servidor, por ejemplo
+# uno simulado en los benchmarks
+IMAGEKIT_BASE_URLS = ("https://api.imagekit.io", "https://upload.imagekit.io")
+# Confianza minima (excluida) por defecto de los tags de las consultas, la misma que al registrar las imagenes
+DEFAULT_MIN_CONFIDENCE = 80
+# Confianza minima (excluida) de los tags que agrega tag_stats. Es fija: las filas de tag_stats se calcularon con este
+# valor (ver scripts/migracion_10_estadisticas_tags_confianza.sql) y cambiarlo requiere una migracion que las recalcule.
+# Coincide con DEFAULT_MIN_CONFIDENCE para que GET /tags use el rollup por defecto; con otra confianza minima las
+# estadisticas se agregan de la tabla tags
+TAG_STATS_MIN_CONFIDENCE = 80
+
 
 #
-# Funciones de 
+# Funciones de acceso a los servicios externos
 #
+def get_http_timeout():
+    """
+        Devuelve los timeouts de conexion y de lectura de las llamadas a los servicios externos,
+        configurables con HTTP_CONNECT_TIMEOUT (3.05 segundos) y HTTP_READ_TIMEOUT (30 segundos) (ver config).
+
+    Returns:
+        tuple: (timeout de conexion, timeout de lectura)
+    """
+    settings = config.get_settings()
+    return (settings.http_connect_timeout, settings.http_read_timeout)
+
+def get_http_session():
+    """
+        Devuelve la sesion HTTP compartida por el proceso para las llamadas a Imagga e Imagekitio, que mantiene
+        un pool de conexiones keep-alive de HTTP_POOL_SIZE conexiones (10) por host (ver config).
+
+    Returns:
+        requests.Session: sesion HTTP
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_lock:
+            if _http_session is None:
+                pool_size = config.get_settings().http_pool_size
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+                session.mount("http://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+                _http_session = session
+    return _http_session
+
+def _imagekit_request(method, url, headers, params=None, files=None, data=None):
+    """
+        Sustituye a ImageKitRequest.request para que el cliente de Imagekitio use la sesion HTTP compartida y los timeouts.
+        Si se configura IMAGEKIT_API_URL, sustituye por ella la url base de la API y de subida de Imagekitio.
+    """
+    imagekit_api_url = config.get_settings().imagekit_api_url
+    if imagekit_api_url:
+        for base_url in IMAGEKIT_BASE_URLS:
+            if url.startswith(base_url):
+                url = imagekit_api_url + url[len(base_url):]
+    return get_http_session().request(method=method, url=url, params=params, files=files, data=data,
+                                      headers=headers, timeout=get_http_timeout())
+
+def get_imagekit():
+    """
+        Devuelve el cliente de Imagekitio compartido por el proceso.
+
+    Returns:
+        ImageKit: cliente de Imagekitio
+    """
+    global _imagekit
+    if _imagekit is None:
+        with _http_lock:
+            if _imagekit is None:
+                settings = config.get_settings()
+                imagekit = ImageKit(
+                    public_key=settings.imagekit_public_key,
+                    private_key=settings.imagekit_private_key,
+                    url_endpoint = settings.imagekit_url_endpoint
+                )
+                imagekit.ik_request.request = _imagekit_request
+                _imagekit = imagekit
+    return _imagekit
+
+def get_breakers_status():
+    """
+        Devuelve el estado de los circuit breakers de los servicios externos.
+
+    Returns:
+        dict: estado de cada circuito (ver CircuitBreaker.status)
+    """
+    return {"imagga": imagga_breaker.status(), "imagekit": imagekit_breaker.status()}
+
+@metrics.timed("external_call_seconds")
 def delete_image_url(file_id):
     """
     Delete the image from imagekitio.
@@ -24,18 +131,12 @@ def delete_image_url(file_id):
     Returns:
         response: respuesta de Imagekitio
     """
-    # Connec to  imagekitio
-    imagekit = ImageKit(
-        public_key=os.environ["IMAGEKIT_PUBLIC_KEY"],
-        private_key=os.environ["IMAGEKIT_PRIVATE_KEY"],
-        url_endpoint = os.environ["IMAGEKIT_URL_ENDPOINT"]
-    )
-    
     # Delete the image from  imagekitio
-    delete = imagekit.delete_file(file_id=file_id)
+    delete = imagekit_breaker.call(retry_call, get_imagekit().delete_file, file_id=file_id)
     
     return delete
     
+@metrics.timed("external_call_seconds")
 def get_image_url(imagenb64: str, filename: str):
     """
         Upload la imagen en base 64 imagenb64 a Imagekitio con el nombre filename.
@@ -47,18 +148,24 @@ def get_image_url(imagenb64: str, filename: str):
     Returns:
         json: respuesta del metodo upload de Imagekitio
     """
-    # Upload the image to imagekitio
-    imagekit = ImageKit(
-        public_key=os.environ["IMAGEKIT_PUBLIC_KEY"],
-        private_key=os.environ["IMAGEKIT_PRIVATE_KEY"],
-        url_endpoint = os.environ["IMAGEKIT_URL_ENDPOINT"]
-    )
-
-    # upload the image to imagekitio
-    upload_info = imagekit.upload(file=imagenb64, file_name=filename)
+    # upload the image to imagekitio. No se reintenta tras un timeout de lectura para no duplicar la subida
+    upload_info = imagekit_breaker.call(retry_call, get_imagekit().upload, file=imagenb64, file_name=filename,
+                                        idempotent=False)
     # Devuelve la url publica de la imagen
     return upload_info
 
+def _imagga_tags(method: str, **kwargs):
+    """
+        Invoca el endpoint de tags de Imagga y devuelve la lista de tags de la respuesta.
+    """
+    settings = config.get_settings()
+    response = get_http_session().request(method, f"{settings.imagga_api_url}/v2/tags",
+                                          auth=(settings.imagga_api_key, settings.imagga_api_secret),
+                                          timeout=get_http_timeout(), **kwargs)
+    response.raise_for_status()
+    return response.json()["result"]["tags"]
+
+@metrics.timed("external_call_seconds")
 def get_tags_url(image_url: str):
     """
         Devuelve las tags de una imagen (imagen_url) invocando la API de Imagga       
@@ -71,22 +178,179 @@ def get_tags_url(image_url: str):
             -confidence
     """
     # Requests the tags of the image to imagga
-    response = requests.get(f"https://api.imagga.com/v2/tags?image_url={image_url}", auth=(os.environ["IMAGGAN_API_KEY"], os.environ["IMAGGAN_API_SECRET"]))
+    result = imagga_breaker.call(retry_call, _imagga_tags, "GET", params={"image_url": image_url})
     # Define the list of tags with confidence > min_confidence
     tags = [
         {
             "tag": t["tag"]["en"],
             "confidence": t["confidence"]
         }
-        for t in response.json()["result"]["tags"]
+        for t in result
     ]    
     # Devuelve los tags de la imagen
     return tags
 
+@metrics.timed("external_call_seconds")
+def get_tags_bytes(image_bin: bytes, filename: str):
+    """
+        Devuelve las tags de una imagen enviandola directamente a la API de Imagga en el body de la peticion
+    Args:
+        image_bin (bytes): imagen en binario
+        filename (str): nombre de la imagen
+
+    Returns:
+        list: lista de tags: cada elemento es un Dict con claves:
+            - tag
+            -confidence
+    """
+    # Requests the tags of the image to imagga
+    result = imagga_breaker.call(retry_call, _imagga_tags, "POST", files={"image": (filename, image_bin)})
+    tags = [
+        {
+            "tag": t["tag"]["en"],
+            "confidence": t["confidence"]
+        }
+        for t in result
+    ]
+    # Devuelve los tags de la imagen
+    return tags
+
 #
 # Funciones para el acceso a la base de datos
 #
-def insert_picture_tags(myuuid: str, date: str, path: str, size: int, tags: List):
+def id_to_db(picture_id: str):
+    """
+        Convierte el id de una imagen (uuid en texto) al formato de la BBDD, BINARY(16).
+    Args:
+        picture_id (str): id de la imagen
+
+    Returns:
+        bytes: id de la imagen en binario
+    """
+    return uuid.UUID(picture_id).bytes
+
+def id_from_db(value):
+    """
+        Convierte el id de una imagen leido de la BBDD (BINARY(16)) a uuid en texto.
+    Args:
+        value (bytes): id de la imagen en binario
+
+    Returns:
+        str: id de la imagen
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return str(uuid.UUID(bytes=bytes(value)))
+    return value
+
+def date_from_db(value):
+    """
+        Convierte una fecha leida de la BBDD (DATETIME) a texto en formato %Y-%m-%d %H:%M:%S.
+    Args:
+        value (datetime): fecha
+
+    Returns:
+        str: fecha en texto
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+def get_connection_str():
+    """
+        Devuelve la cadena de conexion a la base de datos.
+        Si existe la variable de entorno DATABASE_URL se usa directamente, en otro caso se construye
+        a partir de las variables MYSQL_*.
+
+    Returns:
+        str: cadena de conexion de SQLAlchemy
+    """
+    if os.environ.get("DATABASE_URL"):
+        return os.environ["DATABASE_URL"]
+    return f"mysql+pymysql://{os.environ['MYSQL_USERNAME']}:{ os.environ['MYSQL_USER_PASSWORD']}@{os.environ['MYSQL_SERVER']}/{ os.environ['MYSQL_USER_DATABASE']}"
+
+def init_engine(connection_str: str = None):
+    """
+        Crea el engine de la base de datos compartido por todo el proceso, con un pool de conexiones acotado (QueuePool).
+        La configuracion del pool se lee de variables de entorno:
+            - DB_POOL_SIZE: conexiones permanentes del pool (5)
+            - DB_MAX_OVERFLOW: conexiones adicionales permitidas por encima de DB_POOL_SIZE (10)
+            - DB_POOL_TIMEOUT: segundos maximos de espera para obtener una conexion del pool (30)
+            - DB_POOL_RECYCLE: segundos tras los que se recicla una conexion (1800)
+            - DB_POOL_PRE_PING: comprueba la conexion antes de usarla (true)
+        Si ya existia un engine se libera su pool.
+    Args:
+        connection_str (str): cadena de conexion. Por defecto get_connection_str()
+
+    Returns:
+        obj: engine de la bd
+    """
+    global _engine
+    engine = create_engine(connection_str or get_connection_str(),
+                           poolclass=QueuePool,
+                           pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+                           max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+                           pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+                           pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+                           pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"))
+    with _engine_lock:
+        old_engine, _engine = _engine, engine
+    if old_engine is not None:
+        old_engine.dispose()
+    # Estado del pool de conexiones, exportado en /metrics
+    metrics.register_gauge("db_pool_size", lambda: get_engine().pool.size())
+    metrics.register_gauge("db_pool_checked_out", lambda: get_engine().pool.checkedout())
+    metrics.register_gauge("db_pool_checked_in", lambda: get_engine().pool.checkedin())
+    metrics.register_gauge("db_pool_overflow", lambda: get_engine().pool.overflow())
+
+    return engine
+
+def get_engine():
+    """
+        Devuelve el engine compartido de la base de datos, creandolo si todavia no existe.
+
+    Returns:
+        obj: engine de la bd
+    """
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                init_engine()
+    return _engine
+
+@contextmanager
+def connect():
+    """
+        Obtiene una conexion del pool del engine compartido y la devuelve al pool al terminar.
+        Registra el tiempo de espera para obtener la conexion en la metrica db_pool_checkout_seconds.
+
+    Returns:
+        obj: conexion de la bd
+    """
+    start = time.perf_counter()
+    conn = get_engine().connect()
+    metrics.observe("db_pool_checkout_seconds", time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def get_pool_status():
+    """
+        Devuelve el estado del pool de conexiones del engine compartido.
+        Permite dimensionar los threads de waitress frente al tamaño del pool.
+
+    Returns:
+        dict: con las claves pool_size, max_overflow, timeout, checked_out, checked_in, overflow y checkout_wait
+        (numero de esperas, tiempo total, maximo y medio en segundos)
+    """
+    pool = get_engine().pool
+    return {"pool_size": pool.size(), "max_overflow": pool._max_overflow, "timeout": pool.timeout(),
+            "checked_out": pool.checkedout(), "checked_in": pool.checkedin(), "overflow": pool.overflow(),
+            "checkout_wait": metrics.get_summary("db_pool_checkout_seconds")}
+
+@metrics.timed("db_query_seconds")
+def insert_picture_tags(myuuid: str, date: str, path: str, size: int, tags: List, hash: str = None, min_confidence: int = None,
+                        location: dict = None):
     """
         Inserta una imagen en la tabla Pictures y sus tags asociados en la tabla Tags
     Args:
@@ -95,29 +359,104 @@ def insert_picture_tags(myuuid: str, date: str, path: str, size: int, tags: List
         path (str): path local de la imagen
         size (int): tamaño en bytes de la imagen
         tags (List): lista de tags y su confidence
+        hash (str): hash SHA-256 del contenido de la imagen
+        min_confidence (int): confianza minima con la que se filtraron los tags guardados
+        location (dict): ubicacion de la imagen en el almacen de segmentos (claves segment, seg_offset y seg_length)
 
     Returns:
         obj: engine de la bd
     """
-    # Definimos la conexion a la base de datos
-    connection_str=f"mysql+pymysql://{os.environ['MYSQL_USERNAME']}:{ os.environ['MYSQL_USER_PASSWORD']}@{os.environ['MYSQL_SERVER']}/{ os.environ['MYSQL_USER_DATABASE']}"
-    tags_db=[{"tag": t['tag'], "picture_id": myuuid, "confidence": t['confidence'], "date": date} for t in tags]
+    location = location or {}
+    picture_id = id_to_db(myuuid)
+    tags_db=[{"tag": t['tag'], "picture_id": picture_id, "confidence": t['confidence'], "date": date} for t in tags]
     try:
-        # Creamos la conexion a la base de datos
-        engine = create_engine(connection_str)
         # Ejecutamos las sentencias sql para insertar la imagen y sus tags en la base de datos en una transaccion
-        with engine.connect() as conn:
-            conn.execute(text("INSERT INTO pictures (id,path,date, size) VALUES (:id, :path, :date, :size)"), {"id": myuuid, "path": path, "date": date, "size": size})
-            conn.execute(text("INSERT INTO tags (tag,picture_id,confidence,date) VALUES (:tag, :picture_id, :confidence, :date)"), tags_db)
+        with connect() as conn:
+            conn.execute(text("INSERT INTO pictures (id,path,date, size, hash, min_confidence, segment, seg_offset, seg_length) VALUES (:id, :path, :date, :size, :hash, :min_confidence, :segment, :seg_offset, :seg_length)"),
+                         {"id": picture_id, "path": path, "date": date, "size": size, "hash": hash, "min_confidence": min_confidence,
+                          "segment": location.get("segment"), "seg_offset": location.get("seg_offset"),
+                          "seg_length": location.get("seg_length")})
+            # Una imagen puede no tener tags por encima de min_confidence
+            if len(tags_db)>0:
+                conn.execute(text("INSERT INTO tags (tag,picture_id,confidence,date) VALUES (:tag, :picture_id, :confidence, :date)"), tags_db)
+                # Sumamos sus tags a las estadisticas por tag y dia, en la misma transaccion
+                conn.execute(text(set_sql_tag_stats_upsert(" WHERE t.picture_id=:picture_id")), {"picture_id": picture_id})
             conn.commit()
+        # Las respuestas cacheadas de GET /images y GET /tags dejan de ser validas
+        cache.bump_generation()
             
-        return engine
+        return get_engine()
+    except exc.TimeoutError as error:
+        raise BBDDConexionError(f"No hay conexiones libres en el pool de la BBDD. Error de conexión: {error}")
     except exc.OperationalError as error:
         raise BBDDConexionError(f"Verifique credenciales de acceso a BBDD. Error de conexión: {error}")
     except exc.ProgrammingError as error:
         raise BBDDObjetoError(f"Verifique la existencia de los objetos de BBDD. Error de Objeto de la BBDD: {error}")
     
 
+@metrics.timed("db_query_seconds")
+def insert_pictures_tags_bulk(pictures: List):
+    """
+        Inserta un lote de imagenes en la tabla Pictures y sus tags en la tabla Tags en una unica transaccion,
+        con una sentencia INSERT ejecutada sobre todos los registros de cada tabla (executemany).
+    Args:
+        pictures (List): lista de dict con las claves id, path, date, size, hash, min_confidence y tags,
+            y opcionalmente segment, seg_offset y seg_length
+
+    Returns:
+        obj: engine de la bd
+    """
+    pictures_db=[{"id": id_to_db(p["id"]), "path": p["path"], "date": p["date"], "size": p["size"], "hash": p["hash"],
+                  "min_confidence": p["min_confidence"], "segment": p.get("segment"), "seg_offset": p.get("seg_offset"),
+                  "seg_length": p.get("seg_length")} for p in pictures]
+    tags_db=[{"tag": t['tag'], "picture_id": id_to_db(p["id"]), "confidence": t['confidence'], "date": p["date"]}
+             for p in pictures for t in p["tags"]]
+    try:
+        with connect() as conn:
+            conn.execute(text("INSERT INTO pictures (id,path,date, size, hash, min_confidence, segment, seg_offset, seg_length) VALUES (:id, :path, :date, :size, :hash, :min_confidence, :segment, :seg_offset, :seg_length)"), pictures_db)
+            if len(tags_db)>0:
+                conn.execute(text("INSERT INTO tags (tag,picture_id,confidence,date) VALUES (:tag, :picture_id, :confidence, :date)"), tags_db)
+                # Sumamos sus tags a las estadisticas por tag y dia, en la misma transaccion
+                ids = {f"picture_id_{i}": id_to_db(p["id"]) for i, p in enumerate(pictures) if len(p["tags"])>0}
+                conn.execute(text(set_sql_tag_stats_upsert(f" WHERE t.picture_id IN ({', '.join(':'+k for k in ids)})")), ids)
+            conn.commit()
+        # Las respuestas cacheadas de GET /images y GET /tags dejan de ser validas
+        cache.bump_generation()
+
+        return get_engine()
+    except exc.TimeoutError as error:
+        raise BBDDConexionError(f"No hay conexiones libres en el pool de la BBDD. Error de conexión: {error}")
+    except exc.OperationalError as error:
+        raise BBDDConexionError(f"Verifique credenciales de acceso a BBDD. Error de conexión: {error}")
+    except exc.ProgrammingError as error:
+        raise BBDDObjetoError(f"Verifique la existencia de los objetos de BBDD. Error de Objeto de la BBDD: {error}")
+
+def set_sql_date_filter(min_date: str, max_date: str, column: str = "p.date"):
+    """
+        Define la clausula WHERE para filtrar por fecha de registro entre min_date y max_date
+    Args:
+        min_date (str): fecha minima de creacion
+        max_date (str): fecha máxima de creacion
+        column (str): columna de fecha sobre la que se filtra
+
+    Returns:
+        str: clausula where (vacia si no hay filtros)
+        dict: parametros de la clausula
+    """
+    conditions=[]
+    params={}
+    # Si min_date es diferente de vacio, añadimos el filtro
+    if min_date!='':
+        conditions.append(f"{column}>:min_date")
+        params["min_date"] = min_date
+    # Si max_date es diferente de vacio, añadimos el filtro
+    if max_date!='':
+        conditions.append(f"{column}<:max_date")
+        params["max_date"] = max_date
+
+    where = " WHERE " + " AND ".join(conditions) if len(conditions)>0 else ""
+    return where, params
+
 def set_sql_pictures_by_date(min_date: str, max_date: str):
     """
         Define la sentencia SELECT para extraer las imagenes cuya fecha de registro esté entre min_date y max_date
@@ -130,23 +469,110 @@ def set_sql_pictures_by_date(min_date: str, max_date: str):
     """
     # Definimos la select base
     sql = "SELECT `id`, `date`, `size` FROM `pictures` p"
-    params=()
-    # Si min_date y max_date son diferentes de vacio, añadimos los filtros a la select base
-    if min_date!='' and max_date!='':
-        sql = sql + " WHERE p.date>:min_date AND p.date<:max_date"
-        params = {"min_date": min_date, "max_date":max_date}
-    # Si min_date es diferente de vacio, añadimos el filtro a la select bas
-    elif min_date!='':
-        sql = sql + " WHERE p.date>:min_date"
-        params = {"min_date": min_date}
-    # Si max_date es diferente de vacio, añadimos el filtro a la select bas
-    elif max_date!='':
-        sql = sql + " WHERE p.date<:max_date"
-        params = {"max_date":max_date}
-        
-    sql += " ORDER BY p.date DESC"
+    # Añadimos los filtros de fecha a la select base
+    where, params = set_sql_date_filter(min_date, max_date)
+    sql += where + " ORDER BY p.date DESC"
     return sql,params
 
+def set_sql_pictures_tags_by_date(min_date: str, max_date: str, tags: List = None, limit: int = None, after: tuple = None,
+                                  min_confidence: int = None):
+    """
+        Define la sentencia SELECT que extrae en una sola consulta las imagenes cuya fecha de registro esté entre min_date y max_date
+        junto con sus tags (LEFT JOIN de pictures y tags). Cada fila contiene id, date, size, tag y confidence; las imagenes
+        sin tags aparecen en una fila con tag y confidence a NULL.
+        Si se indican tags, solo se devuelven las imagenes que tienen todas ellas. El filtro se resuelve en la BBDD con
+        `tag IN (...) GROUP BY picture_id HAVING COUNT(DISTINCT tag)=k` sobre el indice (tag, picture_id) de tags.
+        Si se indica min_confidence, solo se devuelven los tags con confidence mayor y el filtro por tags solo considera
+        esos tags, recorriendo el indice (tag, confidence) de tags.
+        Las imagenes se ordenan por (date, id) descendente. Para paginar se usa keyset pagination: se devuelven como maximo
+        limit imagenes posteriores en ese orden a la imagen after, de forma que el coste no depende de la profundidad de la pagina.
+    Args:
+        min_date (str): fecha minima de creacion
+        max_date (str): fecha máxima de creacion
+        tags (List): lista de tags que debe tener la imagen
+        limit (int): numero maximo de imagenes a devolver. Por defecto todas
+        after (tuple): (date, id) de la ultima imagen de la pagina anterior
+        min_confidence (int): confianza minima (excluida) de los tags. Por defecto todos los tags
+
+    Returns:
+        str: sentencia select
+    """
+    # Condicion de confianza minima de los tags
+    confidence = " AND {alias}.`confidence`>:min_confidence" if min_confidence is not None else ""
+    # Definimos la select base de imagenes
+    sql = "SELECT p.`id`, p.`date`, p.`size` FROM `pictures` p"
+    # Añadimos los filtros de fecha a la select base
+    where, params = set_sql_date_filter(min_date, max_date)
+    # Si hay tags, partimos de las picture_id que tienen todas ellas
+    if tags:
+        tag_params = {f"tag_{i}": tag for i, tag in enumerate(tags)}
+        sql = ("SELECT p.`id`, p.`date`, p.`size` FROM "
+               "(SELECT tf.`picture_id` FROM `tags` tf WHERE tf.`tag` IN (" + ", ".join(f":{name}" for name in tag_params) + ")"
+               + confidence.format(alias="tf") + " GROUP BY tf.`picture_id` HAVING COUNT(DISTINCT tf.`tag`)=:n_tags) f "
+               "JOIN `pictures` p ON p.id = f.picture_id")
+        params.update(tag_params)
+        params["n_tags"] = len(tags)
+    # Si hay cursor, continuamos a partir de la ultima imagen devuelta
+    if after is not None:
+        where += " AND " if where else " WHERE "
+        where += "(p.date<:after_date OR (p.date=:after_date AND p.id<:after_id))"
+        params["after_date"], params["after_id"] = after[0], id_to_db(after[1])
+    sql += where + " ORDER BY p.date DESC, p.id DESC"
+    if min_confidence is not None:
+        params["min_confidence"] = min_confidence
+    # Limitamos el numero de imagenes (no de filas de la JOIN)
+    if limit is not None:
+        sql += " LIMIT :limit"
+        params["limit"] = limit
+    # Añadimos las tags de las imagenes seleccionadas.
+    # Ordenamos tambien por id para que las filas de una misma imagen sean consecutivas
+    sql = ("SELECT p.`id`, p.`date`, p.`size`, t.`tag`, t.`confidence` FROM (" + sql + ") p "
+           "LEFT JOIN `tags` t ON t.picture_id = p.id" + confidence.format(alias="t") + " ORDER BY p.date DESC, p.id DESC")
+    return sql,params
+
+def group_pictures_tags(rows):
+    """
+        Agrupa las filas (id, date, size, tag, confidence) devueltas por la JOIN de pictures y tags en un listado de imagenes
+        con sus tags, respetando el orden de las filas.
+    Args:
+        rows (list): filas de la select
+
+    Returns:
+        list: dict con la clave id, date, size y tags.
+    """
+    pictures={}
+    for p_id, p_date, p_size, tag, confidence in rows:
+        picture = pictures.get(p_id)
+        if picture is None:
+            picture = pictures[p_id] = {"id": id_from_db(p_id), "date": date_from_db(p_date), "size": p_size, "tags": []}
+        # Las imagenes sin tags devuelven una fila con tag NULL
+        if tag is not None:
+            picture["tags"].append({"tag": tag, "confidence": confidence})
+
+    return list(pictures.values())
+
+def iter_group_pictures_tags(rows):
+    """
+        Version en streaming de group_pictures_tags: agrupa las filas (id, date, size, tag, confidence), que deben llegar
+        con las filas de cada imagen consecutivas, y devuelve cada imagen en cuanto se completa.
+    Args:
+        rows (iterable): filas de la select
+
+    Returns:
+        generator: dict con la clave id, date, size y tags.
+    """
+    picture, current_id = None, None
+    for p_id, p_date, p_size, tag, confidence in rows:
+        if picture is None or current_id!=p_id:
+            if picture is not None:
+                yield picture
+            picture, current_id = {"id": id_from_db(p_id), "date": date_from_db(p_date), "size": p_size, "tags": []}, p_id
+        # Las imagenes sin tags devuelven una fila con tag NULL
+        if tag is not None:
+            picture["tags"].append({"tag": tag, "confidence": confidence})
+    if picture is not None:
+        yield picture
+
 def run_query(sql, params):
     """
         Ejecuta una sentencia select en la base de datos y devuelve el resultado
@@ -158,22 +584,68 @@ def run_query(sql, params):
         list: cada elemento es un registro devuelto por la select en forma de dict la clave el nombre de la columna y el valor de esa columna
     """
     try:
-        # Definimos la conexion a la base de datos
-        connection_str=f"mysql+pymysql://{os.environ['MYSQL_USERNAME']}:{ os.environ['MYSQL_USER_PASSWORD']}@{os.environ['MYSQL_SERVER']}/{ os.environ['MYSQL_USER_DATABASE']}"
-        # Creamos la conexion a la base de datos
-        engine = create_engine(connection_str)
-        # Obtenemos las imagenes de la base de datos
-        with engine.connect() as conn:
+        # Obtenemos una conexion del pool compartido
+        with connect() as conn:
             # Obtenemos las picture_id de las imagenes que cumplan con los filtros de min y max date
-            result = conn.execute(text(sql), params)
+            result = conn.execute(text(sql), params).all()
                             
-        return result.all()
+        return result
+    except exc.TimeoutError as error:
+        raise BBDDConexionError(f"No hay conexiones libres en el pool de la BBDD. Error de conexión: {error}")
+    except exc.OperationalError as error:
+        raise BBDDConexionError(f"Verifique credenciales de acceso a BBDD. Error de conexión: {error}")
+    except exc.ProgrammingError as error:
+        raise BBDDObjetoError(f"Verifique la existencia de los objetos de BBDD. Error de Objeto de la BBDD: {error}")
+
+def run_statement(sql, params):
+    """
+        Ejecuta una sentencia de modificacion (INSERT, UPDATE o DELETE) en la base de datos en una transaccion
+    Args:
+        sql (str): sentencia a ejecutar
+        params (dict | list): parametros de la sentencia, o lista de parametros para ejecutarla sobre varios registros
+
+    Returns:
+        int: numero de registros afectados
+    """
+    try:
+        with connect() as conn:
+            result = conn.execute(text(sql), params)
+            conn.commit()
+
+        return result.rowcount
+    except exc.TimeoutError as error:
+        raise BBDDConexionError(f"No hay conexiones libres en el pool de la BBDD. Error de conexión: {error}")
     except exc.OperationalError as error:
         raise BBDDConexionError(f"Verifique credenciales de acceso a BBDD. Error de conexión: {error}")
     except exc.ProgrammingError as error:
         raise BBDDObjetoError(f"Verifique la existencia de los objetos de BBDD. Error de Objeto de la BBDD: {error}")
 
+def stream_query(sql, params, chunk_size: int = 1000):
+    """
+        Ejecuta una sentencia select con un cursor de servidor y devuelve sus registros a medida que llegan de la BBDD,
+        leyendolos en bloques de chunk_size. La memoria empleada no depende del numero de registros.
+        La conexion se devuelve al pool cuando se consume o se cierra el generador.
+    Args:
+        sql (str): sentencia select a ejecutar
+        params (dict): parametros de la sentencia select
+        chunk_size (int): numero de registros leidos de la BBDD en cada bloque
 
+    Returns:
+        generator: cada elemento es un registro devuelto por la select
+    """
+    try:
+        with connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(text(sql), params)
+            for partition in result.partitions():
+                yield from partition
+    except exc.TimeoutError as error:
+        raise BBDDConexionError(f"No hay conexiones libres en el pool de la BBDD. Error de conexión: {error}")
+    except exc.OperationalError as error:
+        raise BBDDConexionError(f"Verifique credenciales de acceso a BBDD. Error de conexión: {error}")
+    except exc.ProgrammingError as error:
+        raise BBDDObjetoError(f"Verifique la existencia de los objetos de BBDD. Error de Objeto de la BBDD: {error}")
+
+@metrics.timed("db_query_seconds")
 def get_tags_by_picture_id(picture_id: str):
     """
         Devuelve el listado de tags asociados a una imagen dada su picture_id.
@@ -190,7 +662,7 @@ def get_tags_by_picture_id(picture_id: str):
     """
     # Definimos la select base
     sql = "SELECT `tag`,`confidence` FROM `tags` t WHERE t.picture_id = :id"
-    params = {"id": picture_id}
+    params = {"id": id_to_db(picture_id)}
      # Ejecutamos la select para extraer las tags
     result= run_query(sql, params)
     # Si hay tags, obtenemos sus tags y los añadimos a la respuesta
@@ -201,9 +673,12 @@ def get_tags_by_picture_id(picture_id: str):
                 
     return result_tags
 
-def get_images_by_date(min_date: str, max_date: str):
+@metrics.timed("db_query_seconds")
+def get_images_by_date(min_date: str, max_date: str, tags: List = None, limit: int = None, after: tuple = None,
+                       min_confidence: int = DEFAULT_MIN_CONFIDENCE):
     """
-        Devuelve el listado de imagenes cuya fecha de registro esté entre min_date y max_date.
+        Devuelve el listado de imagenes cuya fecha de registro esté entre min_date y max_date y, si se indican tags,
+        que tengan todas ellas.
         Si la imagen no tiene tags, devuelve un listado vacio.
         Si la imagen no existe, devuelve un listado vacio.
         
@@ -212,50 +687,549 @@ def get_images_by_date(min_date: str, max_date: str):
     Args:
         min_date (str): fecha minima de creacion
         max_date (str): fecha máxima de creacion
+        tags (List): lista de tags que debe tener la imagen
+        limit (int): numero maximo de imagenes a devolver. Por defecto todas
+        after (tuple): (date, id) de la ultima imagen de la pagina anterior
+        min_confidence (int): confianza minima (excluida) de los tags. Por defecto DEFAULT_MIN_CONFIDENCE (80); None
+            para incluir todos los tags
 
     Returns:
         list: dict con la clave id, date, size y tags. 
     """
-    # Obtenemos la select
-    sql, params = set_sql_pictures_by_date(min_date, max_date)
-    # Ejecutamos la select para extraer las imagenes
+    # Obtenemos la select de imagenes y tags
+    sql, params = set_sql_pictures_tags_by_date(min_date, max_date, tags, limit, after, min_confidence)
+    # Ejecutamos una unica select para extraer las imagenes y sus tags
     result= run_query(sql, params)
-    # Si hay imagenes, obtenemos sus tags y los añadimos a la respuesta
-    if len(result)>0:
-        result_img=[{"id": p_id, "date":p_date,"size": p_size, "tags": get_tags_by_picture_id(p_id)} for p_id,p_date,p_size in result]
-    else:
-        result_img=[]
+    # Agrupamos las tags de cada imagen
+    result_img=group_pictures_tags(result)
                         
     return result_img
 
+def iter_images_by_date(min_date: str, max_date: str, tags: List = None, limit: int = None, after: tuple = None,
+                        min_confidence: int = DEFAULT_MIN_CONFIDENCE):
+    """
+        Version en streaming de get_images_by_date: devuelve las imagenes a medida que se leen de un cursor de servidor,
+        sin cargar el resultado completo en memoria.
+    Args:
+        min_date (str): fecha minima de creacion
+        max_date (str): fecha máxima de creacion
+        tags (List): lista de tags que debe tener la imagen
+        limit (int): numero maximo de imagenes a devolver. Por defecto todas
+        after (tuple): (date, id) de la ultima imagen de la pagina anterior
+        min_confidence (int): confianza minima (excluida) de los tags. Por defecto DEFAULT_MIN_CONFIDENCE (80); None
+            para incluir todos los tags
+
+    Returns:
+        generator: dict con la clave id, date, size y tags. 
+    """
+    # Obtenemos la select de imagenes y tags
+    sql, params = set_sql_pictures_tags_by_date(min_date, max_date, tags, limit, after, min_confidence)
+    # Agrupamos las tags de cada imagen a medida que llegan las filas
+    return iter_group_pictures_tags(stream_query(sql, params))
+
+def set_sql_export(since: str = ""):
+    """
+        Define la sentencia SELECT de la exportacion del archivo: todas las imagenes junto con sus tags (LEFT JOIN de
+        pictures y tags), ordenadas por (date, id) ascendente para recorrer el indice de fechas de pictures sin ordenar
+        el resultado. Cada fila contiene id, date, size, tag y confidence, con las filas de cada imagen consecutivas.
+        Con since solo se exportan las imagenes registradas en esa fecha o despues (exportacion incremental).
+    Args:
+        since (str): fecha minima de registro. Vacia para exportar todo el archivo
+
+    Returns:
+        str: sentencia select
+        dict: parametros de la select
+    """
+    sql = ("SELECT p.`id`, p.`date`, p.`size`, t.`tag`, t.`confidence` FROM `pictures` p "
+           "LEFT JOIN `tags` t ON t.picture_id = p.id")
+    params = {}
+    if since!='':
+        sql += " WHERE p.date>=:since"
+        params["since"] = since
+    sql += " ORDER BY p.date, p.id"
+    return sql,params
+
+def iter_export_rows(since: str = "", chunk_size: int = 1000):
+    """
+        Devuelve las filas (id, date, size, tag, confidence) de la exportacion (ver set_sql_export) a medida que se leen
+        de un cursor de servidor en bloques de chunk_size filas, con el id y la fecha ya convertidos a texto.
+        La memoria empleada no depende del tamaño del archivo.
+    Args:
+        since (str): fecha minima de registro. Vacia para exportar todo el archivo
+        chunk_size (int): numero de filas leidas de la BBDD en cada bloque
+
+    Returns:
+        generator: tuplas (id, date, size, tag, confidence). Las imagenes sin tags tienen tag y confidence a None
+    """
+    sql, params = set_sql_export(since)
+    for p_id, p_date, p_size, tag, confidence in stream_query(sql, params, chunk_size):
+        yield id_from_db(p_id), date_from_db(p_date), p_size, tag, confidence
+
+@metrics.timed("db_query_seconds")
+def get_image_file_by_id(picture_id: str):
+    """
+        Devuelve la ubicacion, el tamaño y el hash del fichero de una imagen dada su picture_id, sin sus tags.
+        Si la imagen no existe, devuelve un dict vacio.
+    Args:
+        picture_id (str): id de la imagen
+
+    Returns:
+        dict: dict con la clave id, path, segment, seg_offset, seg_length, size y hash. 
+    """
+    results = run_query("SELECT `id`, `path`, `segment`, `seg_offset`, `seg_length`, `size`, `hash` FROM `pictures` p WHERE p.id=:p_id", {"p_id": id_to_db(picture_id)})
+    if len(results)==0:
+        return {}
+    return dict(results[0]._mapping, id=picture_id)
+
+@metrics.timed("db_query_seconds")
+def get_image_by_hash(hash: str, min_confidence: int):
+    """
+        Devuelve una imagen registrada con el mismo contenido (hash SHA-256) cuyos tags se guardaron con una confianza minima
+        menor o igual que min_confidence, de forma que sus tags incluyen todos los que tendrian confianza mayor que min_confidence.
+        Si no existe, devuelve un dict vacio.
+        
+        Devuelve un dict con la clave id, date, size, tags, min_confidence (con la que se filtraron sus tags) y la ubicacion
+        de la imagen (path, segment, seg_offset y seg_length).
+    Args:
+        hash (str): hash SHA-256 del contenido de la imagen
+        min_confidence (int): confianza minima de los tags solicitados
+
+    Returns:
+        dict: dict con la clave id, date, size, tags, min_confidence, path, segment, seg_offset y seg_length. 
+    """
+    # Obtenemos la imagen con el mismo hash y menor min_confidence, junto con sus tags
+    sql= ("SELECT p.`id`, p.`date`, p.`size`, t.`tag`, t.`confidence`, p.`path`, p.`segment`, p.`seg_offset`, p.`seg_length`, "
+          "p.`min_confidence` FROM "
+          "(SELECT `id`, `date`, `size`, `path`, `segment`, `seg_offset`, `seg_length`, `min_confidence` FROM `pictures` WHERE `hash`=:hash AND `min_confidence`<=:min_confidence "
+          "ORDER BY `min_confidence` LIMIT 1) p LEFT JOIN `tags` t ON t.picture_id = p.id")
+    params = {"hash": hash, "min_confidence": min_confidence}
+
+    results=run_query(sql, params)
+    # Si hay imagen, agrupamos sus tags y añadimos su ubicacion
+    if len(results)>0:
+        result_img=group_pictures_tags([row[:5] for row in results])[0]
+        result_img.update(zip(("path", "segment", "seg_offset", "seg_length", "min_confidence"), results[0][5:]))
+    else:
+        result_img={}
+
+    return result_img
+
+def set_sql_tag_stats_upsert(where: str):
+    """
+        Define la sentencia que suma a la tabla tag_stats las filas de tags que cumplen where y cuya confidence es
+        superior a TAG_STATS_MIN_CONFIDENCE, agrupadas por tag y dia: numero de filas, suma, minimo y maximo de confidence.
+        Las filas de tag_stats que ya existen se actualizan (ON DUPLICATE KEY UPDATE en MySQL, ON CONFLICT en SQLite).
+    Args:
+        where (str): clausula where sobre la tabla tags con alias t (vacia para todas las filas)
+
+    Returns:
+        str: sentencia sql
+    """
+    where += (" AND " if where else " WHERE ") + f"t.`confidence`>{int(TAG_STATS_MIN_CONFIDENCE)}"
+    select = ("SELECT t.`tag` AS tag, DATE(t.`date`) AS day, COUNT(*) AS n, SUM(t.`confidence`) AS sum_confidence, "
+              "MIN(t.`confidence`) AS min_confidence, MAX(t.`confidence`) AS max_confidence FROM `tags` t" + where +
+              " GROUP BY t.`tag`, DATE(t.`date`)")
+    insert = "INSERT INTO tag_stats (tag, day, n, sum_confidence, min_confidence, max_confidence) SELECT * FROM (" + select + ") s"
+    if get_engine().dialect.name == "sqlite":
+        return (insert + " WHERE true ON CONFLICT (tag, day) DO UPDATE SET n=tag_stats.n+excluded.n, "
+                "sum_confidence=tag_stats.sum_confidence+excluded.sum_confidence, "
+                "min_confidence=MIN(tag_stats.min_confidence, excluded.min_confidence), "
+                "max_confidence=MAX(tag_stats.max_confidence, excluded.max_confidence)")
+    return (insert + " ON DUPLICATE KEY UPDATE n=tag_stats.n+s.n, sum_confidence=tag_stats.sum_confidence+s.sum_confidence, "
+            "min_confidence=LEAST(tag_stats.min_confidence, s.min_confidence), "
+            "max_confidence=GREATEST(tag_stats.max_confidence, s.max_confidence)")
+
+def _parse_date(date):
+    """
+        Convierte un filtro de fecha (datetime, str en formato %Y-%m-%d %H:%M:%S o vacio) en datetime, None si esta vacio.
+    """
+    if date is None or date == "":
+        return None
+    if isinstance(date, datetime.datetime):
+        return date
+    return datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+
+def set_sql_tags_stats_rollup(min_date: str, max_date: str):
+    """
+        Define la select de las estadisticas por tag entre min_date y max_date (excluidas) que combina los dias completos
+        del rango, leidos de tag_stats, con las filas de tags de los dias parciales de los extremos. Como en tag_stats,
+        solo se incluyen los tags con confidence superior a TAG_STATS_MIN_CONFIDENCE.
+        Devuelve None si el rango no contiene ningun dia completo.
+    Args:
+        min_date (str): fecha minima de creacion
+        max_date (str): fecha máxima de creacion
+
+    Returns:
+        str: select con las columnas tag, n, sum_confidence, min_confidence y max_confidence (una fila por tag y origen)
+        dict: parametros de la select
+    """
+    min_dt, max_dt = _parse_date(min_date), _parse_date(max_date)
+    # Primer dia completo: el del primer segundo posterior a min_date si es medianoche, o el dia siguiente
+    first_day = None
+    if min_dt is not None:
+        start = min_dt + datetime.timedelta(seconds=1)
+        first_day = start.date() if start.time() == datetime.time() else start.date() + datetime.timedelta(days=1)
+    # Los dias anteriores al de max_date son completos
+    end_day = max_dt.date() if max_dt is not None else None
+    if first_day is not None and end_day is not None and first_day >= end_day:
+        return None
+
+    conditions, params = [], {"stats_min_confidence": TAG_STATS_MIN_CONFIDENCE}
+    selects = []
+    raw = ("SELECT t.`tag` AS tag, COUNT(*) AS n, SUM(t.`confidence`) AS sum_confidence, MIN(t.`confidence`) AS min_confidence, "
+           "MAX(t.`confidence`) AS max_confidence FROM `tags` t WHERE t.`confidence`>:stats_min_confidence AND ")
+    if first_day is not None:
+        conditions.append("s.`day`>=:first_day")
+        params.update({"first_day": first_day.strftime("%Y-%m-%d"), "min_date": min_dt.strftime("%Y-%m-%d %H:%M:%S"),
+                       "first_day_start": first_day.strftime("%Y-%m-%d 00:00:00")})
+        # Filas del dia parcial inicial
+        selects.append(raw + "t.`date`>:min_date AND t.`date`<:first_day_start GROUP BY t.`tag`")
+    if end_day is not None:
+        conditions.append("s.`day`<:end_day")
+        params.update({"end_day": end_day.strftime("%Y-%m-%d"), "max_date": max_dt.strftime("%Y-%m-%d %H:%M:%S"),
+                       "end_day_start": end_day.strftime("%Y-%m-%d 00:00:00")})
+        # Filas del dia parcial final
+        selects.append(raw + "t.`date`>=:end_day_start AND t.`date`<:max_date GROUP BY t.`tag`")
+    rollup = "SELECT s.`tag`, s.`n`, s.`sum_confidence`, s.`min_confidence`, s.`max_confidence` FROM `tag_stats` s"
+    if len(conditions)>0:
+        rollup += " WHERE " + " AND ".join(conditions)
+    return " UNION ALL ".join([rollup] + selects), params
+
+@metrics.timed("db_query_seconds")
+def get_tags_stats_by_date(min_date: str, max_date: str, limit: int = None, order_by: str = None, use_rollup: bool = None,
+                           min_confidence: int = DEFAULT_MIN_CONFIDENCE):
+    """
+        Devuelve las estadisticas de confianza de cada tag registrada entre min_date y max_date, calculadas en la BBDD
+        con una unica select GROUP BY tag. Los dias completos del rango se leen de la tabla tag_stats (una fila por tag
+        y dia) y solo los dias parciales de los extremos de la tabla tags (filtrando por su columna date).
+        Las estadisticas solo incluyen los tags con confidence mayor que min_confidence. tag_stats solo agrega los tags
+        con confidence mayor que TAG_STATS_MIN_CONFIDENCE: con otro valor se agrega directamente la tabla tags, recorriendo
+        el indice (date, tag, confidence).
+        
+        Devuelve un listado de dict con la clave tag, n, min_confidence, max_confidence y mean_confidence.
+        Ejemplo: [{"tag":"tag1", "n":2, "min_confidence":60, "max_confidence":80, "mean_confidence":70.0}]
+    Args:
+        min_date (str): fecha minima de creacion
+        max_date (str): fecha máxima de creacion
+        limit (int): numero maximo de tags a devolver. Por defecto todas
+        order_by (str): `n` o `mean_confidence` para ordenar de mayor a menor. Por defecto se ordena por tag
+        use_rollup (bool): si es False, agrega directamente la tabla tags. Por defecto TAG_STATS_ROLLUP (true)
+        min_confidence (int): confianza minima (excluida) de los tags. Por defecto DEFAULT_MIN_CONFIDENCE (80); None
+            para incluir todos los tags
+
+    Returns:
+        list: dict con la clave tag, n, min_confidence, max_confidence y mean_confidence. 
+    """
+    if use_rollup is None:
+        use_rollup = os.environ.get("TAG_STATS_ROLLUP", "true").lower() != "false"
+    if min_confidence != TAG_STATS_MIN_CONFIDENCE:
+        use_rollup = False
+    rollup = set_sql_tags_stats_rollup(min_date, max_date) if use_rollup else None
+    if rollup is not None:
+        # Combinamos los dias completos de tag_stats con los dias parciales de tags
+        source, params = rollup
+        sql = ("SELECT u.`tag`, SUM(u.`n`) AS n, MIN(u.`min_confidence`) AS min_confidence, MAX(u.`max_confidence`) AS max_confidence, "
+               "SUM(u.`sum_confidence`) * 1.0 / SUM(u.`n`) AS mean_confidence FROM (" + source + ") u GROUP BY u.`tag`")
+        tag_column = "u.`tag`"
+    else:
+        # Definimos la select de agregacion
+        sql = ("SELECT t.`tag`, COUNT(*) AS n, MIN(t.`confidence`) AS min_confidence, MAX(t.`confidence`) AS max_confidence, "
+               "AVG(t.`confidence`) AS mean_confidence FROM `tags` t")
+        # Añadimos los filtros de fecha sobre la columna date de tags
+        where, params = set_sql_date_filter(min_date, max_date, column="t.date")
+        # Añadimos el filtro de confianza minima
+        if min_confidence is not None:
+            where += (" AND " if where else " WHERE ") + "t.`confidence`>:min_confidence"
+            params["min_confidence"] = min_confidence
+        sql += where + " GROUP BY t.`tag`"
+        tag_column = "t.`tag`"
+    # Ordenamos de mayor a menor por el criterio indicado
+    if order_by in ("n", "mean_confidence"):
+        sql += f" ORDER BY {order_by} DESC, {tag_column}"
+    else:
+        sql += f" ORDER BY {tag_column}"
+    # Limitamos el numero de tags devueltas
+    if limit is not None:
+        sql += " LIMIT :limit"
+        params["limit"] = limit
+    # Ejecutamos la select
+    result = run_query(sql, params)
+
+    return [{"tag": tag, "n": int(n), "min_confidence": min_c, "max_confidence": max_c, "mean_confidence": float(mean_c)}
+            for tag, n, min_c, max_c, mean_c in result]
+
+@metrics.timed("db_query_seconds")
+def rebuild_tag_stats():
+    """
+        Recalcula la tabla tag_stats a partir de la tabla tags (con confidence superior a TAG_STATS_MIN_CONFIDENCE) en
+        una unica transaccion.
+
+    Returns:
+        int: numero de filas (tag y dia) de tag_stats
+    """
+    try:
+        with connect() as conn:
+            conn.execute(text("DELETE FROM tag_stats"))
+            conn.execute(text(set_sql_tag_stats_upsert("")))
+            conn.commit()
+            rows = conn.execute(text("SELECT COUNT(*) FROM tag_stats")).scalar()
+    except exc.TimeoutError as error:
+        raise BBDDConexionError(f"No hay conexiones libres en el pool de la BBDD. Error de conexión: {error}")
+    except exc.OperationalError as error:
+        raise BBDDConexionError(f"Verifique credenciales de acceso a BBDD. Error de conexión: {error}")
+    except exc.ProgrammingError as error:
+        raise BBDDObjetoError(f"Verifique la existencia de los objetos de BBDD. Error de Objeto de la BBDD: {error}")
+    cache.bump_generation()
+    return rows
+
+@metrics.timed("db_query_seconds")
 def get_image_by_id(picture_id: str):
     """
         Devuelve la imagen dada su picture_id.
         Si la imagen no tiene tags, devuelve un listado vacio.
         Si la imagen no existe, devuelve un dict vacio.
         
-        Devuelve un dict con la clave id, date, size y tags.
-        Ejemplo: {"id":"id1", "date":"date1", "size":100, "tags":[{"tag":"tag1", "confidence":0.8}, {"tag":"tag2", "confidence":0.6}]}
+        Devuelve un dict con la clave id, date, size, tags y la ubicacion de la imagen (path, segment, seg_offset y seg_length).
+        Ejemplo: {"id":"id1", "date":"date1", "size":100, "tags":[{"tag":"tag1", "confidence":0.8}, {"tag":"tag2", "confidence":0.6}], "path": ...}
     Args:
         picture_id (str): id de la imagen
 
     Returns:
-        dict: dict con la clave id, date, size y tags. 
+        dict: dict con la clave id, date, size, tags, path, segment, seg_offset y seg_length. 
     """
-    # Obtenemos la select por id
-    sql= "SELECT `id`, `date`, `size`, `path`  FROM `pictures` p WHERE p.id=:p_id"
-    params = {"p_id":picture_id}
+    # Obtenemos la select por id, junto con sus tags
+    sql= ("SELECT p.`id`, p.`date`, p.`size`, t.`tag`, t.`confidence`, p.`path`, p.`segment`, p.`seg_offset`, p.`seg_length` "
+          "FROM `pictures` p LEFT JOIN `tags` t ON t.picture_id = p.id WHERE p.id=:p_id")
+    params = {"p_id":id_to_db(picture_id)}
     
-    # Inicializamos la lista de imagenes a vacio
+    # Ejecutamos una unica select para la imagen y sus tags
     results=run_query(sql, params)
-    # Si hay imagenes, obtenemos sus tags y los añadimos a la respuesta
-    if len(results)==1:
-        result_img={"id": results[0][0], "date":results[0][1],"size": results[0][2], "path": results[0][3], "tags": get_tags_by_picture_id(results[0][0])}
+    # Si hay imagen, agrupamos sus tags y añadimos su ubicacion
+    if len(results)>0:
+        result_img=group_pictures_tags([row[:5] for row in results])[0]
+        result_img.update(zip(("path", "segment", "seg_offset", "seg_length"), results[0][5:]))
     else:
         result_img={}
 
     return result_img
 
+#
+# Funciones para completar los tags de las imagenes registradas con un filtro de confianza (ver backfill)
+#
+@metrics.timed("db_query_seconds")
+def get_pictures_to_backfill(after: str = None, limit: int = 100):
+    """
+        Devuelve hasta limit imagenes cuyos tags se guardaron filtrados por confianza (min_confidence mayor que 0, o
+        NULL si se registraron antes de guardarlo), ordenadas por id y posteriores a la imagen after.
+    Args:
+        after (str): id de la ultima imagen procesada. Por defecto desde el principio
+        limit (int): numero maximo de imagenes
+
+    Raises:
+        ValueError: si after no es un id valido
+
+    Returns:
+        list: dict con la clave id, date, min_confidence y la ubicacion de la imagen (path, segment, seg_offset y seg_length)
+    """
+    sql = ("SELECT `id`, `date`, `min_confidence`, `path`, `segment`, `seg_offset`, `seg_length` FROM `pictures` "
+           "WHERE (`min_confidence` IS NULL OR `min_confidence`>0)")
+    params = {"limit": limit}
+    if after is not None:
+        sql += " AND `id`>:after"
+        try:
+            params["after"] = id_to_db(after)
+        except (TypeError, AttributeError, ValueError):
+            raise ValueError(f"id no valido: {after}")
+    results = run_query(sql + " ORDER BY `id` LIMIT :limit", params)
+    return [{"id": id_from_db(p_id), "date": date_from_db(p_date), "min_confidence": min_confidence, "path": path,
+             "segment": segment, "seg_offset": seg_offset, "seg_length": seg_length}
+            for p_id, p_date, min_confidence, path, segment, seg_offset, seg_length in results]
+
+@metrics.timed("db_query_seconds")
+def add_picture_tags(picture_id: str, date: str, tags: List):
+    """
+        Completa los tags de una imagen con los tags de tags que aun no tiene, los suma a tag_stats y marca la imagen
+        como etiquetada con todos sus tags (min_confidence 0), en una unica transaccion. Los tags que ya tiene la imagen
+        no se modifican, de forma que las estadisticas de tag_stats se mantienen sumando solo los nuevos.
+    Args:
+        picture_id (str): id de la imagen
+        date (str): fecha de registro de la imagen
+        tags (List): lista de tags y su confidence
+
+    Returns:
+        int: numero de tags añadidos
+    """
+    picture_id = id_to_db(picture_id)
+    try:
+        with connect() as conn:
+            existing = {row[0] for row in conn.execute(text("SELECT `tag` FROM `tags` WHERE `picture_id`=:picture_id"),
+                                                       {"picture_id": picture_id})}
+            tags_db = [{"tag": t['tag'], "picture_id": picture_id, "confidence": t['confidence'], "date": date}
+                       for t in tags if t['tag'] not in existing]
+            if len(tags_db)>0:
+                conn.execute(text("INSERT INTO tags (tag,picture_id,confidence,date) VALUES (:tag, :picture_id, :confidence, :date)"), tags_db)
+                # Sumamos solo los tags nuevos a las estadisticas por tag y dia
+                tag_params = {f"tag_{i}": t["tag"] for i, t in enumerate(tags_db)}
+                conn.execute(text(set_sql_tag_stats_upsert(" WHERE t.picture_id=:picture_id AND t.tag IN (" +
+                                                           ", ".join(f":{name}" for name in tag_params) + ")")),
+                             dict(tag_params, picture_id=picture_id))
+            conn.execute(text("UPDATE `pictures` SET `min_confidence`=0 WHERE `id`=:picture_id"), {"picture_id": picture_id})
+            conn.commit()
+        cache.bump_generation()
+        return len(tags_db)
+    except exc.TimeoutError as error:
+        raise BBDDConexionError(f"No hay conexiones libres en el pool de la BBDD. Error de conexión: {error}")
+    except exc.OperationalError as error:
+        raise BBDDConexionError(f"Verifique credenciales de acceso a BBDD. Error de conexión: {error}")
+    except exc.ProgrammingError as error:
+        raise BBDDObjetoError(f"Verifique la existencia de los objetos de BBDD. Error de Objeto de la BBDD: {error}")
+
+#
+# Funciones para el mantenimiento del almacen de segmentos (ver storage)
+#
+@metrics.timed("db_query_seconds")
+def get_flat_image_paths(limit: int):
+    """
+        Devuelve los paths de hasta limit ficheros de imagenes que no estan en el almacen de segmentos.
+    Args:
+        limit (int): numero maximo de paths
+
+    Returns:
+        list: paths de los ficheros
+    """
+    results = run_query("SELECT DISTINCT `path` FROM `pictures` WHERE `segment` IS NULL LIMIT :limit", {"limit": limit})
+    return [row[0] for row in results]
+
+@metrics.timed("db_query_seconds")
+def get_segments_usage():
+    """
+        Devuelve los bytes ocupados por imagenes registradas en cada segmento. Las imagenes duplicadas que
+        comparten ubicacion se cuentan una vez.
+
+    Returns:
+        dict: bytes ocupados por nombre de segmento
+    """
+    results = run_query("SELECT s.`segment`, SUM(s.`seg_length`) FROM (SELECT DISTINCT `segment`, `seg_offset`, `seg_length` "
+                        "FROM `pictures` WHERE `segment` IS NOT NULL) s GROUP BY s.`segment`", {})
+    return {segment: int(used) for segment, used in results}
+
+@metrics.timed("db_query_seconds")
+def get_segment_locations(segment: str):
+    """
+        Devuelve las posiciones y longitudes de las imagenes registradas en un segmento.
+    Args:
+        segment (str): nombre del segmento
+
+    Returns:
+        list: tuplas (seg_offset, seg_length)
+    """
+    results = run_query("SELECT DISTINCT `seg_offset`, `seg_length` FROM `pictures` WHERE `segment`=:segment ORDER BY `seg_offset`",
+                        {"segment": segment})
+    return [(offset, length) for offset, length in results]
+
+@metrics.timed("db_query_seconds")
+def update_image_location(old: dict, new: dict):
+    """
+        Cambia la ubicacion de todas las imagenes guardadas en la ubicacion old por new.
+    Args:
+        old (dict): ubicacion actual (claves path, segment, seg_offset y seg_length)
+        new (dict): nueva ubicacion
+
+    Returns:
+        int: numero de imagenes actualizadas
+    """
+    sql = "UPDATE `pictures` SET `path`=:path, `segment`=:segment, `seg_offset`=:seg_offset, `seg_length`=:seg_length WHERE "
+    params = dict(new)
+    if old.get("segment") is None:
+        sql += "`path`=:old_path AND `segment` IS NULL"
+        params["old_path"] = old["path"]
+    else:
+        sql += "`segment`=:old_segment AND `seg_offset`=:old_offset"
+        params.update({"old_segment": old["segment"], "old_offset": old["seg_offset"]})
+    return run_statement(sql, params)
+
+#
+# Funciones para la cola de trabajos de registro de imagenes
+#
+@metrics.timed("db_query_seconds")
+def insert_job(job_id: str, path: str, min_confidence: int, date: str):
+    """
+        Inserta un trabajo de registro de imagen en estado pending
+    Args:
+        job_id (str): id del trabajo
+        path (str): path local de la imagen recibida
+        min_confidence (int): confianza minima de los tags a aceptar
+        date (str): fecha de creacion del trabajo
+    """
+    run_statement("INSERT INTO jobs (id, status, path, min_confidence, created, updated) VALUES (:id, 'pending', :path, :min_confidence, :date, :date)",
+                  {"id": job_id, "path": path, "min_confidence": min_confidence, "date": date})
+
+@metrics.timed("db_query_seconds")
+def claim_job(job_id: str, date: str):
+    """
+        Marca un trabajo pending como running. Solo un worker puede reclamar cada trabajo.
+    Args:
+        job_id (str): id del trabajo
+        date (str): fecha de actualizacion
+
+    Returns:
+        bool: True si el trabajo se ha reclamado
+    """
+    return run_statement("UPDATE jobs SET status='running', updated=:date WHERE id=:id AND status='pending'",
+                         {"id": job_id, "date": date}) == 1
+
+@metrics.timed("db_query_seconds")
+def finish_job(job_id: str, status: str, result: str, date: str):
+    """
+        Registra el resultado de un trabajo
+    Args:
+        job_id (str): id del trabajo
+        status (str): estado final, done o error
+        result (str): json con la respuesta del registro de la imagen o con la descripcion del error
+        date (str): fecha de actualizacion
+    """
+    run_statement("UPDATE jobs SET status=:status, result=:result, updated=:date WHERE id=:id",
+                  {"id": job_id, "status": status, "result": result, "date": date})
+
+@metrics.timed("db_query_seconds")
+def get_job(job_id: str):
+    """
+        Devuelve un trabajo dado su id. Si no existe devuelve un dict vacio.
+    Args:
+        job_id (str): id del trabajo
+
+    Returns:
+        dict: con las claves id, status, path, min_confidence, result, created y updated
+    """
+    results = run_query("SELECT `id`, `status`, `path`, `min_confidence`, `result`, `created`, `updated` FROM `jobs` WHERE id=:id", {"id": job_id})
+    if len(results)==0:
+        return {}
+    return dict(results[0]._mapping)
+
+@metrics.timed("db_query_seconds")
+def get_pending_job_ids(limit: int):
+    """
+        Devuelve los ids de los trabajos pending mas antiguos
+    Args:
+        limit (int): numero maximo de ids a devolver
+
+    Returns:
+        list: ids de los trabajos
+    """
+    return [job_id for job_id, in run_query("SELECT `id` FROM `jobs` WHERE status='pending' ORDER BY created LIMIT :limit", {"limit": limit})]
+
+@metrics.timed("db_query_seconds")
+def reset_running_jobs(date: str):
+    """
+        Devuelve a pending los trabajos que quedaron en running al detenerse el proceso
+    Args:
+        date (str): fecha de actualizacion
+
+    Returns:
+        int: numero de trabajos recuperados
+    """
+    return run_statement("UPDATE jobs SET status='pending', updated=:date WHERE status='running'", {"date": date})
+
 # Funciones para el acceso a disco
 def save_image(imagen: bytes, filename: str):
     """
@@ -273,7 +1247,79 @@ def save_image(imagen: bytes, filename: str):
         
     return filename
 
+def save_stream(stream, filename: str, chunk_size: int = 64*1024, hasher=None):
+    """
+        Guarda en disco local con el nombre filename una imagen leida de un stream, por bloques de chunk_size bytes
+    Args:
+        stream (file): stream de lectura de la imagen
+        filename (str): nombre del archivo a generar
+        chunk_size (int): tamaño de los bloques de lectura
+        hasher (obj): si se indica, hash de hashlib que se actualiza con cada bloque
+
+    Returns:
+        int: tamaño en bytes de la imagen
+    """
+    size = 0
+    with open(filename, 'wb') as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            size += len(chunk)
+
+    return size
+
+def hash_image(filename: str, chunk_size: int = 64*1024):
+    """
+        Calcula el hash SHA-256 de una imagen de disco local leyendola por bloques de chunk_size bytes
+    Args:
+        filename (str): nombre del archivo a leer
+        chunk_size (int): tamaño de los bloques de lectura
+
+    Returns:
+        str: hash SHA-256 en hexadecimal
+    """
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+def move_image(source: str, filename: str):
+    """
+        Mueve una imagen de la carpeta de imagenes al fichero filename, sin copiar su contenido
+    Args:
+        source (str): fichero de origen
+        filename (str): fichero de destino
+
+    Returns:
+        str: filename
+    """
+    os.replace(source, filename)
+
+    return filename
+
 # Funciones para el acceso a disco
+def read_image_header(filename: str, length: int = 16):
+    """
+        Lee los primeros length bytes de una imagen de disco local
+    Args:
+        filename (str): nombre del archivo a leer
+        length (int): numero de bytes a leer
+
+    Returns:
+        bytes: cabecera de la imagen
+    """
+    with open(filename, "rb") as f:
+        return f.read(length)
+
 def read_image(filename: str):
     """
         Lee una imagen de disco local con el nombre filename
@@ -0,0 +1,93 @@
+from flask import Blueprint, Response, request, g, make_response
+import time
+
+from image_tags_api import models, metrics, controller, cache, cleanup, startup
+
+monitor_bp = Blueprint('monitor', __name__, url_prefix='/')
+
+@monitor_bp.before_app_request
+def start_request_timer():
+    """
+        Registra el inicio de cada peticion de la API y la cuenta en el gauge http_requests_in_flight.
+    """
+    g.request_start = time.perf_counter()
+    metrics.add_gauge("http_requests_in_flight", 1)
+
+@monitor_bp.after_app_request
+def observe_request(response):
+    """
+        Registra la duracion de cada peticion en el histograma http_request_duration_seconds, por metodo, endpoint
+        (la regla de la url, no la url, para acotar las etiquetas) y codigo de estado. En las respuestas en streaming
+        la duracion es la del envio de las cabeceras.
+    """
+    _observe_request(response.status_code)
+    return response
+
+@monitor_bp.teardown_app_request
+def finish_request(error=None):
+    """
+        Descuenta la peticion de http_requests_in_flight. Las peticiones que terminan con una excepcion no capturada
+        se registran con el codigo 500.
+    """
+    if "request_start" not in g:
+        return
+    if not g.get("request_observed"):
+        _observe_request(500)
+    metrics.add_gauge("http_requests_in_flight", -1)
+
+def _observe_request(status: int):
+    g.request_observed = True
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.observe("http_request_duration_seconds", time.perf_counter() - g.request_start,
+                    {"method": request.method, "endpoint": endpoint, "status": str(status)})
+
+@monitor_bp.get('/healthz')
+def get_healthz():
+    """
+        Implementacion del metodo GET /healthz (liveness). Responde 200 mientras el proceso atiende peticiones, sin
+        comprobar sus dependencias.
+    Returns:
+        Un json con el campo `status`: `ok`.
+    """
+    return {"status": "ok"}
+
+@monitor_bp.get('/readyz')
+def get_readyz():
+    """
+        Implementacion del metodo GET /readyz (readiness). Responde 200 cuando ha terminado el calentamiento del arranque
+        (pool de conexiones a la BBDD y sesiones con los servicios externos) y la BBDD responde, y 503 en otro caso.
+    Returns:
+        Un json con los campos `ready`, `warmed_up` (si ha terminado el calentamiento), `startup_seconds` (duracion del
+        arranque) y `checks` (resultado y duracion de cada etapa del calentamiento).
+    """
+    ready = startup.is_ready()
+    return make_response(dict(startup.get_status(), ready=ready), 200 if ready else 503)
+
+@monitor_bp.get('/metrics')
+def get_metrics():
+    """
+        Implementacion del metodo GET /metrics. Devuelve las metricas del proceso en el formato de texto de Prometheus:
+        contadores, histogramas de duracion (etapas del registro de imagenes, consultas a la BBDD, llamadas a Imagga e
+        Imagekitio y peticiones por endpoint y codigo de estado) y gauges (pool de conexiones y peticiones en curso).
+    Returns:
+        Las metricas en texto plano (text/plain; version=0.0.4).
+    """
+    return Response(metrics.render_prometheus(), mimetype="text/plain", headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+@monitor_bp.get('/status')
+def get_status():
+    """
+        Implementacion del metodo GET /status. Devuelve el estado interno del servicio para su monitorizacion.
+    Returns:
+        Un json con los siguientes campos:
+            - `db_pool`: estado del pool de conexiones a la BBDD (tamaño, conexiones en uso, overflow y tiempos de espera)
+            - `dedup`: aciertos, fallos y tasa de aciertos de la deduplicacion de imagenes por contenido
+            - `cache`: entradas, bytes, aciertos, fallos, caducadas, expulsiones y tasa de aciertos de las caches de imagenes
+              por id y de respuestas
+            - `breakers`: estado de los circuit breakers de Imagga e Imagekitio (`closed`, `open` o `half_open`)
+            - `cleanup`: borrados de imagenes de Imagekitio pendientes en la cola de segundo plano
+            - `metrics`: contadores y resumenes internos del proceso
+    """
+    return {"db_pool": models.get_pool_status(), "dedup": controller.get_dedup_stats(),
+            "cache": cache.get_cache_stats(), "breakers": models.get_breakers_status(),
+            "cleanup": {"pending": cleanup.get_pending()}, "metrics": metrics.snapshot()}
@@ -0,0 +1,63 @@
+import io
+import os
+
+from PIL import Image, ImageOps
+
+
+def resize_for_tagging(image_bin: bytes, max_edge: int = None, quality: int = None):
+    """
+        Reduce una imagen para enviarla al backend de etiquetado: la escala para que su lado mayor no supere max_edge
+        pixeles y la recodifica en JPEG con calidad quality. La imagen original se guarda sin cambios.
+        Devuelve la imagen original si no se reconoce, si ya es un JPEG dentro del tamaño maximo o si la version
+        reducida no es mas pequeña.
+    Args:
+        image_bin (bytes): imagen en binario
+        max_edge (int): lado mayor maximo en pixeles. Por defecto TAG_MAX_EDGE (1024); 0 desactiva la reduccion
+        quality (int): calidad JPEG de la imagen reducida. Por defecto TAG_JPEG_QUALITY (85)
+
+    Returns:
+        bytes: imagen a enviar al backend de etiquetado
+    """
+    resized_bin = _resize(io.BytesIO(image_bin), max_edge, quality)
+    return resized_bin if resized_bin is not None and len(resized_bin) < len(image_bin) else image_bin
+
+def resize_file_for_tagging(image_file, max_edge: int = None, quality: int = None):
+    """
+        Version de resize_for_tagging para una imagen guardada en un fichero: solo se lee completa si se envia sin reducir.
+    Args:
+        image_file (file): fichero de la imagen abierto en modo binario
+        max_edge (int): lado mayor maximo en pixeles. Por defecto TAG_MAX_EDGE (1024); 0 desactiva la reduccion
+        quality (int): calidad JPEG de la imagen reducida. Por defecto TAG_JPEG_QUALITY (85)
+
+    Returns:
+        bytes: imagen a enviar al backend de etiquetado
+    """
+    resized_bin = _resize(image_file, max_edge, quality)
+    if resized_bin is not None and len(resized_bin) < os.fstat(image_file.fileno()).st_size:
+        return resized_bin
+    image_file.seek(0)
+    return image_file.read()
+
+def _resize(source, max_edge: int, quality: int):
+    # Devuelve la imagen de source reducida y recodificada en JPEG, o None si se debe enviar la original
+    max_edge = int(os.environ.get("TAG_MAX_EDGE", 1024)) if max_edge is None else max_edge
+    quality = int(os.environ.get("TAG_JPEG_QUALITY", 85)) if quality is None else quality
+    if max_edge <= 0:
+        return None
+    try:
+        with Image.open(source) as image:
+            if image.format == "JPEG" and max(image.size) <= max_edge:
+                return None
+            # En JPEG, draft decodifica directamente a escala 1/2, 1/4 o 1/8, sin decodificar la imagen completa
+            image.draft("RGB", (max_edge, max_edge))
+            # Aplicamos la orientacion EXIF, que se pierde al recodificar
+            resized = ImageOps.exif_transpose(image)
+            resized.thumbnail((max_edge, max_edge))
+            if resized.mode != "RGB":
+                resized = resized.convert("RGB")
+            output = io.BytesIO()
+            resized.save(output, "JPEG", quality=quality, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # No es una imagen que Pillow pueda procesar: se envia tal cual
+        return None
+    return output.getvalue()
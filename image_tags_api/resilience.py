@@ -0,0 +1,132 @@
+import os
+import time
+import random
+import threading
+
+import requests
+from imagekitio.exceptions.InternalServerException import InternalServerException
+from imagekitio.exceptions.TooManyRequestsException import TooManyRequestsException
+
+from . import metrics
+from .appexceptions import CircuitOpenError
+
+
+def is_retryable(error: Exception, idempotent: bool = True):
+    """
+        Indica si un error de una llamada a un servicio externo es transitorio y la llamada se puede reintentar:
+        errores de conexion, respuestas 429 y 5xx y, si la llamada es idempotente, timeouts de lectura.
+    Args:
+        error (Exception): error de la llamada
+        idempotent (bool): si la llamada se puede repetir sin efectos secundarios
+
+    Returns:
+        bool: True si se puede reintentar
+    """
+    if isinstance(error, (InternalServerException, TooManyRequestsException, requests.ConnectionError)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    if isinstance(error, requests.Timeout):
+        return idempotent
+    return False
+
+def retry_call(func, *args, idempotent: bool = True, **kwargs):
+    """
+        Ejecuta func(*args, **kwargs) reintentando los errores transitorios (ver is_retryable) con backoff exponencial
+        y jitter completo. La configuracion se lee de las variables de entorno HTTP_RETRIES (2 reintentos),
+        HTTP_BACKOFF (0.5 segundos) y HTTP_MAX_BACKOFF (5 segundos).
+    Args:
+        func (callable): funcion a ejecutar
+        idempotent (bool): si la llamada se puede repetir sin efectos secundarios
+
+    Returns:
+        obj: resultado de func
+    """
+    retries = int(os.environ.get("HTTP_RETRIES", 2))
+    backoff = float(os.environ.get("HTTP_BACKOFF", 0.5))
+    max_backoff = float(os.environ.get("HTTP_MAX_BACKOFF", 5))
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as error:
+            if attempt >= retries or not is_retryable(error, idempotent):
+                raise
+            metrics.incr("http_retries")
+            time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** attempt)))
+            attempt += 1
+
+class CircuitBreaker:
+    """
+        Circuit breaker de un servicio externo. Tras failure_threshold fallos consecutivos el circuito se abre y las
+        llamadas fallan inmediatamente con CircuitOpenError durante reset_timeout segundos. Despues se deja pasar una
+        llamada de prueba (estado half_open): si tiene exito el circuito se cierra y si falla vuelve a abrirse.
+        Solo cuentan como fallos los errores transitorios del servicio (ver is_retryable), no los errores de la peticion.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_timeout: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold if failure_threshold is not None else int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5))
+        self.reset_timeout = reset_timeout if reset_timeout is not None else float(os.environ.get("BREAKER_RESET_TIMEOUT", 30))
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Dejamos pasar una unica llamada de prueba
+                self.state = self.HALF_OPEN
+                return
+            metrics.incr(f"breaker_{self.name}_rejected")
+            raise CircuitOpenError(f"Circuito abierto para {self.name}: el servicio no esta disponible")
+
+    def _on_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def _on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        """
+            Ejecuta func(*args, **kwargs) a traves del circuito.
+        Raises:
+            CircuitOpenError: si el circuito esta abierto
+        Returns:
+            obj: resultado de func
+        """
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            if is_retryable(error):
+                self._on_failure()
+            else:
+                self._on_success()
+            raise
+        self._on_success()
+        return result
+
+    def status(self):
+        """
+            Devuelve el estado del circuito para su monitorizacion.
+
+        Returns:
+            dict: con las claves state, failures y open_seconds (segundos que lleva abierto)
+        """
+        with self._lock:
+            return {"state": self.state, "failures": self.failures,
+                    "open_seconds": time.monotonic() - self.opened_at if self.opened_at is not None else 0.0}
@@ -0,0 +1,302 @@
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+from . import models, metrics
+
+# Indice de similitud en memoria del proceso (ver get_index), construido en la primera consulta
+_index = None
+_building = False
+_pending = []
+_index_lock = threading.Lock()
+_pending_lock = threading.Lock()
+
+
+class TagIndex:
+    """
+        Matriz dispersa imagen x tag con la confianza de cada tag, para buscar las imagenes mas parecidas a una dada por
+        similitud coseno. La matriz se guarda en formato CSC (por cada tag, las filas de las imagenes que lo tienen), de
+        forma que el coste de una consulta depende del numero de imagenes que comparten algun tag con la consultada y no
+        del total de imagenes.
+        Las imagenes añadidas tras la construccion se acumulan en un delta que se fusiona con la matriz principal
+        cuando supera merge_threshold entradas (o la decima parte de la matriz, si es mayor).
+        Al actualizar los tags de una imagen su fila se marca como borrada y se añade una nueva; las filas borradas
+        se ignoran en las consultas y se descartan al reconstruir el indice.
+    """
+    def __init__(self, merge_threshold: int = 50000):
+        self.merge_threshold = merge_threshold
+        # Columna de cada tag, fila de cada imagen e id de cada fila
+        self.vocabulary = {}
+        self.rows = {}
+        self.ids = []
+        # Filas borradas al actualizar una imagen, marcadas en un array que se amplia al doble al llenarse
+        self._deleted = np.zeros(0, dtype=bool)
+        # Matriz principal en formato CSC
+        self._col_ptr = np.zeros(1, dtype=np.int64)
+        self._row_idx = np.zeros(0, dtype=np.int32)
+        self._values = np.zeros(0, dtype=np.float32)
+        # Norma al cuadrado de cada fila de la matriz principal
+        self._norms_sq = np.zeros(0, dtype=np.float32)
+        # Delta: entradas (fila, columna, valor) y normas de las filas añadidas desde la ultima fusion, en arrays
+        # que se amplian al doble al llenarse
+        self._reset_delta()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, picture_id: str, tags: list):
+        """
+            Añade una imagen al indice. Las imagenes que ya estan en el indice se ignoran.
+        Args:
+            picture_id (str): id de la imagen
+            tags (list): dict con las claves tag y confidence
+        """
+        with self._lock:
+            if picture_id in self.rows:
+                return
+            self._append(picture_id, tags)
+
+    def update(self, picture_id: str, tags: list):
+        """
+            Sustituye los tags de una imagen del indice: marca su fila como borrada y la vuelve a añadir con tags.
+            Si la imagen no esta en el indice, se añade.
+        Args:
+            picture_id (str): id de la imagen
+            tags (list): dict con las claves tag y confidence
+        """
+        with self._lock:
+            row = self.rows.pop(picture_id, None)
+            if row is not None:
+                if row >= len(self._deleted):
+                    self._deleted = np.concatenate([self._deleted, np.zeros(max(len(self._deleted), row + 1), dtype=bool)])
+                self._deleted[row] = True
+            self._append(picture_id, tags)
+
+    def _append(self, picture_id: str, tags: list):
+        # Añade una fila al delta con los tags de la imagen
+        row = len(self.ids)
+        self.rows[picture_id] = row
+        self.ids.append(picture_id)
+        size = self._delta_size
+        if size + len(tags) > len(self._delta_rows):
+            capacity = max(2*len(self._delta_rows), size + len(tags))
+            self._delta_rows, self._delta_cols, self._delta_values = (
+                np.resize(array, capacity) for array in (self._delta_rows, self._delta_cols, self._delta_values))
+        if len(self._delta_norms_sq) == row - len(self._norms_sq):
+            self._delta_norms_sq = np.resize(self._delta_norms_sq, 2*len(self._delta_norms_sq))
+        values = [float(tag["confidence"]) for tag in tags]
+        self._delta_rows[size:size + len(tags)] = row
+        self._delta_cols[size:size + len(tags)] = [self.vocabulary.setdefault(tag["tag"], len(self.vocabulary)) for tag in tags]
+        self._delta_values[size:size + len(tags)] = values
+        self._delta_norms_sq[row - len(self._norms_sq)] = sum(value**2 for value in values)
+        self._delta_size += len(tags)
+        if self._delta_size >= max(self.merge_threshold, len(self._values)//10):
+            self._merge()
+
+    def add_many(self, pictures):
+        """
+            Añade al indice un bloque de imagenes con una sola fusion, por ejemplo al construirlo.
+            Las imagenes que ya estan en el indice se ignoran.
+        Args:
+            pictures (iterable): tuplas (id, tags) con tags una lista de dict con las claves tag y confidence
+        """
+        rows, cols, values, norms_sq = [], [], [], []
+        with self._lock:
+            for picture_id, tags in pictures:
+                if picture_id in self.rows:
+                    continue
+                row = len(self.ids)
+                self.rows[picture_id] = row
+                self.ids.append(picture_id)
+                picture_values = [float(tag["confidence"]) for tag in tags]
+                rows.extend([row]*len(tags))
+                cols.extend(self.vocabulary.setdefault(tag["tag"], len(self.vocabulary)) for tag in tags)
+                values.extend(picture_values)
+                norms_sq.append(sum(value**2 for value in picture_values))
+            # El delta pendiente y el bloque se fusionan juntos con la matriz principal
+            size = self._delta_size
+            n_delta_rows = len(self.ids) - len(norms_sq) - len(self._norms_sq)
+            self._delta_rows = np.concatenate([self._delta_rows[:size], np.asarray(rows, dtype=np.int32)])
+            self._delta_cols = np.concatenate([self._delta_cols[:size], np.asarray(cols, dtype=np.int32)])
+            self._delta_values = np.concatenate([self._delta_values[:size], np.asarray(values, dtype=np.float32)])
+            self._delta_norms_sq = np.concatenate([self._delta_norms_sq[:n_delta_rows], np.asarray(norms_sq, dtype=np.float32)])
+            self._delta_size = len(self._delta_rows)
+            self._merge()
+
+    def _reset_delta(self, capacity: int = 1024):
+        self._delta_rows = np.zeros(capacity, dtype=np.int32)
+        self._delta_cols = np.zeros(capacity, dtype=np.int32)
+        self._delta_values = np.zeros(capacity, dtype=np.float32)
+        self._delta_norms_sq = np.zeros(capacity, dtype=np.float32)
+        self._delta_size = 0
+
+    def _merge(self):
+        # Fusiona el delta con la matriz principal, reordenando todas las entradas por columna
+        size = self._delta_size
+        main_cols = np.repeat(np.arange(len(self._col_ptr) - 1, dtype=np.int32), np.diff(self._col_ptr))
+        cols = np.concatenate([main_cols, self._delta_cols[:size]])
+        rows = np.concatenate([self._row_idx, self._delta_rows[:size]])
+        values = np.concatenate([self._values, self._delta_values[:size]])
+        order = np.argsort(cols, kind="stable")
+        self._row_idx = rows[order]
+        self._values = values[order]
+        self._col_ptr = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cols, minlength=len(self.vocabulary)), out=self._col_ptr[1:])
+        self._norms_sq = np.concatenate([self._norms_sq, self._delta_norms_sq[:len(self.ids) - len(self._norms_sq)]])
+        self._reset_delta()
+
+    def top_k(self, tags: list, k: int, exclude: str = None):
+        """
+            Devuelve las k imagenes del indice mas parecidas, por similitud coseno, al vector de tags tags.
+            Solo se devuelven imagenes que comparten algun tag (similitud mayor que 0).
+        Args:
+            tags (list): dict con las claves tag y confidence
+            k (int): numero maximo de imagenes a devolver
+            exclude (str): id de una imagen a excluir del resultado, normalmente la consultada
+
+        Returns:
+            list: dict con las claves id y similarity, ordenados por similitud descendente
+        """
+        with self._lock:
+            query = {self.vocabulary[t["tag"]]: float(t["confidence"]) for t in tags if t["tag"] in self.vocabulary}
+            query_norm = np.sqrt(sum(float(t["confidence"])**2 for t in tags))
+            if not query or query_norm == 0:
+                return []
+            # Producto escalar con las filas de la matriz principal que tienen alguno de los tags de la consulta
+            n_main_cols = len(self._col_ptr) - 1
+            rows, weights = [], []
+            for col, confidence in query.items():
+                if col < n_main_cols:
+                    start, end = self._col_ptr[col], self._col_ptr[col + 1]
+                    rows.append(self._row_idx[start:end])
+                    weights.append(self._values[start:end] * confidence)
+            # y con las del delta
+            size = self._delta_size
+            if size:
+                query_dense = np.zeros(len(self.vocabulary), dtype=np.float32)
+                query_dense[list(query)] = list(query.values())
+                rows.append(self._delta_rows[:size])
+                weights.append(self._delta_values[:size] * query_dense[self._delta_cols[:size]])
+            norms = np.sqrt(np.concatenate([self._norms_sq, self._delta_norms_sq[:len(self.ids) - len(self._norms_sq)]]))
+            ids = self.ids
+            exclude_row = self.rows.get(exclude)
+            deleted = self._deleted[:len(norms)]
+
+        scores = np.bincount(np.concatenate(rows), weights=np.concatenate(weights), minlength=len(norms))
+        # Las filas borradas no son candidatas
+        scores[:len(deleted)][deleted] = 0
+        candidates = np.flatnonzero(scores)
+        if exclude_row is not None:
+            candidates = candidates[candidates != exclude_row]
+        similarity = scores[candidates] / (norms[candidates] * query_norm)
+        if len(candidates) > k:
+            best = np.argpartition(-similarity, k - 1)[:k]
+            candidates, similarity = candidates[best], similarity[best]
+        order = np.argsort(-similarity, kind="stable")
+        return [{"id": ids[row], "similarity": round(float(score), 6)}
+                for row, score in zip(candidates[order], similarity[order])]
+
+def iter_pictures_tags():
+    """
+        Lee de la BBDD, con un cursor de servidor, los tags de todas las imagenes.
+
+    Returns:
+        generator: tuplas (id, tags) con tags una lista de dict con las claves tag y confidence
+    """
+    current_id, tags = None, []
+    for picture_id, tag, confidence in models.stream_query(
+            "SELECT `picture_id`, `tag`, `confidence` FROM `tags` ORDER BY `picture_id`", {}, chunk_size=10000):
+        if picture_id != current_id:
+            if tags:
+                yield models.id_from_db(current_id), tags
+            current_id, tags = picture_id, []
+        tags.append({"tag": tag, "confidence": confidence})
+    if tags:
+        yield models.id_from_db(current_id), tags
+
+def build_index():
+    """
+        Construye el indice con los tags de todas las imagenes de la BBDD, leidos con un cursor de servidor.
+
+    Returns:
+        TagIndex: indice con todas las imagenes con tags
+    """
+    start = time.perf_counter()
+    index = TagIndex(int(os.environ.get("SIMILARITY_MERGE_THRESHOLD", 50000)))
+    index.add_many(iter_pictures_tags())
+    metrics.observe("similarity_index_build_seconds", time.perf_counter() - start)
+    logging.info(f"Indice de similitud construido con {len(index)} imagenes en {time.perf_counter() - start:.2f}s")
+    return index
+
+def get_index():
+    """
+        Devuelve el indice de similitud, construyendolo en la primera llamada. Las imagenes insertadas durante la
+        construccion se añaden al terminar (ver add_picture).
+
+    Returns:
+        TagIndex: indice de similitud
+    """
+    global _index, _building, _pending
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                with _pending_lock:
+                    _building = True
+                index = None
+                try:
+                    index = build_index()
+                finally:
+                    with _pending_lock:
+                        # Las imagenes confirmadas antes de la lectura ya estan en el indice y add las ignora;
+                        # las actualizadas se sustituyen
+                        if index is not None:
+                            for picture_id, tags, replace in _pending:
+                                if replace:
+                                    index.update(picture_id, tags)
+                                else:
+                                    index.add(picture_id, tags)
+                            _index = index
+                        _building = False
+                        _pending = []
+    return _index
+
+def add_picture(picture_id: str, tags: list):
+    """
+        Añade al indice de similitud una imagen recien insertada en la BBDD. Si el indice aun no se ha construido,
+        no hace nada: la imagen se leera de la BBDD al construirlo.
+    Args:
+        picture_id (str): id de la imagen
+        tags (list): dict con las claves tag y confidence
+    """
+    with _pending_lock:
+        if _index is not None:
+            _index.add(picture_id, tags)
+        elif _building:
+            _pending.append((picture_id, tags, False))
+
+def update_picture(picture_id: str, tags: list):
+    """
+        Sustituye en el indice de similitud los tags de una imagen cuyos tags se han modificado en la BBDD.
+        Si el indice aun no se ha construido, no hace nada: la imagen se leera de la BBDD al construirlo.
+    Args:
+        picture_id (str): id de la imagen
+        tags (list): todos los tags de la imagen, dict con las claves tag y confidence
+    """
+    with _pending_lock:
+        if _index is not None:
+            _index.update(picture_id, tags)
+        elif _building:
+            _pending.append((picture_id, tags, True))
+
+def reset():
+    """
+        Descarta el indice, que se vuelve a construir en la siguiente consulta, por ejemplo tras modificar la tabla tags
+        fuera de la API.
+    """
+    global _index
+    with _index_lock:
+        _index = None
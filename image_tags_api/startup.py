@@ -0,0 +1,156 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from sqlalchemy import text
+
+from . import models, metrics, taggers, config
+
+# Estado del arranque del proceso (ver start_warmup e is_ready)
+_ready = threading.Event()
+_lock = threading.Lock()
+_status = {"startup_seconds": None, "checks": {}}
+
+
+def warm_db_pool(n_connections: int = 0, timeout: float = 10):
+    """
+        Abre concurrentemente n_connections conexiones del pool (por defecto DB_POOL_SIZE, como maximo su capacidad con
+        el overflow) y ejecuta en cada una un `SELECT 1`, de forma que las primeras peticiones no pagan el
+        establecimiento de la conexion. Cada conexion se mantiene hasta que estan abiertas todas o pasan timeout
+        segundos: si las peticiones en curso ocupan parte del pool el calentamiento es parcial, pero no es un error.
+    Args:
+        n_connections (int): conexiones a abrir
+        timeout (float): segundos maximos de espera a que esten abiertas todas las conexiones
+
+    Returns:
+        int: conexiones abiertas
+    """
+    pool = models.get_pool_status()
+    n_connections = n_connections or pool["pool_size"]
+    if pool["max_overflow"] >= 0:
+        n_connections = min(n_connections, pool["pool_size"] + pool["max_overflow"])
+    barrier = threading.Barrier(n_connections, timeout=timeout)
+
+    def open_connection():
+        with models.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            # Mantenemos la conexion hasta que esten abiertas todas, para no reutilizar la misma
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=n_connections, thread_name_prefix="warmup-db") as executor:
+        completed = [future.result() for future in [executor.submit(open_connection) for _ in range(n_connections)]]
+    if not all(completed):
+        logging.info(f"Calentamiento parcial del pool de la BBDD: no se han podido mantener abiertas a la vez "
+                     f"{n_connections} conexiones")
+    return n_connections
+
+def warm_external_sessions(tagger_backend: str):
+    """
+        Crea la sesion HTTP compartida, el cliente de Imagekitio y el backend de etiquetado y, si el backend llama a
+        Imagga, abre una conexion keep-alive con Imagga. Un error de conexion no impide el arranque: se registra y la
+        conexion se abrira en la primera peticion.
+    Args:
+        tagger_backend (str): backend de etiquetado (ver taggers.create_tagger)
+
+    Returns:
+        str: resultado del calentamiento
+    """
+    session = models.get_http_session()
+    taggers.get_tagger()
+    if tagger_backend not in ("url", "direct"):
+        return "skipped"
+    if tagger_backend == "url":
+        models.get_imagekit()
+    try:
+        session.head(config.get_settings().imagga_api_url, timeout=models.get_http_timeout())
+    except Exception as error:
+        logging.warning(f"No se ha podido abrir la conexion con Imagga durante el arranque: {error}")
+        return "connection_error"
+    return "ok"
+
+def _run_check(name: str, func, *args):
+    start = time.perf_counter()
+    try:
+        result = {"status": "ok", "result": func(*args)}
+    except Exception as error:
+        logging.error(f"Error en el calentamiento {name}: {error}")
+        result = {"status": "error", "error": str(error)}
+    result["seconds"] = round(time.perf_counter() - start, 4)
+    with _lock:
+        _status["checks"][name] = result
+
+def warm_up(settings, started: float):
+    """
+        Calienta en paralelo el pool de conexiones a la BBDD y las sesiones con los servicios externos, registra el
+        tiempo de arranque desde started y marca el proceso como preparado (ver is_ready).
+    Args:
+        settings (Settings): configuracion del proceso (ver config)
+        started (float): instante de inicio del arranque (time.perf_counter)
+    """
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="warmup")
+    futures = [executor.submit(_run_check, "db", warm_db_pool, settings.warmup_db_connections),
+               executor.submit(_run_check, "external", warm_external_sessions, settings.tagger_backend)]
+    # Las etapas que superan warmup_timeout siguen en segundo plano y constan como timeout
+    wait(futures, timeout=settings.warmup_timeout)
+    executor.shutdown(wait=False)
+    with _lock:
+        for name in ("db", "external"):
+            _status["checks"].setdefault(name, {"status": "timeout"})
+    _finish(started)
+
+def _finish(started: float):
+    seconds = time.perf_counter() - started
+    with _lock:
+        _status["startup_seconds"] = round(seconds, 4)
+    metrics.observe("startup_seconds", seconds)
+    logging.info(f"Arranque completado en {seconds:.3f}s: {get_status()['checks']}")
+    _ready.set()
+
+def start_warmup(settings, started: float):
+    """
+        Arranca el calentamiento en segundo plano (ver warm_up), de forma que el servidor atiende /healthz mientras
+        tanto. Si settings.warmup es false, el proceso se marca como preparado sin calentar.
+    Args:
+        settings (Settings): configuracion del proceso (ver config)
+        started (float): instante de inicio del arranque (time.perf_counter)
+    """
+    if not settings.warmup:
+        _finish(started)
+        return
+    threading.Thread(target=warm_up, args=(settings, started), name="warmup", daemon=True).start()
+
+def is_ready():
+    """
+        Indica si el proceso esta preparado para recibir trafico: el calentamiento ha terminado y la BBDD responde.
+        Si el calentamiento de la BBDD fallo (por ejemplo, porque la BBDD aun no habia arrancado), se vuelve a
+        comprobar con un `SELECT 1`.
+
+    Returns:
+        bool: True si esta preparado
+    """
+    if not _ready.is_set():
+        return False
+    with _lock:
+        db_ok = _status["checks"].get("db", {"status": "ok"})["status"] == "ok"
+    if not db_ok:
+        _run_check("db", warm_db_pool, 1)
+        with _lock:
+            db_ok = _status["checks"]["db"]["status"] == "ok"
+    return db_ok
+
+def get_status():
+    """
+        Devuelve el estado del arranque.
+
+    Returns:
+        dict: con las claves warmed_up, startup_seconds (segundos hasta terminar el calentamiento) y checks (resultado
+            y duracion del calentamiento de la BBDD y de los servicios externos)
+    """
+    with _lock:
+        return {"warmed_up": _ready.is_set(), "startup_seconds": _status["startup_seconds"],
+                "checks": {name: dict(check) for name, check in _status["checks"].items()}}
@@ -0,0 +1,419 @@
+import io
+import os
+import mmap
+import time
+import fcntl
+import shutil
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import models
+
+# Almacen de ficheros de imagenes.
+# Cada imagen tiene una ubicacion (location): un dict con las claves path, segment, seg_offset y seg_length.
+# Las imagenes del almacen original (un fichero por imagen) solo tienen path; las del almacen de segmentos
+# tienen el path del segmento, su nombre y la posicion y longitud de la imagen dentro de el.
+LOCATION_FIELDS = ("path", "segment", "seg_offset", "seg_length")
+
+# Almacen del proceso (ver get_store) y mapas en memoria (mmap) de los segmentos leidos, por path, con el inodo del
+# fichero mapeado y en orden LRU (ver _get_map)
+_store = None
+_store_lock = threading.Lock()
+_maps = OrderedDict()
+_maps_lock = threading.Lock()
+
+
+def flat_location(path: str):
+    """
+        Devuelve la ubicacion de una imagen guardada en su propio fichero.
+    Args:
+        path (str): path del fichero
+
+    Returns:
+        dict: ubicacion de la imagen
+    """
+    return {"path": path, "segment": None, "seg_offset": None, "seg_length": None}
+
+def pop_location(picture: dict):
+    """
+        Extrae de picture las claves de su ubicacion (path, segment, seg_offset y seg_length).
+    Args:
+        picture (dict): imagen devuelta por models
+
+    Returns:
+        dict: ubicacion de la imagen
+    """
+    return {field: picture.pop(field, None) for field in LOCATION_FIELDS}
+
+class FlatStore:
+    """
+        Almacen original: cada imagen en un fichero img_<uuid> de la carpeta de imagenes.
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def put(self, image_bin: bytes, name: str):
+        """
+            Guarda una imagen y devuelve su ubicacion.
+        Args:
+            image_bin (bytes): imagen en binario
+            name (str): nombre de la imagen
+
+        Returns:
+            dict: ubicacion de la imagen
+        """
+        path = os.path.abspath(os.path.join(self.folder, name))
+        models.save_image(image_bin, path)
+        return flat_location(path)
+
+    def put_file(self, source_path: str, name: str, image_bin: bytes = None):
+        """
+            Guarda la imagen del fichero source_path, que se mueve al almacen, y devuelve su ubicacion.
+        Args:
+            source_path (str): fichero temporal con la imagen
+            name (str): nombre de la imagen
+            image_bin (bytes): contenido del fichero, si ya se ha leido
+
+        Returns:
+            dict: ubicacion de la imagen
+        """
+        path = os.path.abspath(os.path.join(self.folder, name))
+        models.move_image(source_path, path)
+        return flat_location(path)
+
+class PackStore:
+    """
+        Almacen de segmentos: las imagenes se añaden al final de ficheros de segmento (packs/seg_<n>.pack) de hasta
+        segment_size bytes; al llenarse un segmento se abre el siguiente. Evita tener un fichero por imagen en un unico
+        directorio. Las escrituras se serializan entre threads con un lock y entre procesos con flock sobre packs/.lock.
+    """
+    def __init__(self, folder: str, segment_size: int):
+        self.folder = os.path.abspath(os.path.join(folder, "packs"))
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._active = None
+        os.makedirs(self.folder, exist_ok=True)
+
+    def segments(self):
+        """
+            Devuelve los nombres de los segmentos del almacen, en orden.
+
+        Returns:
+            list: nombres de los segmentos
+        """
+        return sorted(name for name in os.listdir(self.folder) if name.startswith("seg_") and name.endswith(".pack"))
+
+    def active_segment(self):
+        """
+            Devuelve el nombre del segmento en el que se añaden las imagenes.
+
+        Returns:
+            str: nombre del segmento
+        """
+        if self._active is None:
+            segments = self.segments()
+            self._active = segments[-1] if segments else "seg_000001.pack"
+        return self._active
+
+    def _next_segment(self):
+        segments = self.segments()
+        last = max(int(segments[-1][4:10]), int(self._active[4:10])) if segments else 0
+        return f"seg_{last + 1:06d}.pack"
+
+    def put(self, image_bin: bytes, name: str = None):
+        """
+            Añade una imagen al segmento activo y devuelve su ubicacion.
+        Args:
+            image_bin (bytes): imagen en binario
+            name (str): nombre de la imagen (no se usa, las imagenes se identifican por su ubicacion)
+
+        Returns:
+            dict: ubicacion de la imagen
+        """
+        return self._append(len(image_bin), lambda f: f.write(image_bin))
+
+    @contextmanager
+    def locked(self):
+        """
+            Bloquea las escrituras en los segmentos: entre threads con un lock y entre procesos con flock sobre packs/.lock.
+        """
+        with self._lock, open(os.path.join(self.folder, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append(self, length: int, write):
+        # Escribe length bytes con write(f) al final del segmento activo, o del siguiente si no caben
+        with self.locked():
+            segment = self.active_segment()
+            path = os.path.join(self.folder, segment)
+            # Si la imagen no cabe en el segmento activo, abrimos el siguiente
+            if os.path.exists(path) and os.path.getsize(path) > 0 and \
+                    os.path.getsize(path) + length > self.segment_size:
+                segment = self._active = self._next_segment()
+                path = os.path.join(self.folder, segment)
+            with open(path, "ab") as f:
+                offset = f.tell()
+                write(f)
+                f.flush()
+                if os.environ.get("PACK_FSYNC", "false").lower() == "true":
+                    os.fsync(f.fileno())
+        return {"path": path, "segment": segment, "seg_offset": offset, "seg_length": length}
+
+    def put_file(self, source_path: str, name: str, image_bin: bytes = None):
+        """
+            Añade la imagen del fichero source_path al segmento activo, borra el fichero y devuelve su ubicacion.
+            Si no se ha leido, la imagen se copia del fichero por bloques, sin cargarla completa en memoria.
+        Args:
+            source_path (str): fichero temporal con la imagen
+            name (str): nombre de la imagen
+            image_bin (bytes): contenido del fichero, si ya se ha leido
+
+        Returns:
+            dict: ubicacion de la imagen
+        """
+        if image_bin is not None:
+            location = self.put(image_bin, name)
+        else:
+            with open(source_path, "rb") as source:
+                location = self._append(os.fstat(source.fileno()).st_size,
+                                        lambda f: shutil.copyfileobj(source, f, 1024*1024))
+        os.remove(source_path)
+        return location
+
+def _get_map(path: str, end: int):
+    """
+        Devuelve el mmap de un segmento que cubre al menos hasta el byte end, volviendo a mapearlo si el segmento ha crecido
+        o si se ha sustituido por otro fichero (distinto inodo). Se mantienen como maximo PACK_MAX_MAPS segmentos mapeados
+        (64): al mapear uno nuevo se olvidan los de segmentos borrados (por ejemplo, por la compactacion en otro proceso)
+        o sustituidos y, si se supera el limite, los usados hace mas tiempo.
+        Los mapas olvidados no se cierran explicitamente: otro thread puede estar leyendolos (cerrar un mmap mientras se
+        copia un slice falla con ValueError), y se liberan al soltar su ultima referencia.
+    """
+    stat = os.stat(path)
+    inode = (stat.st_dev, stat.st_ino)
+    with _maps_lock:
+        entry = _maps.get(path)
+        if entry is not None and entry[0] == inode and len(entry[1]) >= end:
+            _maps.move_to_end(path)
+            return entry[1]
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _maps[path] = (inode, mm)
+        _maps.move_to_end(path)
+        # Olvidamos los mapas de segmentos que ya no existen o que se han sustituido
+        for other in [other for other in _maps if other != path]:
+            try:
+                other_stat = os.stat(other)
+                replaced = (other_stat.st_dev, other_stat.st_ino) != _maps[other][0]
+            except FileNotFoundError:
+                replaced = True
+            if replaced:
+                del _maps[other]
+        while len(_maps) > int(os.environ.get("PACK_MAX_MAPS", 64)):
+            _maps.popitem(last=False)
+    return mm
+
+def release_segment(path: str):
+    """
+        Olvida el mmap de un segmento, por ejemplo tras borrarlo en la compactacion.
+    Args:
+        path (str): path del segmento
+    """
+    with _maps_lock:
+        _maps.pop(path, None)
+
+def read(location: dict, length: int = None):
+    """
+        Lee una imagen (o sus primeros length bytes) de su ubicacion. Las imagenes de segmentos se leen del mmap del segmento.
+    Args:
+        location (dict): ubicacion de la imagen
+        length (int): numero de bytes a leer. Por defecto la imagen completa
+
+    Returns:
+        bytes: imagen
+    """
+    if location.get("segment") is None:
+        return models.read_image_header(location["path"], length) if length is not None else models.read_image(location["path"])
+    offset = location["seg_offset"]
+    end = offset + (min(length, location["seg_length"]) if length is not None else location["seg_length"])
+    return _get_map(location["path"], end)[offset:end]
+
+class SegmentFile(io.RawIOBase):
+    """
+        Fichero de solo lectura acotado a una imagen de un segmento: lee con pread los seg_length bytes desde seg_offset,
+        sin copiar la imagen a memoria. Mantiene abierto el segmento, por lo que se puede seguir leyendo aunque la
+        compactacion lo borre.
+    """
+    def __init__(self, location: dict):
+        super().__init__()
+        self._fd = os.open(location["path"], os.O_RDONLY)
+        self._offset = location["seg_offset"]
+        self.length = location["seg_length"]
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.length - self._position)
+        if size <= 0:
+            return 0
+        data = os.pread(self._fd, size, self._offset + self._position)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.length}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+def open_image(location: dict):
+    """
+        Abre una imagen de un segmento para leerla en streaming, sin cargarla en memoria.
+    Args:
+        location (dict): ubicacion de la imagen, en un segmento
+
+    Returns:
+        SegmentFile: fichero acotado a la imagen
+    """
+    return SegmentFile(location)
+
+def exists(location: dict):
+    """
+        Indica si la imagen sigue en disco.
+    Args:
+        location (dict): ubicacion de la imagen
+
+    Returns:
+        bool: True si existe
+    """
+    if location.get("segment") is None:
+        return os.path.exists(location["path"])
+    return os.path.exists(location["path"]) and \
+        os.path.getsize(location["path"]) >= location["seg_offset"] + location["seg_length"]
+
+def get_store():
+    """
+        Devuelve el almacen de imagenes del proceso segun la variable de entorno IMAGE_STORE: `flat` (por defecto), un
+        fichero por imagen en IMAGE_FOLDER, o `pack`, segmentos de PACK_SEGMENT_SIZE bytes (1 GiB) en IMAGE_FOLDER/packs.
+        Conviene activar `pack` tras migrar las imagenes existentes con pack_flat_images.
+
+    Returns:
+        FlatStore | PackStore: almacen de imagenes
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if os.environ.get("IMAGE_STORE", "flat") == "pack":
+                    _store = PackStore(os.environ["IMAGE_FOLDER"], int(os.environ.get("PACK_SEGMENT_SIZE", 1024**3)))
+                else:
+                    _store = FlatStore(os.environ["IMAGE_FOLDER"])
+    return _store
+
+def pack_flat_images(batch: int = 1000):
+    """
+        Migra las imagenes del almacen original (un fichero por imagen) al almacen de segmentos.
+        Cada fichero se añade a un segmento, se actualizan todas las imagenes que lo referencian y se borra el fichero.
+        Se puede interrumpir y volver a ejecutar: solo procesa las imagenes que aun no estan en un segmento.
+    Args:
+        batch (int): numero de imagenes leidas de la BBDD en cada iteracion
+
+    Returns:
+        int: numero de ficheros migrados
+    """
+    store = get_store()
+    assert isinstance(store, PackStore), "IMAGE_STORE debe ser pack para migrar las imagenes a segmentos"
+    packed = 0
+    missing = set()
+    while True:
+        paths = [path for path in models.get_flat_image_paths(batch + len(missing)) if path not in missing][:batch]
+        if len(paths)==0:
+            return packed
+        for path in paths:
+            if not os.path.exists(path):
+                logging.warning(f"No existe el fichero {path}")
+                missing.add(path)
+                continue
+            location = store.put(models.read_image(path))
+            models.update_image_location(flat_location(path), location)
+            os.remove(path)
+            packed += 1
+
+def compact_segments(threshold: float = 0.5, grace: float = None):
+    """
+        Compacta los segmentos cuyo espacio ocupado por imagenes registradas es menor que threshold: copia sus imagenes
+        al segmento activo, actualiza sus ubicaciones y borra el segmento, recuperando el espacio de las imagenes borradas.
+        El segmento activo no se compacta. Las imagenes se guardan en el almacen antes de registrarlas en la BBDD, por lo
+        que tampoco se compactan los segmentos modificados en los ultimos grace segundos, ni se borra un segmento si se
+        ha escrito en el mientras se compactaba (se comprueba con las escrituras bloqueadas).
+    Args:
+        threshold (float): fraccion minima de espacio ocupado para no compactar un segmento
+        grace (float): segundos desde la ultima escritura en un segmento para poder compactarlo. Por defecto
+            PACK_COMPACT_GRACE (600)
+
+    Returns:
+        dict: numero de segmentos compactados y bytes recuperados
+    """
+    store = get_store()
+    assert isinstance(store, PackStore), "IMAGE_STORE debe ser pack para compactar los segmentos"
+    grace = float(os.environ.get("PACK_COMPACT_GRACE", 600)) if grace is None else grace
+    usage = models.get_segments_usage()
+    compacted, reclaimed = 0, 0
+    for segment in store.segments():
+        if segment == store.active_segment():
+            continue
+        path = os.path.join(store.folder, segment)
+        stat = os.stat(path)
+        total = stat.st_size
+        live = usage.get(segment, 0)
+        if total == 0 or live / total >= threshold or time.time() - stat.st_mtime < grace:
+            continue
+        for offset, length in models.get_segment_locations(segment):
+            old = {"path": path, "segment": segment, "seg_offset": offset, "seg_length": length}
+            models.update_image_location(old, store.put(read(old)))
+        with store.locked():
+            current = os.stat(path)
+            if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                logging.warning(f"Se ha escrito en el segmento {segment} durante la compactacion: no se borra")
+                continue
+            release_segment(path)
+            os.remove(path)
+        compacted += 1
+        reclaimed += total - live
+        logging.info(f"Segmento {segment} compactado: {total - live} bytes recuperados")
+    return {"segments": compacted, "bytes": reclaimed}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gestion del almacen de segmentos de imagenes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("pack", help="migra las imagenes de IMAGE_FOLDER (un fichero por imagen) a segmentos")
+    compact_parser = subparsers.add_parser("compact", help="compacta los segmentos con espacio de imagenes borradas")
+    compact_parser.add_argument("--threshold", type=float, default=0.5,
+                                help="fraccion minima de espacio ocupado para no compactar un segmento (0.5)")
+    compact_parser.add_argument("--grace", type=float, default=None,
+                                help="segundos sin escrituras para compactar un segmento (PACK_COMPACT_GRACE, 600)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "pack":
+        print(f"Imagenes migradas a segmentos: {pack_flat_images()}")
+    else:
+        print(f"Compactacion: {compact_segments(args.threshold, args.grace)}")
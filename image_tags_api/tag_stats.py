@@ -0,0 +1,14 @@
+import argparse
+import logging
+
+from . import models
+
+# Mantenimiento de la tabla tag_stats (estadisticas de confianza por tag y dia usadas por GET /tags)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mantenimiento de las estadisticas por tag y dia (tabla tag_stats)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild", help="recalcula tag_stats a partir de la tabla tags")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(f"Filas de tag_stats recalculadas: {models.rebuild_tag_stats()}")
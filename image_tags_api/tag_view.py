@@ -1,7 +1,9 @@
 from flask import Blueprint, request, make_response
 import datetime
+import logging
 
 from image_tags_api.controller import get_tags_by_date
+from image_tags_api.appexceptions import BBDDConexionError, BBDDObjetoError
 
 tag_bp = Blueprint('tag', __name__, url_prefix='/')
 
@@ -13,12 +15,15 @@ def get_tags():
     Query parameters:
         min_date (str): Fecha minima de las imagenes en formato `YYYY-MM-DD HH:MM:SS`.
         max_date (str): Fecha maxima de las imagenes en formato `YYYY-MM-DD HH:MM:SS`.
+        limit (int): Numero maximo de tags a devolver.
+        order_by (str): `n` o `mean_confidence`. Ordena las tags de mayor a menor por ese campo. Por defecto se ordenan por tag.
+        min_confidence (int): Las estadisticas solo incluyen las tags con confidence superior. Por defecto 80.
 
     Returns:
         json: 
         
             - `tag`: nombre de la etiqueta
-            - `n_images`: número de imágenes que tienen asociada esta tag
+            - `n`: número de imágenes que tienen asociada esta tag
             - `min_confidence`, `max_confidence`, `mean_confidence`: confianza mínima, máxima y media de esta tag para todas las imágenes con las que está asignada.
     """
     try:
@@ -40,13 +45,38 @@ def get_tags():
     except ValueError:
         return make_response({"description": "max_date debe ser una fecha en formato %Y-%m-%d %H:%M:%S"}, 400)
 
-    # Inicializamos la respuesta
-    response=[]
-    # Obtenemos las tags de las imagenes entre min_date y max_date
-    tags= get_tags_by_date(min_date, max_date)
-    # Recorremos los tags y calculamos el minimo, maximo y promedio de confianza
-    _ = [response.append({"tag":tag, "n": len(tags[tag]['confidences']), "min_confidence":min(tags[tag]['confidences']), 
-                      "max_confidence":max(tags[tag]['confidences']),
-                     "mean_confidence":sum(tags[tag]['confidences'])/len(tags[tag]['confidences'])}) for tag in tags.keys()]
+    try:
+        # Leemos el query parameter limit
+        limit= int(request.args["limit"]) if 'limit' in request.args else None
+        # Validamos que limit sea positivo
+        if limit is not None and limit <= 0:
+            return make_response({"description": "limit debe ser un entero positivo"}, 400)
+    except ValueError:
+        return make_response({"description": "limit debe ser un entero"}, 400)
+
+    # Leemos el query parameter order_by
+    order_by= request.args.get("order_by")
+    if order_by is not None and order_by not in ("n", "mean_confidence"):
+        return make_response({"description": "order_by debe ser n o mean_confidence"}, 400)
+
+    try:
+        # Leemos el query parameter min_confidence
+        min_confidence= int(request.args.get("min_confidence", 80))
+        # Validamos que min_confidence este entre 0 y 100
+        if min_confidence < 0 or min_confidence > 100:
+            return make_response({"description": "min_confidence debe estar entre 0 y 100"}, 400)
+    except ValueError:
+        return make_response({"description": "min_confidence debe ser un entero"}, 400)
+
+    try:
+        # Obtenemos las tags entre min_date y max_date con su minimo, maximo y promedio de confianza
+        response= get_tags_by_date(min_date, max_date, limit, order_by, min_confidence)
+        logging.info("Tags obtenidas de BBDD")
+    except BBDDConexionError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
+    except BBDDObjetoError as error:
+        logging.error(error)
+        return make_response({"description": str(error)}, 501)
 
     return response
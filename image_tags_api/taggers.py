@@ -0,0 +1,137 @@
+from typing import List
+
+import time
+import base64
+import random
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+
+from . import models, config, cleanup
+from .appexceptions import ImageKitError, ImaggaError
+
+
+class Tagger(ABC):
+    """
+        Interfaz de los backends de etiquetado de imagenes.
+        Cada backend implementa get_tags, que devuelve todos los tags de una imagen con su confidence.
+    """
+    @abstractmethod
+    def get_tags(self, image_bin: bytes, filename: str) -> List:
+        """
+            Devuelve los tags de una imagen.
+        Args:
+            image_bin (bytes): imagen en binario
+            filename (str): nombre de la imagen
+
+        Returns:
+            list: lista de tags: cada elemento es un Dict con claves:
+                - tag
+                - confidence
+        """
+
+class UrlTagger(Tagger):
+    """
+        Backend original: sube la imagen a Imagekitio para obtener una url publica, solicita los tags de esa url a Imagga
+        y borra la imagen de Imagekitio. El borrado no afecta al resultado: se encola en segundo plano, con reintentos
+        (ver cleanup), tambien si Imagga falla.
+    """
+    def get_tags(self, image_bin: bytes, filename: str) -> List:
+        try:
+            # Upload the image to imagekitio
+            upload_info = models.get_image_url(base64.b64encode(image_bin).decode(), filename)
+        except Exception as error:
+            raise ImageKitError(f"Error al subir la imagen a Imagekitio: {error}")
+        try:
+            # Requests the tags of the image to imagga
+            tags = models.get_tags_url(upload_info.response_metadata.raw['url'])
+        except Exception as error:
+            raise ImaggaError(f"Error al obtener los tags de la imagen de Imagga: {error}")
+        finally:
+            # Delete the image from  imagekitio in the background
+            cleanup.schedule_delete(upload_info.file_id)
+
+        return tags
+
+class DirectTagger(Tagger):
+    """
+        Envia la imagen directamente a Imagga en una unica peticion, sin pasar por Imagekitio.
+    """
+    def get_tags(self, image_bin: bytes, filename: str) -> List:
+        try:
+            # Requests the tags of the image to imagga
+            return models.get_tags_bytes(image_bin, filename)
+        except Exception as error:
+            raise ImaggaError(f"Error al obtener los tags de la imagen de Imagga: {error}")
+
+class FakeTagger(Tagger):
+    """
+        Backend en proceso para tests y benchmarks: no realiza llamadas remotas y devuelve tags deterministas
+        derivados del contenido de la imagen, tras esperar latency segundos mas el tiempo de enviar la imagen
+        con un ancho de banda de bandwidth bytes por segundo (0 para no simularlo).
+    """
+    VOCABULARY = ["car", "vehicle", "motor vehicle", "wheel", "road", "transportation", "sky", "tree", "building",
+                  "city", "street", "person", "people", "office", "work", "computer", "table", "chair", "room",
+                  "interior", "light", "window", "sport", "speed", "auto", "drive", "travel", "landscape", "water", "grass"]
+
+    def __init__(self, latency: float = 0.0, n_tags: int = 10, bandwidth: float = 0.0):
+        self.latency = latency
+        self.n_tags = n_tags
+        self.bandwidth = bandwidth
+
+    def get_tags(self, image_bin: bytes, filename: str) -> List:
+        delay = self.latency + (len(image_bin) / self.bandwidth if self.bandwidth > 0 else 0)
+        if delay > 0:
+            time.sleep(delay)
+        rnd = random.Random(hashlib.sha256(image_bin).digest())
+        return [{"tag": tag, "confidence": round(rnd.uniform(5, 100), 4)} for tag in rnd.sample(self.VOCABULARY, self.n_tags)]
+
+# Backend de etiquetado del proceso (ver get_tagger)
+_tagger = None
+_tagger_lock = threading.Lock()
+
+
+def create_tagger(backend: str):
+    """
+        Crea el backend de etiquetado backend: `url`, `direct` o `fake`.
+        El backend `fake` espera FAKE_TAGGER_LATENCY segundos (0 por defecto) en cada imagen, mas el tiempo de envio
+        con un ancho de banda de FAKE_TAGGER_BANDWIDTH bytes por segundo (0 por defecto, sin simular) (ver config).
+    Args:
+        backend (str): nombre del backend
+
+    Returns:
+        Tagger: backend de etiquetado
+    """
+    if backend == "url":
+        return UrlTagger()
+    if backend == "direct":
+        return DirectTagger()
+    if backend == "fake":
+        settings = config.get_settings()
+        return FakeTagger(latency=settings.fake_tagger_latency, bandwidth=settings.fake_tagger_bandwidth)
+    raise ValueError(f"TAGGER_BACKEND desconocido: {backend}. Valores validos: url, direct, fake")
+
+def get_tagger():
+    """
+        Devuelve el backend de etiquetado del proceso, creandolo segun la configuracion TAGGER_BACKEND (`url` por defecto,
+        ver config).
+
+    Returns:
+        Tagger: backend de etiquetado
+    """
+    global _tagger
+    if _tagger is None:
+        with _tagger_lock:
+            if _tagger is None:
+                _tagger = create_tagger(config.get_settings().tagger_backend)
+    return _tagger
+
+def set_tagger(tagger: Tagger):
+    """
+        Sustituye el backend de etiquetado del proceso, por ejemplo por un FakeTagger en tests y benchmarks.
+    Args:
+        tagger (Tagger): backend de etiquetado
+    """
+    global _tagger
+    with _tagger_lock:
+        _tagger = tagger
@@ -0,0 +1,5 @@
+-- Indices para los filtros de GET /images
+-- El filtro por tags (tag IN (...) GROUP BY picture_id) se resuelve sobre el indice (tag, picture_id),
+-- que ya es la PRIMARY KEY de Pictures.tags, por lo que no se crea un indice duplicado.
+-- El filtro por rango de fechas necesita un indice sobre Pictures.pictures(date).
+create index idx_pictures_date on Pictures.pictures (date);
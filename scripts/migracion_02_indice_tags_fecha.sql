@@ -0,0 +1,4 @@
+-- Indice para las estadisticas de GET /tags
+-- La agregacion GROUP BY tag filtra por Pictures.tags(date); el indice (date, tag, confidence)
+-- permite resolver el rango de fechas y la agregacion recorriendo solo el indice.
+create index idx_tags_date on Pictures.tags (date, tag, confidence);
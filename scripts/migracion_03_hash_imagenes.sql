@@ -0,0 +1,6 @@
+-- Deduplicacion de imagenes por contenido
+-- hash: SHA-256 del contenido de la imagen
+-- min_confidence: confianza minima con la que se filtraron los tags guardados de la imagen
+alter table Pictures.pictures add column hash CHAR(64) NULL,
+                              add column min_confidence INT NULL;
+create index idx_pictures_hash on Pictures.pictures (hash, min_confidence);
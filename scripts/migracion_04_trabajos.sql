@@ -0,0 +1,12 @@
+-- Cola persistente de trabajos de registro de imagenes (POST /image?async=true)
+-- status: pending, running, done o error
+-- result: json con la imagen registrada o con la descripcion del error
+create table Pictures.jobs (id VARCHAR(36) PRIMARY KEY,
+                            status VARCHAR(16) NOT NULL,
+                            path VARCHAR(256) NOT NULL,
+                            min_confidence INT NOT NULL,
+                            result TEXT NULL,
+                            created VARCHAR(25) NOT NULL,
+                            updated VARCHAR(25) NOT NULL
+                            );
+create index idx_jobs_status on Pictures.jobs (status, created);
@@ -0,0 +1,9 @@
+-- Ubicacion de cada imagen en el almacen de segmentos (ver image_tags_api/storage.py):
+-- nombre del segmento, posicion y longitud de la imagen dentro de el.
+-- Las imagenes guardadas en su propio fichero (almacen flat) tienen estas columnas a NULL.
+ALTER TABLE Pictures.pictures
+    ADD COLUMN segment VARCHAR(64) NULL,
+    ADD COLUMN seg_offset BIGINT NULL,
+    ADD COLUMN seg_length INT NULL;
+
+CREATE INDEX idx_pictures_segment ON Pictures.pictures (segment, seg_offset);
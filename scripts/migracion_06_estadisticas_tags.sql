@@ -0,0 +1,17 @@
+-- Estadisticas de confianza por tag y dia para GET /tags
+-- Se actualizan en la misma transaccion que la insercion de los tags de cada imagen. GET /tags suma las filas
+-- de los dias completos del rango y solo agrega Pictures.tags para los dias parciales de los extremos.
+-- Se recalculan con: python -m image_tags_api.tag_stats rebuild
+create table Pictures.tag_stats (tag VARCHAR(32) NOT NULL,
+                                 day DATE NOT NULL,
+                                 n INT NOT NULL,
+                                 sum_confidence BIGINT NOT NULL,
+                                 min_confidence INT NOT NULL,
+                                 max_confidence INT NOT NULL,
+                                 PRIMARY KEY (tag, day)
+                                 );
+create index idx_tag_stats_day on Pictures.tag_stats (day);
+
+insert into Pictures.tag_stats (tag, day, n, sum_confidence, min_confidence, max_confidence)
+    select tag, SUBSTR(date, 1, 10), COUNT(*), SUM(confidence), MIN(confidence), MAX(confidence)
+    from Pictures.tags group by tag, SUBSTR(date, 1, 10);
@@ -0,0 +1,15 @@
+-- Versiones del esquema aplicadas (ver python -m image_tags_api.migrations)
+-- Cada migracion registra su version al final del script. Esta registra tambien las anteriores, que se aplicaron
+-- antes de existir la tabla (al crear la BBDD con docker-entrypoint-initdb.d).
+create table if not exists Pictures.schema_version (version INT PRIMARY KEY,
+                                                    name VARCHAR(128) NOT NULL,
+                                                    applied DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                                                    );
+insert ignore into Pictures.schema_version (version, name) values
+    (1, 'indices'),
+    (2, 'indice_tags_fecha'),
+    (3, 'hash_imagenes'),
+    (4, 'trabajos'),
+    (5, 'almacen_segmentos'),
+    (6, 'estadisticas_tags'),
+    (7, 'versiones_esquema');
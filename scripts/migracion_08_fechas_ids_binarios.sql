@@ -0,0 +1,27 @@
+-- Tipos compactos para fechas e ids de imagenes
+-- date pasa de VARCHAR(25) a DATETIME (5 bytes en lugar de hasta 26), de forma que los filtros por rango comparan
+-- fechas y no cadenas, y los ids de imagenes de VARCHAR(36) a BINARY(16) (UUID_TO_BIN), reduciendo las claves
+-- primarias y todos los indices que las incluyen. Los indices sobre date (idx_pictures_date, idx_tags_date) se conservan.
+-- La capa models convierte los ids a texto y las fechas al formato %Y-%m-%d %H:%M:%S.
+
+-- La clave ajena de tags se vuelve a crear sobre los nuevos tipos
+alter table Pictures.tags drop foreign key tags_ibfk_1;
+
+alter table Pictures.pictures add column id_bin BINARY(16) NULL;
+update Pictures.pictures set id_bin = UUID_TO_BIN(id);
+alter table Pictures.pictures drop primary key, drop column id;
+alter table Pictures.pictures rename column id_bin to id;
+alter table Pictures.pictures modify id BINARY(16) NOT NULL FIRST,
+                              add primary key (id),
+                              modify date DATETIME NOT NULL;
+
+alter table Pictures.tags add column picture_id_bin BINARY(16) NULL;
+update Pictures.tags set picture_id_bin = UUID_TO_BIN(picture_id);
+alter table Pictures.tags drop primary key, drop column picture_id;
+alter table Pictures.tags rename column picture_id_bin to picture_id;
+alter table Pictures.tags modify picture_id BINARY(16) NOT NULL AFTER tag,
+                          add primary key (tag, picture_id),
+                          modify date DATETIME NOT NULL,
+                          add foreign key (picture_id) references Pictures.pictures(id);
+
+insert into Pictures.schema_version (version, name) values (8, 'fechas_ids_binarios');
@@ -0,0 +1,9 @@
+-- Filtro min_confidence en las consultas
+-- Las imagenes nuevas guardan todos los tags devueltos por el backend de etiquetado (pictures.min_confidence=0) y
+-- GET /images, GET /image/<id> y GET /tags aplican min_confidence al consultar. El filtro por tags de GET /images
+-- (tag IN (...) AND confidence>:min_confidence) recorre el indice (tag, confidence); InnoDB añade picture_id, de la
+-- clave primaria, por lo que el indice cubre la subconsulta.
+-- Los tags de las imagenes anteriores se completan con: python -m image_tags_api.backfill
+create index idx_tags_tag_confidence on Pictures.tags (tag, confidence);
+
+insert into Pictures.schema_version (version, name) values (9, 'indice_tags_confianza');
@@ -0,0 +1,10 @@
+-- Estadisticas por tag y dia solo de los tags con confianza superior a 80
+-- Desde la migracion 9 se guardan todos los tags, y GET /images, GET /image/<id> y GET /tags aplican por defecto
+-- min_confidence=80 al consultar, como hacia antes POST /image al guardarlos. tag_stats se recalcula con los tags
+-- de confianza superior a 80 (models.TAG_STATS_MIN_CONFIDENCE) para que GET /tags siga usandola por defecto.
+delete from Pictures.tag_stats;
+insert into Pictures.tag_stats (tag, day, n, sum_confidence, min_confidence, max_confidence)
+    select tag, DATE(date), COUNT(*), SUM(confidence), MIN(confidence), MAX(confidence)
+    from Pictures.tags where confidence > 80 group by tag, DATE(date);
+
+insert into Pictures.schema_version (version, name) values (10, 'estadisticas_tags_confianza');
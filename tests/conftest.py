@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from benchmarks.common import create_sqlite_database
+from image_tags_api import create_app, cache, similarity, storage, taggers
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "data")
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+        BBDD SQLite temporal con el esquema de benchmarks.common, con el engine del proceso apuntando a ella.
+    """
+    path = create_sqlite_database(str(tmp_path / "pictures.sqlite"))
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{path}")
+    return path
+
+@pytest.fixture
+def client(database, tmp_path, monkeypatch):
+    """
+        Cliente de la API sobre la BBDD temporal, con el backend de etiquetado fake y sin workers ni calentamiento.
+    """
+    monkeypatch.setenv("IMAGE_FOLDER", str(tmp_path / "images"))
+    monkeypatch.setenv("CREDENTIALS_FILE", str(tmp_path / "credentials.json"))
+    monkeypatch.setenv("TAGGER_BACKEND", "fake")
+    monkeypatch.setenv("JOBS_WORKERS", "0")
+    monkeypatch.setenv("WARMUP", "false")
+    os.makedirs(tmp_path / "images")
+    # Estado del proceso que depende de la configuracion
+    monkeypatch.setattr(storage, "_store", None)
+    taggers.set_tagger(None)
+    cache.reset()
+    similarity.reset()
+    app = create_app()
+    yield app.test_client()
+    taggers.set_tagger(None)
+
+@pytest.fixture
+def image_bin():
+    with open(os.path.join(DATA_FOLDER, "car1.jpg"), "rb") as f:
+        return f.read()
@@ -0,0 +1,183 @@
+import json
+import uuid
+import random
+
+import pytest
+
+from image_tags_api import cache, controller, metrics, models
+
+rng = random.Random(0)
+
+
+@pytest.mark.parametrize("value", [
+    [],
+    {"tag": "car"},
+    [{"tag": "car", "n": 1}] * 10,
+    [{"id": f"{i:032x}", "date": "2023-05-01 10:00:00", "size": i,
+      "tags": [{"tag": "car", "confidence": 90}] * rng.randint(0, 8)} for i in range(1000)],
+])
+def test_estimate_size(value):
+    size = len(json.dumps(value, default=str))
+
+    assert cache.estimate_size(value) == pytest.approx(size, rel=0.2)
+
+
+class Clock:
+    """
+        Reloj monotonic controlado por el test.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+@pytest.fixture
+def caches(monkeypatch):
+    """
+        Vuelve a crear las caches del proceso tras el test, con la configuracion original.
+    """
+    yield
+    monkeypatch.undo()
+    cache.reset()
+
+def counters(name):
+    return {counter: metrics.get_counter(f"{name}_{counter}") for counter in ("hits", "misses", "expired", "evictions")}
+
+def counters_delta(name, before):
+    return {counter: value - before[counter] for counter, value in counters(name).items()}
+
+
+def test_lru_eviction_order(clock):
+    lru = cache.LRUCache("test_lru", max_entries=3, ttl=60)
+    before = counters("test_lru")
+    for key in ("a", "b", "c"):
+        lru.set(key, key.upper())
+    # Leer a la convierte en la mas reciente: se expulsa b
+    assert lru.get("a") == "A"
+    lru.set("d", "D")
+
+    assert lru.get("b") is None
+    assert [lru.get(key) for key in ("a", "c", "d")] == ["A", "C", "D"]
+    assert counters_delta("test_lru", before) == {"hits": 4, "misses": 1, "expired": 0, "evictions": 1}
+
+def test_ttl_expiry(clock):
+    lru = cache.LRUCache("test_ttl", max_entries=10, ttl=10)
+    before = counters("test_ttl")
+    lru.set("a", 1)
+
+    clock.now += 9.9
+    assert lru.get("a") == 1
+    clock.now += 0.1
+    assert lru.get("a") is None
+
+    assert lru.stats() == {"entries": 0, "bytes": 0}
+    assert counters_delta("test_ttl", before) == {"hits": 1, "misses": 1, "expired": 1, "evictions": 0}
+
+def test_max_bytes_bound(clock):
+    lru = cache.LRUCache("test_bytes", max_entries=10, ttl=60, max_bytes=100)
+    before = counters("test_bytes")
+    for key in ("a", "b", "c"):
+        lru.set(key, key, size=40)
+
+    assert lru.stats() == {"entries": 2, "bytes": 80}
+    assert lru.get("a") is None
+    # Un valor mayor que el limite no se cachea ni expulsa a los demas
+    lru.set("big", "big", size=101)
+    assert lru.get("big") is None
+    assert lru.stats() == {"entries": 2, "bytes": 80}
+    # Sustituir un valor descuenta su tamaño anterior
+    lru.set("b", "b", size=10)
+    assert lru.stats() == {"entries": 2, "bytes": 50}
+    assert counters_delta("test_bytes", before)["evictions"] == 1
+
+def test_picture_data_max_bytes(clock, caches, monkeypatch):
+    monkeypatch.setenv("PICTURE_CACHE_MAX_BYTES", "100")
+    cache.reset()
+    loads = []
+    def loader(data):
+        return lambda: loads.append(data) or data
+
+    cache.get_picture_data("p1", loader("x" * 60))
+    cache.get_picture_data("p2", loader("y" * 60))
+    cache.get_picture_data("p2", loader("y" * 60))
+    cache.get_picture_data("p1", loader("x" * 60))
+
+    assert loads == ["x" * 60, "y" * 60, "x" * 60]
+    assert cache.get_cache_stats()["picture_data_cache"]["bytes"] <= 100
+
+def test_shared_tier(clock, caches, monkeypatch):
+    monkeypatch.setenv("PICTURE_CACHE_REDIS_URL", "fake://")
+    monkeypatch.setenv("PICTURE_CACHE_TTL", "60")
+    cache.reset()
+    loads = []
+    def loader(picture_id):
+        loads.append(picture_id)
+        return {"id": picture_id, "tags": []}
+    local, _, _, shared = cache._get_caches()
+
+    assert cache.get_picture("p1", loader) == {"id": "p1", "tags": []}
+    # Otro proceso (sin la entrada en su cache local) la lee del nivel compartido
+    local.clear()
+    assert cache.get_picture("p1", loader) == {"id": "p1", "tags": []}
+    assert loads == ["p1"]
+    # Las imagenes que no existen no se cachean
+    assert cache.get_picture("p2", lambda picture_id: {}) == {}
+    assert shared.get("p2") is None
+    # El nivel compartido tambien caduca
+    local.clear()
+    clock.now += 61
+    cache.get_picture("p1", loader)
+    assert loads == ["p1", "p1"]
+    # invalidate_picture borra la imagen de los dos niveles
+    cache.invalidate_picture("p1")
+    assert local.get("p1") is None and shared.get("p1") is None
+
+def test_invalidate_picture_after_insert(client):
+    picture_id = str(uuid.uuid4())
+    # Entrada obsoleta de la imagen en la cache
+    cache.get_picture(picture_id, lambda _: {"id": picture_id, "tags": [{"tag": "old", "confidence": 99}]})
+
+    controller.register_image_tags_bd(picture_id, "x.jpg", [{"tag": "car", "confidence": 90}], "2023-05-01 10:00:00", 100)
+
+    picture = cache.get_picture(picture_id, models.get_image_by_id)
+    assert [t["tag"] for t in picture["tags"]] == ["car"]
+
+def test_invalidate_picture_after_refresh(client, image_bin):
+    picture = client.post("/image?min_confidence=0&return_data=false", data=image_bin,
+                          content_type="application/octet-stream").json
+    tags = client.get(f"/image/{picture['id']}?min_confidence=0").json["tags"]
+    models.add_picture_tags(picture["id"], picture["date"], [{"tag": "backfill", "confidence": 95}])
+
+    # Hasta que se refresca, la imagen se sirve de la cache
+    assert client.get(f"/image/{picture['id']}?min_confidence=0").json["tags"] == tags
+    assert client.post("/images/refresh", json={"ids": [picture["id"]]}).json == {"refreshed": 1}
+    refreshed = client.get(f"/image/{picture['id']}?min_confidence=0").json["tags"]
+    assert sorted(t["tag"] for t in refreshed) == sorted([t["tag"] for t in tags] + ["backfill"])
+
+def test_shared_generation(caches, monkeypatch):
+    monkeypatch.setenv("PICTURE_CACHE_REDIS_URL", "fake://")
+    cache.reset()
+    loads = []
+    def loader():
+        loads.append(1)
+        return [{"tag": "car", "n": len(loads)}]
+    shared = cache._get_caches()[3]
+
+    assert cache.get_response("tags", {}, loader) == cache.get_response("tags", {}, loader)
+    assert len(loads) == 1
+    # Una insercion en otro proceso con el mismo servidor (backfill, tag_stats rebuild) solo incrementa el contador
+    # compartido, y las respuestas de este proceso dejan de usarse
+    shared.client.incr(cache.GENERATION_KEY)
+    assert cache.get_response("tags", {}, loader) == [{"tag": "car", "n": 2}]
+    # Las inserciones de este proceso incrementan las dos generaciones
+    cache.bump_generation()
+    assert shared.get_counter(cache.GENERATION_KEY) == 2
+    assert cache.get_response("tags", {}, loader) == [{"tag": "car", "n": 3}]
@@ -0,0 +1,77 @@
+import base64
+import uuid
+
+import pytest
+
+from image_tags_api import controller, models
+
+
+def insert_pictures(dates):
+    """
+        Inserta una imagen con un tag de confianza 90 por cada fecha de dates y devuelve sus ids.
+    """
+    ids = []
+    for date in dates:
+        picture_id = str(uuid.uuid4())
+        models.insert_picture_tags(picture_id, date, f"{picture_id}.jpg", 100, [{"tag": "car", "confidence": 90}], min_confidence=0)
+        ids.append(picture_id)
+    return ids
+
+def get_all_pages(client, limit, query=""):
+    """
+        Recorre las paginas de GET /images siguiendo la cabecera X-Next-Cursor y devuelve los ids en orden.
+    """
+    ids = []
+    url = f"/images?limit={limit}{query}"
+    while True:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.json) <= limit
+        ids += [picture["id"] for picture in response.json]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return ids
+        url = f"/images?limit={limit}&cursor={cursor}{query}"
+
+
+def test_cursor_round_trip():
+    picture = {"id": str(uuid.uuid4()), "date": "2023-05-01 10:00:00"}
+
+    assert controller.decode_cursor(controller.encode_cursor(picture)) == (picture["date"], picture["id"])
+
+@pytest.mark.parametrize("cursor", [
+    "no es base64!",
+    base64.urlsafe_b64encode(b"{}").decode(),
+    base64.urlsafe_b64encode(b'["2023-05-01 10:00:00"]').decode(),
+    base64.urlsafe_b64encode(b'["2023-05-01", "c0a8e0e2-5f1b-4d8e-9a3e-2b7a1f4c6d10"]').decode(),
+    base64.urlsafe_b64encode(b'["2023-05-01 10:00:00", "x\' OR 1=1"]').decode(),
+])
+def test_cursor_invalid(client, cursor):
+    with pytest.raises(ValueError):
+        controller.decode_cursor(cursor)
+    assert client.get(f"/images?limit=2&cursor={cursor}").status_code == 400
+
+def test_pages_cover_all_pictures(client):
+    ids = insert_pictures([f"2023-05-0{day} 10:00:00" for day in range(1, 8)])
+
+    paged = get_all_pages(client, 3)
+
+    # Las imagenes se devuelven por fecha descendente, sin repetidos ni huecos entre paginas
+    assert paged == list(reversed(ids))
+    assert paged == [picture["id"] for picture in client.get("/images").json]
+
+def test_pages_tie_break_same_date(client):
+    # Varias imagenes con la misma fecha que caen en el limite entre paginas
+    ids = insert_pictures(["2023-05-02 10:00:00"] + ["2023-05-01 10:00:00"] * 5 + ["2023-04-30 10:00:00"])
+
+    paged = get_all_pages(client, 2)
+
+    assert sorted(paged) == sorted(ids)
+    assert len(paged) == len(set(paged))
+    assert paged[0] == ids[0] and paged[-1] == ids[-1]
+
+def test_pages_with_tags_filter(client):
+    ids = insert_pictures(["2023-05-01 10:00:00"] * 4)
+
+    assert sorted(get_all_pages(client, 3, "&tags=car")) == sorted(ids)
+    assert get_all_pages(client, 3, "&tags=bus") == []
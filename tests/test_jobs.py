@@ -0,0 +1,38 @@
+import pytest
+
+from image_tags_api import jobs, models, taggers
+
+
+def test_run_job(client, image_bin):
+    job_id = jobs.submit(image_bin, 80)
+
+    jobs.run_job(job_id)
+
+    job = jobs.get_job_status(job_id)
+    assert job["status"] == "done"
+    # La imagen se registra con el id del trabajo
+    assert job["result"]["id"] == job_id
+    assert len(models.get_tags_by_picture_id(job_id)) == taggers.FakeTagger().n_tags
+
+def test_recover_job_interrupted_after_register(client, image_bin, monkeypatch):
+    job_id = jobs.submit(image_bin, 80)
+    # El proceso se detiene tras registrar la imagen y antes de terminar el trabajo
+    finish_job = models.finish_job
+    def crash(*args):
+        raise SystemExit("proceso detenido")
+    monkeypatch.setattr(models, "finish_job", crash)
+    with pytest.raises(SystemExit):
+        jobs.run_job(job_id)
+    monkeypatch.setattr(models, "finish_job", finish_job)
+    assert jobs.get_job_status(job_id)["status"] == "running"
+
+    # Al arrancar se recupera el trabajo; el fichero del trabajo ya se ha movido al almacen
+    models.reset_running_jobs(jobs._now())
+    monkeypatch.setattr(taggers.FakeTagger, "get_tags", pytest.fail)
+    jobs.run_job(job_id)
+
+    job = jobs.get_job_status(job_id)
+    assert job["status"] == "done"
+    assert job["result"]["id"] == job_id
+    assert sorted(t["tag"] for t in job["result"]["tags"]) == \
+        sorted(t["tag"] for t in models.get_tags_by_picture_id(job_id) if t["confidence"] > 80)
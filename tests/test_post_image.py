@@ -0,0 +1,81 @@
+import io
+import base64
+import hashlib
+
+import pytest
+
+from image_tags_api import models, preprocess, storage, taggers
+
+
+def test_tagger_is_abstract():
+    with pytest.raises(TypeError):
+        taggers.Tagger()
+
+def test_post_image_stores_all_tags(client, image_bin):
+    response = client.post("/image", json={"data": base64.b64encode(image_bin).decode()})
+
+    assert response.status_code == 200
+    picture = response.json
+    assert isinstance(taggers.get_tagger(), taggers.FakeTagger)
+    # Se guardan todos los tags del backend y la respuesta solo incluye los de confianza superior a 80
+    stored = models.get_tags_by_picture_id(picture["id"])
+    assert len(stored) == taggers.FakeTagger().n_tags
+    assert sorted(t["tag"] for t in picture["tags"]) == sorted(t["tag"] for t in stored if t["confidence"] > 80)
+    assert picture["size"] == len(image_bin)
+    assert picture["data"] == base64.b64encode(image_bin).decode()
+
+def test_post_image_binary_min_confidence(client, image_bin):
+    response = client.post("/image?min_confidence=0&return_data=false", data=image_bin,
+                           content_type="application/octet-stream")
+
+    assert response.status_code == 200
+    picture = response.json
+    assert "data" not in picture
+    assert len(picture["tags"]) == taggers.FakeTagger().n_tags
+    # La imagen registrada se puede consultar por id con todos sus tags
+    stored = client.get(f"/image/{picture['id']}?min_confidence=0").json
+    assert sorted(t["tag"] for t in stored["tags"]) == sorted(t["tag"] for t in picture["tags"])
+    assert base64.b64decode(stored["data"]) == image_bin
+
+def test_post_image_duplicate_reuses_tags(client, image_bin):
+    data = {"data": base64.b64encode(image_bin).decode()}
+    first = client.post("/image?min_confidence=0", json=data).json
+    second = client.post("/image?min_confidence=0", json=data).json
+
+    assert second["id"] != first["id"]
+    assert sorted(t["tag"] for t in second["tags"]) == sorted(t["tag"] for t in first["tags"])
+
+@pytest.mark.parametrize("query, body", [("", {"data": "no es base64!"}), ("", {}), ("?min_confidence=101", None),
+                                         ("?min_confidence=x", None)])
+def test_post_image_invalid(client, image_bin, query, body):
+    if body is None:
+        body = {"data": base64.b64encode(image_bin).decode()}
+    assert client.post(f"/image{query}", json=body).status_code == 400
+
+@pytest.mark.parametrize("image_store", ["flat", "pack"])
+@pytest.mark.parametrize("multipart", [False, True])
+def test_post_image_binary_from_file(client, image_bin, monkeypatch, image_store, multipart):
+    monkeypatch.setenv("IMAGE_STORE", image_store)
+    monkeypatch.setattr(storage, "_store", None)
+    # Sin return_data la imagen se etiqueta y se guarda desde el fichero temporal, sin leerla completa
+    monkeypatch.setattr(models, "read_image", pytest.fail)
+    if multipart:
+        response = client.post("/image?min_confidence=0", data={"image": (io.BytesIO(image_bin), "car1.jpg")},
+                               content_type="multipart/form-data")
+    else:
+        response = client.post("/image?min_confidence=0", data=image_bin, content_type="application/octet-stream")
+
+    assert response.status_code == 200
+    picture = response.json
+    assert len(picture["tags"]) == taggers.FakeTagger().n_tags
+    assert client.get(f"/image/{picture['id']}/raw").data == image_bin
+    # El hash calculado al guardar el fichero permite reutilizar los tags de la imagen
+    assert models.get_image_by_hash(hashlib.sha256(image_bin).hexdigest(), 0)["id"] == picture["id"]
+
+def test_resize_file_for_tagging(image_bin, tmp_path):
+    path = tmp_path / "car1.jpg"
+    path.write_bytes(image_bin)
+
+    for max_edge in (0, 64, 100000):
+        with open(path, "rb") as image_file:
+            assert preprocess.resize_file_for_tagging(image_file, max_edge) == preprocess.resize_for_tagging(image_bin, max_edge)
@@ -0,0 +1,96 @@
+import pytest
+import requests
+
+from image_tags_api import resilience
+from image_tags_api.appexceptions import CircuitOpenError
+from image_tags_api.resilience import CircuitBreaker
+
+
+class Clock:
+    """
+        Reloj monotonic controlado por el test.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    return clock
+
+def fail():
+    raise requests.ConnectionError("sin conexion")
+
+def calls_failing(breaker, n):
+    for _ in range(n):
+        with pytest.raises(requests.ConnectionError):
+            breaker.call(fail)
+
+
+def test_opens_after_threshold(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+
+    calls_failing(breaker, 2)
+    assert breaker.state == CircuitBreaker.CLOSED
+    calls_failing(breaker, 1)
+    assert breaker.state == CircuitBreaker.OPEN
+    # Con el circuito abierto no se llama al servicio
+    with pytest.raises(CircuitOpenError):
+        breaker.call(pytest.fail, "no se debe llamar al servicio")
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+
+    calls_failing(breaker, 2)
+    assert breaker.call(lambda: "ok") == "ok"
+    calls_failing(breaker, 2)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 2
+
+def test_request_errors_do_not_count(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=10)
+
+    with pytest.raises(ValueError):
+        breaker.call(lambda: int("x"))
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_half_open_after_reset_timeout(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=10)
+    calls_failing(breaker, 1)
+
+    clock.now += 9.9
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "ok")
+    assert breaker.status()["open_seconds"] == pytest.approx(9.9)
+
+    # Pasado reset_timeout se deja pasar una llamada de prueba: si tiene exito el circuito se cierra
+    clock.now += 0.1
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.status() == {"state": CircuitBreaker.CLOSED, "failures": 0, "open_seconds": 0.0}
+
+def test_half_open_failure_reopens(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=10)
+    calls_failing(breaker, 2)
+
+    clock.now += 10
+    # Un unico fallo en half_open vuelve a abrir el circuito durante otros reset_timeout segundos
+    calls_failing(breaker, 1)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 5
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "ok")
+
+def test_config_from_environment(monkeypatch):
+    monkeypatch.setenv("BREAKER_FAILURE_THRESHOLD", "7")
+    monkeypatch.setenv("BREAKER_RESET_TIMEOUT", "2.5")
+
+    breaker = CircuitBreaker("test")
+
+    assert (breaker.failure_threshold, breaker.reset_timeout) == (7, 2.5)
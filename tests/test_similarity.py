@@ -0,0 +1,88 @@
+import random
+
+import numpy as np
+import pytest
+
+from image_tags_api.similarity import TagIndex
+
+VOCABULARY = [f"tag{i}" for i in range(40)]
+
+
+def random_tags(rng):
+    # Con un unico tag todas las imagenes que lo comparten empatan: usamos al menos dos para que el orden este definido
+    return [{"tag": tag, "confidence": round(rng.uniform(1, 100), 3)} for tag in rng.sample(VOCABULARY, rng.randint(2, 8))]
+
+def brute_force_top_k(pictures, tags, k, exclude=None):
+    """
+        Similitud coseno de tags con cada imagen de pictures (dict id -> tags), calculada con vectores densos.
+    """
+    def vector(picture_tags):
+        v = np.zeros(len(VOCABULARY))
+        for t in picture_tags:
+            v[VOCABULARY.index(t["tag"])] = t["confidence"]
+        return v
+    query = vector(tags)
+    scores = []
+    for picture_id, picture_tags in pictures.items():
+        v = vector(picture_tags)
+        score = float(query @ v / (np.linalg.norm(query) * np.linalg.norm(v)))
+        if picture_id != exclude and score > 0:
+            scores.append((score, picture_id))
+    return sorted(scores, reverse=True)[:k]
+
+def assert_same_top_k(index, pictures, tags, k, exclude=None):
+    result = index.top_k(tags, k, exclude=exclude)
+    expected = brute_force_top_k(pictures, tags, k, exclude)
+
+    assert [r["id"] for r in result] == [picture_id for _, picture_id in expected]
+    assert [r["similarity"] for r in result] == pytest.approx([score for score, _ in expected], abs=1e-5)
+
+
+@pytest.mark.parametrize("merge_threshold", [10**6, 50])
+def test_top_k_matches_brute_force(merge_threshold):
+    rng = random.Random(merge_threshold)
+    pictures = {f"p{i}": random_tags(rng) for i in range(300)}
+    index = TagIndex(merge_threshold=merge_threshold)
+    # Parte de las imagenes se añaden en bloque a la matriz principal y el resto una a una al delta
+    items = list(pictures.items())
+    index.add_many(items[:150])
+    for picture_id, tags in items[150:]:
+        index.add(picture_id, tags)
+
+    assert len(index) == len(pictures)
+    for picture_id in rng.sample(list(pictures), 20):
+        assert_same_top_k(index, pictures, pictures[picture_id], 10, exclude=picture_id)
+    assert_same_top_k(index, pictures, random_tags(rng), 500)
+
+@pytest.mark.parametrize("merge_threshold", [10**6, 50])
+def test_top_k_after_update(merge_threshold):
+    rng = random.Random(merge_threshold + 1)
+    pictures = {f"p{i}": random_tags(rng) for i in range(300)}
+    index = TagIndex(merge_threshold=merge_threshold)
+    index.add_many(pictures.items())
+    # Actualizamos imagenes de la matriz principal y, varias veces, imagenes ya actualizadas en el delta
+    for picture_id in [rng.choice(list(pictures)) for _ in range(150)]:
+        pictures[picture_id] = random_tags(rng)
+        index.update(picture_id, pictures[picture_id])
+    index.update("nueva", [{"tag": "tag0", "confidence": 50}])
+    pictures["nueva"] = [{"tag": "tag0", "confidence": 50}]
+
+    assert len(index) == len(pictures)
+    for picture_id in rng.sample(list(pictures), 20):
+        assert_same_top_k(index, pictures, pictures[picture_id], 10, exclude=picture_id)
+    assert_same_top_k(index, pictures, random_tags(rng), 500)
+
+def test_add_ignores_existing_picture():
+    index = TagIndex()
+    index.add("p1", [{"tag": "car", "confidence": 90}])
+    index.add("p1", [{"tag": "sky", "confidence": 90}])
+
+    assert index.top_k([{"tag": "sky", "confidence": 90}], 5) == []
+    assert [r["id"] for r in index.top_k([{"tag": "car", "confidence": 90}], 5)] == ["p1"]
+
+def test_top_k_unknown_tags():
+    index = TagIndex()
+    index.add("p1", [{"tag": "car", "confidence": 90}])
+
+    assert index.top_k([{"tag": "boat", "confidence": 90}], 5) == []
+    assert index.top_k([], 5) == []
@@ -0,0 +1,23 @@
+import time
+
+from image_tags_api import models, startup
+
+
+def test_warm_db_pool_capped_to_pool_capacity(database, monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "2")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "1")
+    models.init_engine()
+
+    assert startup.warm_db_pool(10, timeout=5) == 3
+    # Las conexiones del overflow se cierran al devolverlas al pool
+    assert models.get_pool_status()["checked_in"] == 2
+
+def test_warm_db_pool_partial(database, monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "2")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "1")
+    models.init_engine()
+    # Una peticion en curso ocupa una conexion del pool durante el calentamiento
+    with models.connect():
+        start = time.perf_counter()
+        assert startup.warm_db_pool(3, timeout=0.5) == 3
+        assert time.perf_counter() - start < 5
@@ -0,0 +1,123 @@
+import os
+import time
+import uuid
+import threading
+
+import pytest
+
+from image_tags_api import models, storage
+
+
+class YieldingLock:
+    """
+        Lock que cede el procesador al liberarse, para que otros threads se intercalen justo despues.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+
+    def __exit__(self, *args):
+        self._lock.release()
+        time.sleep(0.0001)
+
+
+def test_read_while_appending(tmp_path, monkeypatch):
+    # Pocos mapas y segmentos pequeños: los mapas se sustituyen y se expulsan continuamente mientras se leen
+    monkeypatch.setenv("PACK_MAX_MAPS", "2")
+    monkeypatch.setattr(storage, "_maps", storage.OrderedDict())
+    monkeypatch.setattr(storage, "_maps_lock", YieldingLock())
+    store = storage.PackStore(str(tmp_path), segment_size=256*1024)
+    images = []
+    for i in range(20):
+        image_bin = bytes([i % 256]) * (4096 + i)
+        images.append((image_bin, store.put(image_bin)))
+    stop = threading.Event()
+    errors = []
+
+    def append():
+        i = 0
+        while not stop.is_set():
+            image_bin = bytes([i % 256]) * (1024 + i % 4096)
+            images.append((image_bin, store.put(image_bin)))
+            i += 1
+
+    def read():
+        try:
+            for n in range(1000):
+                image_bin, location = images[n * 7919 % len(images)]
+                assert storage.read(location) == image_bin
+                assert storage.read(location, 16) == image_bin[:16]
+        except Exception as error:
+            errors.append(error)
+
+    writer = threading.Thread(target=append)
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    writer.start()
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    stop.set()
+    writer.join()
+
+    assert errors == []
+    assert len(store.segments()) > 2
+
+
+@pytest.fixture
+def pack_store(database, tmp_path, monkeypatch):
+    """
+        Almacen de segmentos de 10 KB en una carpeta temporal, como almacen del proceso.
+    """
+    store = storage.PackStore(str(tmp_path), segment_size=10*1024)
+    monkeypatch.setattr(storage, "_store", store)
+    monkeypatch.setattr(storage, "_maps", storage.OrderedDict())
+    return store
+
+def register(store, image_bin):
+    picture_id = str(uuid.uuid4())
+    location = store.put(image_bin)
+    models.insert_picture_tags(picture_id, "2023-05-01 10:00:00", location["path"], len(image_bin), [], location=location)
+    return picture_id
+
+def age_segments(store, seconds):
+    for segment in store.segments():
+        path = os.path.join(store.folder, segment)
+        os.utime(path, (time.time() - seconds, time.time() - seconds))
+
+def test_compact_segments(pack_store):
+    # Primer segmento: una imagen registrada y dos escritas que no se han llegado a registrar
+    picture_id = register(pack_store, b"a" * 4000)
+    pack_store.put(b"b" * 4000)
+    pack_store.put(b"c" * 2000)
+    register(pack_store, b"d" * 4000)
+    first = pack_store.segments()[0]
+
+    # Un segmento escrito recientemente puede tener imagenes que aun no estan en la BBDD
+    assert storage.compact_segments()["segments"] == 0
+    age_segments(pack_store, 3600)
+    result = storage.compact_segments()
+
+    assert result == {"segments": 1, "bytes": 6000}
+    assert first not in pack_store.segments()
+    location = storage.pop_location(models.get_image_by_id(picture_id))
+    assert storage.read(location) == b"a" * 4000
+
+def test_compact_keeps_segment_written_during_compaction(pack_store, monkeypatch):
+    register(pack_store, b"a" * 4000)
+    pack_store.put(b"b" * 6000)
+    register(pack_store, b"c" * 4000)
+    first = pack_store.segments()[0]
+    age_segments(pack_store, 3600)
+    # Otro proceso, con el segmento como activo, escribe en el mientras se copian sus imagenes
+    put = pack_store.put
+    def put_and_write(image_bin, name=None):
+        with open(os.path.join(pack_store.folder, first), "ab") as f:
+            f.write(b"e" * 100)
+        return put(image_bin, name)
+    monkeypatch.setattr(pack_store, "put", put_and_write)
+
+    assert storage.compact_segments()["segments"] == 0
+    assert first in pack_store.segments()
@@ -0,0 +1,77 @@
+import os
+import re
+import uuid
+
+import pytest
+
+from image_tags_api import models
+
+# Imagenes justo en la medianoche, en los segundos de alrededor y a mitad de dia
+DATES = ["2023-05-01 00:00:00", "2023-05-01 00:00:01", "2023-05-01 12:00:00", "2023-05-01 23:59:59",
+         "2023-05-02 00:00:00", "2023-05-02 08:30:00", "2023-05-02 23:59:59", "2023-05-03 00:00:00",
+         "2023-05-03 18:45:00", "2023-05-04 00:00:00", "2023-05-04 00:00:01"]
+
+
+@pytest.fixture
+def pictures(database):
+    """
+        Registra una imagen por cada fecha de DATES con tags por encima y por debajo de 80.
+    """
+    for i, date in enumerate(DATES):
+        tags = [{"tag": "car", "confidence": 81 + i}, {"tag": "road", "confidence": 70 + 3 * i},
+                {"tag": "sky", "confidence": 40 + i}]
+        models.insert_picture_tags(str(uuid.uuid4()), date, "x.jpg", 100, tags, min_confidence=0)
+
+def assert_same_stats(rollup, raw):
+    assert [(s["tag"], s["n"], s["min_confidence"], s["max_confidence"]) for s in rollup] == \
+        [(s["tag"], s["n"], s["min_confidence"], s["max_confidence"]) for s in raw]
+    assert [s["mean_confidence"] for s in rollup] == pytest.approx([s["mean_confidence"] for s in raw])
+
+
+@pytest.mark.parametrize("min_date, max_date", [
+    # Extremos en la medianoche
+    ("2023-05-01 00:00:00", "2023-05-03 00:00:00"),
+    ("2023-04-30 23:59:59", "2023-05-04 00:00:00"),
+    ("2023-05-01 00:00:00", "2023-05-04 00:00:01"),
+    # Extremos a mitad de dia
+    ("2023-05-01 06:00:00", "2023-05-03 18:45:00"),
+    ("2023-05-01 12:00:00", "2023-05-04 12:00:00"),
+    # Rangos dentro de un mismo dia o de dos dias consecutivos, sin dias completos
+    ("2023-05-02 00:00:00", "2023-05-02 23:59:59"),
+    ("2023-05-01 12:00:00", "2023-05-02 08:30:00"),
+    ("2023-05-02 23:59:59", "2023-05-03 00:00:00"),
+    # Rangos abiertos
+    ("", "2023-05-03 00:00:00"),
+    ("2023-05-01 12:00:00", ""),
+    ("", ""),
+])
+def test_rollup_matches_tags(pictures, min_date, max_date):
+    rollup = models.get_tags_stats_by_date(min_date, max_date, use_rollup=True)
+    raw = models.get_tags_stats_by_date(min_date, max_date, use_rollup=False)
+
+    assert_same_stats(rollup, raw)
+
+def test_rollup_only_counts_default_confidence(pictures):
+    stats = {s["tag"]: s for s in models.get_tags_stats_by_date("", "", use_rollup=True)}
+
+    assert stats["car"]["n"] == len(DATES)
+    assert stats["road"]["min_confidence"] > models.TAG_STATS_MIN_CONFIDENCE
+    assert "sky" not in stats
+
+def test_other_min_confidence_reads_tags(pictures):
+    stats = {s["tag"]: s for s in models.get_tags_stats_by_date("2023-05-01 00:00:00", "2023-05-04 00:00:00",
+                                                                 use_rollup=True, min_confidence=None)}
+
+    # Los extremos del rango quedan excluidos
+    assert stats["sky"]["n"] == len(DATES) - 3
+    assert stats["road"]["min_confidence"] == 73
+
+def test_tag_stats_threshold_matches_migration():
+    # Las filas de tag_stats se calcularon en la migracion 10 con un umbral fijo
+    path = os.path.join(os.path.dirname(__file__), "..", "scripts", "migracion_10_estadisticas_tags_confianza.sql")
+    with open(path) as f:
+        thresholds = re.findall(r"where confidence > (\d+)", f.read())
+
+    assert thresholds == [str(models.TAG_STATS_MIN_CONFIDENCE)]
+    # GET /tags solo usa el rollup por defecto si coinciden
+    assert models.DEFAULT_MIN_CONFIDENCE == models.TAG_STATS_MIN_CONFIDENCE